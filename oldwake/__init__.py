@@ -21,6 +21,7 @@ from .utils import *
 from . import pkg as mpkg
 from . import store as mstore
 from . import hash as mhash
+from . import retrieve as mretrieve
 
 
 class Config(object):
@@ -31,8 +32,19 @@ class Config(object):
         root_config = mpkg.PkgConfig(self.base)
         self.pkgs_locked = pjoin(root_config.wakedir, "pkgsLocked.json")
         self.pkgs_defined = pjoin(root_config.wakedir, "pkgsDefined.jsonnet")
+        self.pkgs_retrieved = pjoin(root_config.wakedir, "pkgsRetrieved.json")
         self.run = pjoin(root_config.wakedir, "run.jsonnet")
 
+        # {pkg_req: [pkg_ver]} retrieved in this and earlier builds with the
+        # same requirement inputs (see ``load_retrieved``).
+        self.retrieved = {}
+        self.retrieved_fingerprint = None
+        # {PkgName: Exec} of the retriever of every retrieved pkg.
+        self.retrievers = {}
+        # {pkg_key: pkg_ver} locked by the last build, to guess prefetches.
+        lock = self.load_lock()
+        self.locked_before = lock['pkgs'] if lock else {}
+
         user_file = pjoin(self.user_path, "user.jsonnet")
         if not path.exists(user_file):
             fail("must instantiate user credentials: " + user_file)
@@ -42,6 +54,14 @@ class Config(object):
             self.base,
             pjoin(self.user_path, self.user.get('store', 'store')),
         )
+        self.prefetcher = mretrieve.Prefetcher(
+            self.store,
+            budget=self.user.get('prefetchBudget',
+                                 mretrieve.DEFAULT_PREFETCH_BUDGET),
+            jobs=self.user.get('retrieveJobs', mretrieve.DEFAULT_JOBS),
+            jobs_per_exec=self.user.get('retrieveJobsPerExec',
+                                        mretrieve.DEFAULT_JOBS_PER_EXEC),
+        )
 
     def init(self):
         self.store.init_store()
@@ -95,7 +115,9 @@ class Config(object):
         jsondumpf(pkg_config.pkg_fingerprint, fingerprint.to_dict(), indent=4)
         return fingerprint
 
-    def handle_unresolved_pkg(self, pkg, locked):
+    def handle_unresolved_pkg(self, pkg, locked, retrieve):
+        """Handle an unresolved pkg, appending it to ``retrieve`` if it must
+        be retrieved (see ``retrieve_pkgs``)."""
         from_ = pkg.from_
         using_pkg = pkg.using_pkg
 
@@ -106,88 +128,342 @@ class Config(object):
             # if out is None:
             #     raise ValueError("{} was not in the store".format(pkg))
             return out
-        else:
-            self.exec_get_pkg(pkg, locked)
-
-    def exec_get_pkg(self, pkg, locked):
-        # TODO: these should be collected and called all at once.
 
-        get_exec = pkg.exec_
-
-        cmd = {
-            F_TYPE: C_READ_PKGS,
-            'definitionOnly': True,
-            'pkgVersions': [str(pkg.pkg_req)],
-        }
-
-        exec_path = pjoin(
-            self.store.get_pkg_path(get_exec.path_ref.pkg_ver),
-            get_exec.path_ref.path,
+        if pkg.exec_ is not None:
+            self.retrievers[mpkg.PkgName(pkg.pkg_req.namespace,
+                                         pkg.pkg_req.name)] = pkg.exec_
+        if not self.lock_retrieved(pkg, locked):
+            retrieve.append(pkg)
+
+    def load_retrieved(self, fingerprint):
+        """Load the pkgs retrieved by earlier builds, unless they were built
+        from other requirement inputs (see ``inputs_fingerprint``), which
+        can resolve the same requests differently.
+        """
+        self.retrieved = {}
+        self.retrieved_fingerprint = fingerprint
+        if path.exists(self.pkgs_retrieved):
+            retrieved = jsonloadf(self.pkgs_retrieved)
+            if retrieved.get('fingerprint') == fingerprint:
+                self.retrieved = retrieved['pkgs']
+
+    def lock_retrieved(self, pkg, locked):
+        """Lock the pkgs retrieved for the pkg's request by an earlier build.
+
+        Returns False if there are none, or their definitions are no longer
+        in the store.
+        """
+        pkg_vers = self.retrieved.get(str(pkg.pkg_req))
+        if not pkg_vers:
+            return False
+        if not all(self.store.get_pkg_path(v, def_okay=True)
+                   for v in pkg_vers):
+            return False
+
+        for pkg_ver in pkg_vers:
+            locked[mpkg.PkgName.from_pkg_ver(pkg_ver)] = pkg_ver
+        return True
+
+    def prefetch(self, retrieve, locked):
+        """Prefetch the content of the pkgVers which will probably be locked.
+
+        In order: the locked pkgs, then the pkgVers which the pkgs to
+        ``retrieve`` were locked to by the last build and retrieved as in
+        earlier builds. Guesses which conflict with a locked pkg are
+        discarded.
+        """
+        guesses = list(locked.values())
+        for pkg in retrieve:
+            pkg_key = mpkg.PkgName(pkg.pkg_req.namespace, pkg.pkg_req.name)
+            if str(pkg_key) in self.locked_before:
+                guesses.append(self.locked_before[str(pkg_key)])
+            guesses.extend(self.retrieved.get(str(pkg.pkg_req), []))
+
+        def is_wrong(pkg_ver):
+            pkg_key = mpkg.PkgName.from_pkg_ver(pkg_ver)
+            return locked.get(pkg_key, pkg_ver) != pkg_ver
+
+        self.prefetcher.discard(is_wrong)
+        self.prefetcher.submit(
+            [
+                v for v in guesses
+                if not is_wrong(v)
+                and mpkg.PkgName.from_pkg_ver(v) in self.retrievers
+                and self.store.get_pkg_path(v) is None
+            ],
+            self.retriever_path,
         )
 
-        run_dir = self.store.get_retrieval_dir()
-        result = subprocess.run(
-            [exec_path],
-            input=json.dumps(cmd).encode(),
-            cwd=run_dir,
-            stderr=subprocess.PIPE,
+    def retrieve_pkgs(self, pkgs, locked, depths):
+        """Retrieve the pkgs, running the retriever execs concurrently.
+
+        depths: the ``{pkg_req: depth}`` of the pkgs, shallowest are
+            retrieved first.
+        """
+        jobs = mretrieve.make_jobs(pkgs, self.exec_path, depths)
+        scheduler = mretrieve.Scheduler(
+            self.store,
+            jobs=self.user.get('retrieveJobs', mretrieve.DEFAULT_JOBS),
+            jobs_per_exec=self.user.get('retrieveJobsPerExec',
+                                        mretrieve.DEFAULT_JOBS_PER_EXEC),
+        )
+        scheduler.run(
+            jobs,
+            lambda job, pdir: self.ingest_retrieved(job, pdir, locked),
+            lambda job: self.finish_retrieval(job, locked),
         )
 
-        print("retreiving pkg {} into {}".format(str(pkg.pkg_req), run_dir))
-        if result.returncode != 0:
-            raise RuntimeError("Failed: " + result.stderr.decode())
-
-        retrieved = path.join(run_dir, DIR_WAKE, DIR_RETRIEVED)
-        for pdir in os.listdir(retrieved):
-            pkg_path = os.path.join(retrieved, pdir)
-            ret_config = mpkg.PkgConfig(pkg_path)
-
-            if not os.path.exists(ret_config.wakedir):
-                os.mkdir(ret_config.wakedir)
-            if not os.path.exists(ret_config.path_local_deps):
-                jsondumpf(ret_config.path_local_deps, {})
-
-            self.dump_pkg_fingerprint(ret_config)
-            simple_pkg = self.run_pkg(ret_config).root
-            self.store.add_pkg(ret_config, simple_pkg)
+    def retrieve_content(self, pkg_vers, locked):
+        """Retrieve the full content of the pkg_vers which only have their
+        definition in the store.
+
+        Each pkg_ver is retrieved by the retriever its definition was
+        retrieved with, which must return exactly the same pkg_ver.
+        """
+        pkg_vers = [v for v in pkg_vers if self.store.get_pkg_path(v) is None]
+        # A prefetched job can also have retrieved wrong guesses.
+        for job in self.prefetcher.take(pkg_vers):
+            self.finish_retrieval(job, locked, wanted=pkg_vers)
+
+        pkg_vers = [v for v in pkg_vers if self.store.get_pkg_path(v) is None]
+        if not pkg_vers:
+            return
+
+        jobs_per_exec = self.user.get('retrieveJobsPerExec',
+                                      mretrieve.DEFAULT_JOBS_PER_EXEC)
+        jobs = mretrieve.make_content_jobs(pkg_vers, self.retriever_path,
+                                           jobs_per_exec)
+        scheduler = mretrieve.Scheduler(
+            self.store,
+            jobs=self.user.get('retrieveJobs', mretrieve.DEFAULT_JOBS),
+            jobs_per_exec=jobs_per_exec,
+        )
+        scheduler.run(
+            jobs,
+            lambda job, pdir: self.ingest_retrieved(job, pdir, locked),
+            lambda job: self.finish_retrieval(job, locked),
+        )
 
-            # TODO: version resolution should happen before this is done.
-            locked[simple_pkg.get_pkg_key()] = simple_pkg.pkg_ver
+        missing = [v for v in pkg_vers if self.store.get_pkg_path(v) is None]
+        if missing:
+            raise ValueError("the content of {} was not retrieved".format(
+                missing))
+
+    def retriever_path(self, pkg_ver):
+        """Return the path of the exec which retrieved the pkg_ver."""
+        get_exec = self.retrievers.get(mpkg.PkgName.from_pkg_ver(pkg_ver))
+        if get_exec is None:
+            fail("no retriever is known for {}".format(pkg_ver))
+        return self.exec_path(get_exec)
+
+    def exec_path(self, get_exec):
+        """Return the path of an exec, retrieving the content of its pkg if
+        only its definition is in the store."""
+        pkg_ver = get_exec.path_ref.pkg_ver
+        if self.store.get_pkg_path(pkg_ver) is None:
+            self.retrieve_content([pkg_ver], {})
+        return pjoin(self.store.get_pkg_path(pkg_ver), get_exec.path_ref.path)
+
+    def ingest_retrieved(self, job, pdir, locked, wanted=None):
+        """Add a pkg retrieved by a job to the store and lock it.
+
+        wanted: the pkg_vers whose content is stored, by default all of the
+            job's. The content of the others (i.e. the wrong guesses of a
+            prefetched job) is dropped.
+        """
+        pkg_path = path.join(job.retrieved_dir(), pdir)
+        if not job.definition_only:
+            ret_config, simple_pkg = self.fingerprint_retrieved(pkg_path)
+            if simple_pkg.pkg_ver not in job.reqs:
+                raise ValueError(
+                    "retrieved {} does not match its definition, expected "
+                    "one of {}".format(simple_pkg.pkg_ver, job.reqs))
+            if wanted is None or simple_pkg.pkg_ver in wanted:
+                self.store.add_pkg(ret_config, simple_pkg)
+            return
+
+        simple_pkg = self.add_retrieved(pkg_path, definition_only=True)
+        # TODO: version resolution should happen before this is done.
+        locked[simple_pkg.get_pkg_key()] = simple_pkg.pkg_ver
+        job.retrieved.setdefault(simple_pkg.get_pkg_key(),
+                                 []).append(simple_pkg.pkg_ver)
+
+    def finish_retrieval(self, job, locked, wanted=None):
+        """Ingest the pkgs of a finished job which were not streamed (see
+        ``ingest_retrieved`` for ``wanted``)."""
+        retrieved = job.retrieved_dir()
+        pdirs = sorted(os.listdir(retrieved)) if path.exists(retrieved) else []
+        for pdir in pdirs:
+            if pdir not in job.ingested:
+                self.ingest_retrieved(job, pdir, locked, wanted)
+                job.ingested.add(pdir)
+        self.store.remove_retrieval_dir(job.run_dir)
+        if not job.definition_only:
+            return
+
+        for pkg in job.pkgs:
+            pkg_key = mpkg.PkgName(pkg.pkg_req.namespace, pkg.pkg_req.name)
+            self.retrieved[str(pkg.pkg_req)] = job.retrieved.get(pkg_key, [])
+        jsondumpf(self.pkgs_retrieved, {
+            'fingerprint': self.retrieved_fingerprint,
+            'pkgs': self.retrieved,
+        })
+
+    def add_retrieved(self, pkg_path, definition_only=False):
+        """Fingerprint a retrieved pkg and add it to the store.
+
+        definition_only: only the pkg's definition is stored, unless the
+            retriever returned its content anyway.
+        """
+        ret_config, simple_pkg = self.fingerprint_retrieved(pkg_path)
+        if definition_only:
+            definition_only = not all(
+                path.exists(p) for p in ret_config.paths_abs(simple_pkg.paths))
+        self.store.add_pkg(ret_config, simple_pkg,
+                           definition_only=definition_only)
+        return simple_pkg
+
+    def fingerprint_retrieved(self, pkg_path):
+        """Fingerprint a retrieved pkg, returning its PkgConfig and
+        PkgSimple."""
+        ret_config = mpkg.PkgConfig(pkg_path)
+
+        if not os.path.exists(ret_config.wakedir):
+            os.mkdir(ret_config.wakedir)
+        if not os.path.exists(ret_config.path_local_deps):
+            jsondumpf(ret_config.path_local_deps, {})
+
+        self.dump_pkg_fingerprint(ret_config)
+        return ret_config, self.run_pkg(ret_config).root
+
+    def inputs_fingerprint(self, local_pkgs):
+        """Hash the requirement inputs of a build: the definition of the
+        local pkgs, as in ``compute_pkg_fingerprint`` (their PKG file, local
+        deps and ``paths_def``).
+
+        local_pkgs: the ``[(PkgConfig, PkgSimple)]`` of the local pkgs.
+        """
+        hashstuff = mhash.HashStuff(self.base)
+        for local_config, local_pkg in local_pkgs:
+            if path.exists(local_config.path_local_deps):
+                hashstuff.update_file(local_config.path_local_deps)
+            hashstuff.update_file(local_config.pkg_root)
+            hashstuff.update_paths(local_config.paths_abs(
+                local_pkg.paths_def))
+        return hashstuff.reduce()
+
+    def load_lock(self):
+        """Return the ``{'fingerprint', 'pkgs'}`` of pkgsLocked.json, or None
+        if it is missing or not a lockfile of this format (i.e. corrupt,
+        partially written or from an older wake)."""
+        if not path.exists(self.pkgs_locked):
+            return None
+        try:
+            lock = jsonloadf(self.pkgs_locked)
+        except ValueError:
+            return None
+        if not isinstance(lock, dict):
+            return None
+        fingerprint = lock.get('fingerprint')
+        pkgs = lock.get('pkgs')
+        if not isinstance(fingerprint, str) or not isinstance(pkgs, dict):
+            return None
+        for key, pkg_ver in pkgs.items():
+            if len(key.split(WAKE_SEP)) != 2 or not isinstance(pkg_ver, str):
+                return None
+        return lock
+
+    def use_lock(self, fingerprint, locked):
+        """Lock the pkgs of pkgsLocked.json if it was written for the same
+        requirement inputs and all of its pkgs are still in the store.
+
+        Pkgs which are already in ``locked`` (the local pkgs) are kept.
+        """
+        lock = self.load_lock()
+        if lock is None or lock['fingerprint'] != fingerprint:
+            return False
+
+        pkgs = {}
+        for key, pkg_ver in lock['pkgs'].items():
+            pkg_key = mpkg.PkgName(*key.split(WAKE_SEP))
+            if pkg_key not in locked:
+                pkgs[pkg_key] = pkg_ver
+        if not all(self.store.get_pkg_path(v) for v in pkgs.values()):
+            return False
+        locked.update(pkgs)
+        return True
+
+    def dump_lock(self, fingerprint, locked, local_keys):
+        """Write pkgsLocked.json (without the local pkgs), unless it is
+        unchanged."""
+        lock = {
+            'fingerprint': fingerprint,
+            'pkgs': {
+                str(pkg_key): pkg_ver
+                for pkg_key, pkg_ver in locked.items()
+                if pkg_key not in local_keys
+            },
+        }
+        if self.load_lock() == lock:
+            return
+        jsondumpf(self.pkgs_locked, lock)
 
     def create_defined_pkgs(self, locked):
+        lines = ["{\n"]
+        for pkg_key, pkg_ver in sorted(locked.items()):
+            lines.append("  \"{}\": import \"{}/{}\",\n".format(
+                pkg_key,
+                self.store.get_pkg_path(pkg_ver, def_okay=True),
+                FILE_PKG,
+            ))
+        lines.append("}\n")
+        text = "".join(lines)
+
+        # Most cycles don't change the locked pkgs: don't touch the file (and
+        # invalidate jsonnet's view of it) unless it changed.
+        if path.exists(self.pkgs_defined):
+            with open(self.pkgs_defined) as fd:
+                if fd.read() == text:
+                    return
+
         with open(self.pkgs_defined, 'w') as fd:
-            fd.write("{\n")
-            for pkg_key, pkg_ver in locked.items():
-                line = "  \"{}\": import \"{}/{}\",\n".format(
-                    pkg_key,
-                    self.store.get_pkg_path(pkg_ver),
-                    FILE_PKG,
-                )
-                fd.write(line)
-            fd.write("}\n")
+            fd.write(text)
+            fd.flush()
             os.fsync(fd)
 
 
 ## COMMANDS AND MAIN
 
 
-def run_cycle(config, root_config, locked):
-    """Run a cycle with the config and root_config at the current setting."""
+def run_cycle(config, root_config, locked, handled):
+    """Run a cycle with the config and root_config at the current setting.
+
+    Only unresolved pkgs whose request is not in ``handled`` (the requests
+    handled by earlier cycles) are handled.
+    """
     manifest = config.run_pkg(root_config, locked)
 
     num_unresolved = 0
+    retrieve = []
     for pkg in manifest.all:
         if isinstance(pkg, mpkg.PkgUnresolved):
             num_unresolved += 1
-            config.handle_unresolved_pkg(pkg, locked)
-
+            req = str(pkg.pkg_req)
+            if req in handled:
+                continue
+            handled.add(req)
+            config.handle_unresolved_pkg(pkg, locked, retrieve)
+
+    config.prefetch(retrieve, locked)
+    config.retrieve_pkgs(retrieve, locked, mretrieve.request_depths(manifest))
     return (num_unresolved, manifest)
 
 
-def store_local(config, local_abs, locked):
+def store_local(config, local_abs, locked, local_pkgs):
     """Recursively traverse local dependencies, putting them in the store.
 
-    Also stores own version in the lockfile.
+    Also stores own version in the lockfile and its config and pkg in
+    ``local_pkgs``.
     """
     local_config = mpkg.PkgConfig(local_abs)
     if not path.exists(local_config.pkg_fingerprint):
@@ -211,6 +487,7 @@ def store_local(config, local_abs, locked):
                 config,
                 pjoin(local_abs, dep.from_),
                 locked,
+                local_pkgs,
             ).pkg_ver
 
     deps = OrderedDict(sorted(deps.items()))
@@ -222,6 +499,7 @@ def store_local(config, local_abs, locked):
         raise ValueError(
             "Attempted to add {} to local overrides twice.".format(local_key))
     locked[local_key] = local_pkg.pkg_ver
+    local_pkgs.append((local_config, local_pkg))
     config.store.add_pkg(
         local_config,
         # Note: we don't pass deps here because we only care about hashes
@@ -256,26 +534,52 @@ def build(args):
     # - When retieving pkgs, we first check if the VERSION is in the local store.
     #   if it is, we take it.
     locked = {}
-    store_local(config, config.base, locked)
+    local_pkgs = []
+    store_local(config, config.base, locked, local_pkgs)
+    local_keys = set(locked)
+    fingerprint = config.inputs_fingerprint(local_pkgs)
+    config.load_retrieved(fingerprint)
+
+    if config.use_lock(fingerprint, locked):
+        print("## LOCKED: pkgsLocked.json is up to date")
+        manifest = config.run_pkg(root_config, locked)
+        if not any(p.is_unresolved() for p in manifest.all):
+            pp(manifest.to_dict())
+            return
+        print("-> locked pkgs are incomplete, running build cycles")
 
     print("## BUILD CYCLES")
 
-    cycle = 0
-    unresolved = -1
-    while unresolved:
-        print("### CYCLE={}".format(cycle))
-        print("-> locked pkgs")
-        pp(locked)
-        # TODO: run in loop
-        new_unresolved, manifest = run_cycle(config, root_config, locked)
-
-        print("-> manifest below. unresolved={}".format(new_unresolved))
-        pp(manifest.to_dict())
-
-        if unresolved == new_unresolved:
-            fail("deadlock detected: unresolved has not changed for a cycle")
-        unresolved = new_unresolved
-        cycle += 1
+    try:
+        cycle = 0
+        unresolved = -1
+        handled = set()
+        while unresolved:
+            print("### CYCLE={}".format(cycle))
+            print("-> locked pkgs")
+            pp(locked)
+            # TODO: run in loop
+            new_unresolved, manifest = run_cycle(config, root_config, locked,
+                                                 handled)
+
+            print("-> manifest below. unresolved={}".format(new_unresolved))
+            pp(manifest.to_dict())
+
+            if unresolved == new_unresolved:
+                fail("deadlock detected: unresolved has not changed for a "
+                     "cycle")
+            unresolved = new_unresolved
+            cycle += 1
+
+        print("-> retrieving the content of the locked pkgs")
+        config.retrieve_content(
+            [v for k, v in locked.items() if k not in local_keys],
+            locked,
+        )
+    finally:
+        # Whatever was prefetched and not taken was a wrong guess.
+        config.prefetcher.close()
+    config.dump_lock(fingerprint, locked, local_keys)
 
 
 def parse_args(argv):
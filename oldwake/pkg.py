@@ -51,6 +51,10 @@ class PkgName(TupleObject):
         self.namespace = namespace
         self.name = name
 
+    @classmethod
+    def from_pkg_ver(cls, pkg_ver):
+        return cls(*pkg_ver.split(WAKE_SEP)[:2])
+
     def __str__(self):
         return WAKE_SEP.join((self.namespace, self.name))
 
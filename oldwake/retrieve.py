@@ -0,0 +1,395 @@
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Concurrent retrieval of pkgs by their retriever execs.
+
+Every retriever exec runs as a subprocess in its own retrieval directory.
+Jobs are started shallowest dependency depth first, within a global and a
+per-retriever limit of concurrent jobs.
+
+Retrievers are asked to ``stream``: as soon as a pkg is completely written
+to ``.wake/retrieved/<dir>`` they print a line with the json record
+
+    {"__WAKETYPE__": "retrievedPkg", "dir": "<dir>"}
+
+to stdout, and wake ingests it while the rest is still being retrieved
+(see the Retrievers section of DESIGN.md). Pkgs which were not announced
+(i.e. by retrievers which don't stream) are ingested once the retriever
+exited. The retrievers run on an event loop in a background thread while
+the pkgs are ingested in the calling thread, so that a slow ingestion
+never stalls the retrievers.
+
+Retrieval has two phases: while the build cycles resolve the pkg tree only
+the definitions of pkgs are retrieved, then the full content of just the
+locked pkgVers is retrieved (see ``make_content_jobs``). The content of
+pkgVers which will probably be locked is prefetched while the cycles are
+still resolving (see ``Prefetcher``).
+"""
+
+import asyncio
+import queue
+import threading
+from collections import deque
+
+from .utils import *
+from . import pkg as mpkg
+
+DEFAULT_JOBS = 8
+DEFAULT_JOBS_PER_EXEC = 2
+DEFAULT_PREFETCH_BUDGET = 32
+
+
+class RetrieveJob(object):
+    """One execution of a retriever.
+
+    reqs: the requested ``pkgVersions``, pkg_reqs for definitions or the
+        exact pkg_vers for content.
+    pkgs: the unresolved pkgs of the pkg_reqs (if any).
+    """
+    def __init__(self, exec_path, reqs, depth=0, pkgs=(),
+                 definition_only=True):
+        self.exec_path = exec_path
+        self.reqs = reqs
+        self.depth = depth
+        self.pkgs = pkgs
+        self.definition_only = definition_only
+        self.run_dir = None
+        # The dirs of .wake/retrieved which were ingested.
+        self.ingested = set()
+        # {PkgName: [pkg_ver]} of the ingested pkgs.
+        self.retrieved = {}
+
+    def cmd(self):
+        return {
+            F_TYPE: C_READ_PKGS,
+            'definitionOnly': self.definition_only,
+            'stream': True,
+            'pkgVersions': self.reqs,
+        }
+
+    def retrieved_dir(self):
+        return path.join(self.run_dir, DIR_WAKE, DIR_RETRIEVED)
+
+    def __repr__(self):
+        return "RetrieveJob({}, depth={}, {})".format(self.exec_path,
+                                                      self.depth, self.reqs)
+
+
+def make_jobs(pkgs, get_exec_path, depths):
+    """Group the pkgs into one job per retriever exec, so that every
+    retriever is sent a single request per cycle.
+
+    The pkgs of a job are ordered shallowest first and the job has the depth
+    of its shallowest pkg, so the jobs start by depth.
+
+    depths: the ``{pkg_req: depth}`` of the pkgs (see ``request_depths``).
+    """
+    def depth(pkg):
+        return depths.get(str(pkg.pkg_req), 0)
+
+    groups = OrderedDict()
+    for pkg in sorted(pkgs, key=depth):
+        groups.setdefault(get_exec_path(pkg.exec_), []).append(pkg)
+    return [
+        RetrieveJob(exec_path, [str(pkg.pkg_req) for pkg in group],
+                    depth=depth(group[0]), pkgs=group)
+        for exec_path, group in groups.items()
+    ]
+
+
+def make_content_jobs(pkg_vers, get_exec_path, jobs_per_exec):
+    """Split the content retrieval of the pkg_vers into up to
+    ``jobs_per_exec`` jobs per retriever exec.
+
+    get_exec_path: returns the path of the retriever exec of a pkg_ver.
+    """
+    groups = OrderedDict()
+    for pkg_ver in sorted(pkg_vers):
+        groups.setdefault(get_exec_path(pkg_ver), []).append(pkg_ver)
+    jobs = []
+    for exec_path, group in groups.items():
+        for i in range(min(jobs_per_exec, len(group))):
+            jobs.append(RetrieveJob(exec_path, group[i::jobs_per_exec],
+                                    definition_only=False))
+    return jobs
+
+
+def request_depths(manifest):
+    """Return the dependency depth of every unresolved request in the
+    manifest. The root pkg is at depth 0."""
+    simple = {p.pkg_ver: p for p in manifest.all if not p.is_unresolved()}
+    depths = {}
+    seen = {manifest.root.pkg_ver}
+    todo = deque([(manifest.root, 0)])
+    while todo:
+        pkg, depth = todo.popleft()
+        for dep in pkg.pkgs.values():
+            if isinstance(dep, dict):
+                req = str(mpkg.PkgReq.from_str(dep['pkgReq']))
+                depths.setdefault(req, depth + 1)
+            elif dep in simple and dep not in seen:
+                seen.add(dep)
+                todo.append((simple[dep], depth + 1))
+    return depths
+
+
+class Scheduler(object):
+    """Run ``RetrieveJob``s as concurrent subprocesses."""
+    def __init__(self,
+                 store,
+                 jobs=DEFAULT_JOBS,
+                 jobs_per_exec=DEFAULT_JOBS_PER_EXEC):
+        self.store = store
+        self.jobs = jobs
+        self.jobs_per_exec = jobs_per_exec
+
+    def run(self, jobs, on_pkg, on_done):
+        """Run the jobs on an event loop in a background thread. Meanwhile,
+        in this thread:
+
+        - ``on_pkg(job, dir)`` is called for every pkg streamed by a job,
+          unless it is None.
+        - ``on_done(job)`` is called when a job finished.
+
+        Ingesting pkgs (which blocks on jsonnet) therefore never stalls
+        reading the retrievers. The first failure, of a job or of a
+        callback, cancels the jobs still running.
+        """
+        # (job, dir) of streamed pkgs, (job, None) of finished jobs and None
+        # once every job finished or was cancelled.
+        events = queue.Queue()
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            future = asyncio.run_coroutine_threadsafe(
+                self._run(jobs, events), loop)
+            try:
+                for job, pdir in iter(events.get, None):
+                    if pdir is None:
+                        on_done(job)
+                    elif on_pkg is not None and pdir not in job.ingested:
+                        on_pkg(job, pdir)
+                        job.ingested.add(pdir)
+            except BaseException:
+                future.cancel()
+                # Wait for the running jobs to be cancelled (which removes
+                # their dirs) and remove the dirs of the finished ones.
+                for job, pdir in iter(events.get, None):
+                    if pdir is None:
+                        self.store.remove_retrieval_dir(job.run_dir)
+                raise
+            future.result()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    async def _run(self, jobs, events):
+        try:
+            total = asyncio.Semaphore(self.jobs)
+            per_exec = {}
+            tasks = []
+            # Semaphores wake their waiters in order, so jobs start by depth.
+            for job in sorted(jobs, key=lambda j: j.depth):
+                limit = per_exec.get(job.exec_path)
+                if limit is None:
+                    limit = asyncio.Semaphore(self.jobs_per_exec)
+                    per_exec[job.exec_path] = limit
+                tasks.append(
+                    asyncio.ensure_future(
+                        self._run_job(job, total, limit, events)))
+            try:
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                # gather cancelled the jobs: wait until they cleaned up.
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            events.put(None)
+
+    async def _run_job(self, job, total, limit, events):
+        """Run a job, putting its streamed pkgs and then the job itself in
+        ``events`` (unless it is None)."""
+        async with limit, total:
+            job.run_dir = self.store.get_retrieval_dir()
+            print("retreiving pkgs {} into {}".format(job.reqs, job.run_dir))
+            proc = await asyncio.create_subprocess_exec(
+                job.exec_path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=job.run_dir,
+            )
+            read_stderr = asyncio.ensure_future(proc.stderr.read())
+            try:
+                proc.stdin.write(json.dumps(job.cmd()).encode())
+                await proc.stdin.drain()
+                proc.stdin.close()
+                async for line in proc.stdout:
+                    pdir = parse_record(line)
+                    if events is not None and pdir is not None:
+                        events.put((job, pdir))
+                await proc.wait()
+                stderr = await read_stderr
+            except BaseException:
+                read_stderr.cancel()
+                try:
+                    if proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                finally:
+                    self.store.remove_retrieval_dir(job.run_dir)
+                raise
+            if proc.returncode != 0:
+                self.store.remove_retrieval_dir(job.run_dir)
+                raise RuntimeError("Failed: " + stderr.decode())
+
+        # The rest is ingested outside of the limits so the next job can
+        # start.
+        if events is not None:
+            events.put((job, None))
+
+
+def parse_record(line):
+    """Return the dir of a ``retrievedPkg`` record, or None if the line is
+    not one."""
+    try:
+        record = json.loads(line.decode())
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or record.get(F_TYPE) != T_RETRIEVED_PKG:
+        return None
+    pdir = record['dir']
+    if path.basename(pdir) != pdir or pdir in ('', '.', '..'):
+        raise ValueError("invalid retrieved dir: {}".format(pdir))
+    return pdir
+
+
+class Prefetcher(object):
+    """Speculatively retrieve the content of pkgVers which will probably be
+    locked, while the build cycles are still resolving.
+
+    The jobs run on an event loop in a background thread and are not
+    ingested: ``take`` returns the finished jobs of the pkgVers which turned
+    out to be needed. A job can retrieve several pkgVers, so only the needed
+    ones must be ingested from it. The jobs of wrong guesses are cancelled
+    and their retrieval dirs removed by ``discard`` and ``close``.
+
+    budget: the maximum number of pkgVers prefetched in a build.
+    """
+    def __init__(self,
+                 store,
+                 budget=DEFAULT_PREFETCH_BUDGET,
+                 jobs=DEFAULT_JOBS,
+                 jobs_per_exec=DEFAULT_JOBS_PER_EXEC):
+        self.store = store
+        self.budget = budget
+        self.scheduler = Scheduler(store, jobs, jobs_per_exec)
+        self.submitted = set()
+        # [(job, task)] which were not taken or discarded.
+        self.pending = []
+        self.loop = None
+        self.thread = None
+        self.total = None
+        self.per_exec = {}
+
+    def submit(self, pkg_vers, get_exec_path):
+        """Prefetch the pkg_vers, most likely first, within the budget.
+
+        get_exec_path: returns the path of the retriever exec of a pkg_ver.
+        """
+        pkg_vers = [
+            v for v in OrderedDict.fromkeys(pkg_vers)
+            if v not in self.submitted
+        ][:self.budget - len(self.submitted)]
+        if not pkg_vers:
+            return
+        self.submitted.update(pkg_vers)
+
+        jobs = make_content_jobs(pkg_vers, get_exec_path,
+                                 self.scheduler.jobs_per_exec)
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever,
+                                           daemon=True)
+            self.thread.start()
+        self._call(self._submit(jobs))
+
+    def take(self, pkg_vers):
+        """Wait for the jobs prefetching any of the pkg_vers, returning the
+        ones which succeeded."""
+        pkg_vers = set(pkg_vers)
+        taken = [(j, t) for j, t in self.pending if pkg_vers & set(j.reqs)]
+        if not taken:
+            return []
+        self.pending = [p for p in self.pending if p not in taken]
+        results = self._call(self._wait([t for _, t in taken]))
+        # Failed jobs removed their dir, their pkgVers are retrieved again.
+        return [
+            job for (job, _), result in zip(taken, results)
+            if not isinstance(result, BaseException)
+        ]
+
+    def discard(self, is_wrong):
+        """Cancel the jobs of which every pkgVer ``is_wrong``."""
+        wrong = [(j, t) for j, t in self.pending if all(map(is_wrong, j.reqs))]
+        if not wrong:
+            return
+        self.pending = [p for p in self.pending if p not in wrong]
+        tasks = [t for _, t in wrong]
+        self._call(self._cancel(tasks))
+        for job, _ in wrong:
+            if job.run_dir is not None:
+                self.store.remove_retrieval_dir(job.run_dir)
+
+    def close(self):
+        """Discard every pending job and stop the background thread."""
+        if self.loop is None:
+            return
+        self.discard(lambda pkg_ver: True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _submit(self, jobs):
+        if self.total is None:
+            self.total = asyncio.Semaphore(self.scheduler.jobs)
+        for job in jobs:
+            limit = self.per_exec.get(job.exec_path)
+            if limit is None:
+                limit = asyncio.Semaphore(self.scheduler.jobs_per_exec)
+                self.per_exec[job.exec_path] = limit
+            task = asyncio.ensure_future(
+                self.scheduler._run_job(job, self.total, limit, None))
+            self.pending.append((job, task))
+
+    async def _wait(self, tasks):
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _cancel(self, tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -15,15 +15,24 @@
 # for inclusion in the work by you, as defined in the Apache-2.0 license, shall
 # be dual licensed as above, without any additional terms or conditions.
 
-from wake.utils import *
+from .utils import *
 import jshlib
+import tempfile
+import time
+
+DIR_QUARANTINE = ".quarantine"
+
+# Width of the digest prefix used to shard pkgs in the store.
+SHARD_WIDTH = 2
 
 
 class Store(object):
     """
     (#SPC-arch.store): The default pkg and module storage boject.
 
-    Stores objects on the local filesystem.
+    Stores objects on the local filesystem. The global store is sharded by a
+    prefix of each pkg's digest (``pkgs/ab/<pkgVer>``) so that no directory
+    becomes huge. Stores created before this are sharded by ``init_store``.
     """
     def __init__(self, base, store_dir):
         self.store_dir = store_dir
@@ -36,6 +45,7 @@ class Store(object):
         os.makedirs(self.pkgs_local, exist_ok=True)
         os.makedirs(self.defined, exist_ok=True)
         os.makedirs(self.pkgs, exist_ok=True)
+        self.migrate_store()
 
     def remove_store(self):
         rmtree(self.pkgs_local)
@@ -45,26 +55,44 @@ class Store(object):
             rmtree(self.retrievals)
 
     def get_retrieval_dir(self):
-        rdir = self.retrievals
-        if os.path.exists(rdir):
-            rmtree(rdir)
+        """Create a new retrieval directory, so that retrievals can run
+        concurrently."""
+        os.makedirs(self.retrievals, exist_ok=True)
+        rdir = tempfile.mkdtemp(dir=self.retrievals)
         copy_fsentry(
             wakeConstantsPath,
             path.join(rdir, DIR_WAKE, FILE_CONSTANTS),
         )
-        return self.retrievals
+        return rdir
 
-    def add_pkg(self, pkg_config, simple_pkg, local=False):
+    def remove_retrieval_dir(self, rdir):
+        if os.path.exists(rdir):
+            rmtree(rdir)
+
+    def add_pkg(self, pkg_config, simple_pkg, local=False,
+                definition_only=False):
+        """Add a pkg to the store.
+
+        definition_only: only store the files needed to define the pkg, in
+            ``pkgsDefined``. Its content is added later.
+        """
         if local:
             pcache = pjoin(self.pkgs_local, simple_pkg.pkg_ver)
+        elif definition_only:
+            pcache = shard_path(self.defined, simple_pkg.pkg_ver)
         else:
-            pcache = pjoin(self.pkgs, simple_pkg.pkg_ver)
+            pcache = shard_path(self.pkgs, simple_pkg.pkg_ver)
 
         if load_pkg_meta(pcache):
             return
 
-        os.mkdir(pcache)
-        for fsentry_rel in simple_pkg.get_fsentries():
+        if definition_only:
+            fsentries = simple_pkg.get_def_fsentries()
+        else:
+            fsentries = simple_pkg.get_fsentries()
+
+        os.makedirs(pcache)
+        for fsentry_rel in fsentries:
             copy_fsentry(pkg_config.path_abs(fsentry_rel),
                          pjoin(pcache, fsentry_rel))
 
@@ -72,18 +100,34 @@ class Store(object):
         meta = StoreMeta(state=S_DECLARED)
         jsondumpf(pkg_meta_path(pcache), meta.to_dict())
 
+    def migrate_store(self):
+        """Move pkgs from the flat layout into their shards.
+
+        Only lists the top of the store, so is cheap once it is sharded.
+        """
+        for base in (self.pkgs, self.defined):
+            for entry in os.listdir(base):
+                if WAKE_SEP not in entry:
+                    continue
+                dst = shard_path(base, entry)
+                os.makedirs(path.dirname(dst), exist_ok=True)
+                if path.exists(dst):
+                    rmtree(pjoin(base, entry))
+                else:
+                    os.rename(pjoin(base, entry), dst)
+
     def get_pkg_path(self, pkg_ver, def_okay=False):
         pkg_str = str(pkg_ver)
         pkgPath = pjoin(self.pkgs_local, pkg_str)
         if load_pkg_meta(pkgPath):
             return pkgPath
 
-        pkgPath = pjoin(self.pkgs, pkg_str)
+        pkgPath = shard_path(self.pkgs, pkg_str)
         if load_pkg_meta(pkgPath):
             return pkgPath
 
         if def_okay:
-            pkgPath = pjoin(self.defined, pkg_str)
+            pkgPath = shard_path(self.defined, pkg_str)
             if load_pkg_meta(pkgPath):
                 return pkgPath
 
@@ -112,11 +156,31 @@ def load_pkg_meta(pcache_path):
         dct = jsonloadf(pkg_meta_path(pcache_path))
         return StoreMeta.from_dict(dct)
     except (json.decoder.JSONDecodeError, KeyError):
-        # There was something at the path, but it was a partial pkg. It must be
-        # removed.
-        shutil.rmtree(pcache_path)
+        # There was something at the path, but it was a partial or corrupt
+        # pkg. Move it aside so it can be inspected.
+        quarantine_pkg(pcache_path)
         return None
 
 
+def quarantine_pkg(pcache_path):
+    """Move a pkg out of the store into the ``.quarantine`` dir next to it."""
+    parent, name = path.split(pcache_path)
+    qdir = pjoin(parent, DIR_QUARANTINE)
+    os.makedirs(qdir, exist_ok=True)
+    qpath = pjoin(qdir, "{}.{}".format(name, int(time.time())))
+    os.rename(pcache_path, qpath)
+    return qpath
+
+
+def shard_path(base, pkg_ver):
+    """The path of a pkg_ver in a sharded directory.
+
+    Lookups join the path directly; the directories are never listed.
+    """
+    pkg_ver = str(pkg_ver)
+    digest = pkg_ver.split(WAKE_SEP)[-1].split('.')[-1]
+    return path.join(base, digest[:SHARD_WIDTH], pkg_ver)
+
+
 def pkg_meta_path(pcache_path):
     return path.join(pcache_path, DIR_WAKE, FILE_STORE_META)
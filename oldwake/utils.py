@@ -133,6 +133,7 @@ T_OBJECT = wakeConstants["T_OBJECT"]
 T_PKG = wakeConstants["T_PKG"]
 T_MODULE = wakeConstants["T_MODULE"]
 T_PATH_REF_PKG = wakeConstants["T_PATH_REF_PKG"]
+T_RETRIEVED_PKG = wakeConstants["T_RETRIEVED_PKG"]
 
 S_UNRESOLVED = wakeConstants["S_UNRESOLVED"]
 S_DECLARED = wakeConstants["S_DECLARED"]
@@ -0,0 +1,70 @@
+import unittest
+import os
+import threading
+
+import wakeold2
+from wakeold2.bloom import BloomFilter, FilterFile
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_add_remove(self):
+        bfilter = BloomFilter.for_capacity(100)
+        keys = ["fake🌊lib{}🌊1.0.0🌊md5.abc".format(i) for i in range(100)]
+        for key in keys:
+            bfilter.add(key)
+        assert all(k in bfilter for k in keys)
+
+        bfilter.remove(keys[0])
+        assert keys[0] not in bfilter
+        assert all(k in bfilter for k in keys[1:])
+
+    def test_serialize(self):
+        bfilter = BloomFilter.for_capacity(10)
+        bfilter.add("libA")
+        result = BloomFilter.deserialize(bfilter.serialize())
+        assert "libA" in result
+        assert "libB" not in result
+        assert result.count == 1
+
+    def test_filter_file(self):
+        state = wakeold2.state.State()
+        try:
+            path = os.path.join(state.dir, "filter.bin")
+            writer = FilterFile(path, rebuild_keys=lambda: ["libA"])
+            reader = FilterFile(path)
+            assert reader.refresh() is None, "read-only and unpublished"
+
+            assert "libA" in writer.refresh()
+            writer.add("libB")
+            assert "libB" in reader.refresh()
+        finally:
+            state.cleanup()
+
+    def test_concurrent_writers(self):
+        state = wakeold2.state.State()
+        try:
+            path = os.path.join(state.dir, "filter.bin")
+
+            def write(name):
+                # Every writer has its own FilterFile, as separate processes
+                # would.
+                writer = FilterFile(path, rebuild_keys=lambda: [])
+                for i in range(50):
+                    writer.add("{}{}".format(name, i))
+
+            threads = [
+                threading.Thread(target=write, args=(name, ))
+                for name in ("libA", "libB", "libC")
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            bfilter = FilterFile(path).refresh()
+            assert bfilter.count == 150
+            for name in ("libA", "libB", "libC"):
+                assert all("{}{}".format(name, i) in bfilter
+                           for i in range(50)), "no update was lost"
+        finally:
+            state.cleanup()
@@ -0,0 +1,377 @@
+import json
+import unittest
+import os
+import threading
+
+import wakeold2
+from wakeold2.constants import DEFAULT_FILE_DIGEST, FILE_PKG_DEFAULT
+from wakeold2.digest import Digest
+from wakeold2.exports import (ExportCache, as_dep, fingerprint,
+                              mask_digests, resolved_deps, unmask_digests)
+from wakeold2.pkg import PkgDeclared, PkgExport, PkgReq, PkgRequest, PkgVer
+from wakeold2.store import Store
+
+PKG_TEMPLATE = """
+function(wake)
+    local digest = import "./.wakeDigest.json";
+
+    wake.pkg(
+        pkgVer=wake.pkgVer("fake", "{name}", "{version}", digest),
+        paths=["./README.txt"],
+        depsReq=wake.depsReq(unrestricted={{
+            {deps}
+        }}),
+        export={export},
+    )
+"""
+
+
+def fake_pkg(name, depsReq=None):
+    return PkgDeclared(
+        pkg_file=os.path.join("/fake", name, FILE_PKG_DEFAULT),
+        pkgVer=PkgVer("fake", name, "1.0.0", Digest("abcd" + name, "md5")),
+        pkgOrigin=None,
+        paths=set(),
+        depsReq=depsReq or {},
+    )
+
+
+def create_pkg(state, name, version="1.0.0", deps=(), export="null",
+               readme=None):
+    """Create a package on disk, returning its PkgDeclared.
+
+    deps: the names of the `fake` pkgs it requires.
+    export: the jsonnet of its export function.
+    """
+    pkg_dir = os.path.join(
+        state.create_temp_dir(prefix="pkg-").dir, name)
+    os.mkdir(pkg_dir)
+    wakeold2.utils.dumpf(os.path.join(pkg_dir, "README.txt"),
+                         name if readme is None else readme)
+    wakeold2.utils.dumpf(
+        os.path.join(pkg_dir, FILE_PKG_DEFAULT),
+        PKG_TEMPLATE.format(
+            name=name,
+            version=version,
+            deps=", ".join('"{0}": wake.pkgReq("fake", "{0}", ">=1.0.0")'.
+                           format(d) for d in deps),
+            export=export,
+        ))
+    pkgDeclared = wakeold2.load.loadPkgDeclared(
+        state, os.path.join(pkg_dir, FILE_PKG_DEFAULT), calc_digest=True)
+    # Keep the digest, as in the store.
+    wakeold2.utils.jsondumpf(os.path.join(pkg_dir, DEFAULT_FILE_DIGEST),
+                             pkgDeclared.pkgVer.digest.serialize())
+    return pkgDeclared
+
+
+def fake_req(name):
+    return PkgReq("fake", name, ">=1.0.0").serialize()
+
+
+def fake_request(pkgDeclared, name):
+    return PkgRequest(pkgDeclared.pkgVer,
+                      PkgReq.deserialize(fake_req(name))).serialize()
+
+
+class TestExportCache(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.dir = self.state.create_temp_dir().dir
+
+        # root -> libA -> libC, root -> libB -> libC
+        self.libC = fake_pkg("libC")
+        self.libA = fake_pkg("libA", {
+            "unrestricted": {
+                "c": fake_req("libC")
+            }
+        })
+        self.libB = fake_pkg("libB", {
+            "unrestricted": {
+                "c": fake_req("libC")
+            }
+        })
+        self.root = fake_pkg(
+            "root", {
+                "unrestricted": {
+                    "a": fake_req("libA"),
+                    "b": fake_req("libB"),
+                }
+            })
+        self.pkgsDefined = {
+            fake_request(self.root, "libA"): self.libA,
+            fake_request(self.root, "libB"): self.libB,
+            fake_request(self.libA, "libC"): self.libC,
+            fake_request(self.libB, "libC"): self.libC,
+        }
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def fake_export(self, pkgDeclared):
+        return PkgExport(
+            pkg_file=pkgDeclared.pkg_file,
+            pkgVer=pkgDeclared.pkgVer,
+            pkgOrigin=None,
+            paths=set(pkgDeclared.paths),
+            depsReq=pkgDeclared.depsReq,
+            deps={},
+            export={"name": pkgDeclared.pkgVer.name},
+        )
+
+    def test_resolved_deps(self):
+        assert resolved_deps(self.libC, self.pkgsDefined) == {}
+        assert resolved_deps(self.root, self.pkgsDefined) == self.pkgsDefined
+        assert sorted(resolved_deps(self.libA, self.pkgsDefined)) == [
+            fake_request(self.libA, "libC")
+        ]
+
+    def test_get_or_load(self):
+        cache = ExportCache(self.dir)
+        key = ExportCache.key(self.libA.pkgVer,
+                              {fake_request(self.libA, "libC"): "abcd"})
+        calls = []
+
+        def load():
+            calls.append(1)
+            return self.fake_export(self.libA)
+
+        threads = [
+            threading.Thread(target=cache.get_or_load,
+                             args=(key, self.libA.pkg_file, load))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert calls == [1]
+
+        # persisted for other builds
+        result = ExportCache(self.dir).get(key, self.libA.pkg_file)
+        assert result.serialize() == self.fake_export(self.libA).serialize()
+
+    def test_mask_digests(self):
+        libC = as_dep(self.fake_export(self.libC))
+        libC2 = as_dep(self.fake_export(fake_pkg("libC2")))
+        libC2["export"] = libC["export"]
+        libC_digest = as_dep(self.fake_export(self.libC))
+        libC_digest["pkgVer"] = PkgVer("fake", "libC", "1.0.0",
+                                       Digest("other", "md5")).serialize()
+        libC_digest["export"] = {"ref": libC_digest["pkgVer"]}
+        libC["export"] = {"ref": libC["pkgVer"]}
+
+        masked, digests = mask_digests({"c": libC})
+        assert digests == [self.libC.pkgVer.digest.serialize()]
+        assert self.libC.pkgVer.digest.digest not in json.dumps(masked)
+        assert fingerprint(masked["c"]) == fingerprint(
+            mask_digests({"c": libC_digest})[0]["c"]), "digest is masked"
+        assert fingerprint(masked["c"]) != fingerprint(
+            mask_digests({"c": libC2})[0]["c"]), "name is visible"
+
+        # Equal digests are equal placeholders, others are not.
+        masked, digests = mask_digests({"a": libC, "b": libC_digest})
+        assert len(digests) == 2
+        masked, digests = mask_digests({"a": libC, "b": libC})
+        assert len(digests) == 1
+        assert masked["a"] == masked["b"]
+
+        root = self.fake_export(self.root)
+        root.export = masked["a"]["export"]
+        root.deps = {"unrestricted": masked}
+        root = unmask_digests(root, digests)
+        assert root.export == {"ref": self.libC.pkgVer.serialize()}
+        assert root.deps["unrestricted"]["a"] == libC
+
+
+class TestLoadExport(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_export_tree(self):
+        # root -> libA -> libC, root -> libB -> libC
+        libC = create_pkg(self.state,
+                          "libC",
+                          export="function(wake, pkg) {value: 3}")
+        libA, libB = [
+            create_pkg(self.state,
+                       name,
+                       deps=["libC"],
+                       export="""function(wake, pkg) {
+                           value: pkg.deps.unrestricted.libC.export.value + 1,
+                       }""") for name in ("libA", "libB")
+        ]
+        root = create_pkg(self.state,
+                          "root",
+                          deps=["libA", "libB"],
+                          export="""function(wake, pkg) {
+                              local deps = pkg.deps.unrestricted,
+                              value: deps.libA.export.value
+                                  + deps.libB.export.value,
+                              sameC: deps.libA.deps.unrestricted.libC
+                                  == deps.libB.deps.unrestricted.libC,
+                          }""")
+        pkgsDefined = {
+            fake_request(root, "libA"): libA,
+            fake_request(root, "libB"): libB,
+            fake_request(libA, "libC"): libC,
+            fake_request(libB, "libC"): libC,
+        }
+
+        result = wakeold2.load.loadPkgExport(self.state, pkgsDefined, root)
+        assert result.pkgVer == root.pkgVer
+        assert result.export == {"value": 8, "sameC": True}
+        libA_dep = result.deps["unrestricted"]["libA"]
+        assert libA_dep["pkgVer"] == libA.pkgVer.serialize()
+        assert libA_dep["export"] == {"value": 4}
+        assert libA_dep["deps"]["unrestricted"]["libC"]["export"] == {
+            "value": 3
+        }
+
+        # Exporting a dep on its own only needs its closure.
+        result = wakeold2.load.loadPkgExport(self.state, pkgsDefined, libA)
+        assert result.export == {"value": 4}
+
+    def test_pruned(self):
+        libA = create_pkg(self.state,
+                          "libA",
+                          export="function(wake, pkg) {value: 1}")
+        root = create_pkg(self.state, "root", deps=["libA"])
+        broken = create_pkg(self.state, "broken")
+        wakeold2.utils.dumpf(broken.pkg_file, "{")
+        pkgsDefined = {
+            fake_request(root, "libA"): libA,
+            # i.e. another package of the workspace
+            fake_request(libA, "broken"): broken,
+        }
+
+        # The broken package is not in root's closure, so not evaluated.
+        result = wakeold2.load.loadPkgExport(self.state, pkgsDefined, libA)
+        assert result.export == {"value": 1}
+        result = wakeold2.load.loadPkgExport(self.state, pkgsDefined, root)
+        assert result.deps["unrestricted"]["libA"]["export"] == {"value": 1}
+
+    def test_missing_request(self):
+        root = create_pkg(self.state, "root", deps=["libA"])
+        with self.assertRaises(KeyError):
+            wakeold2.load.loadPkgExport(self.state, {}, root)
+
+
+class TestReadExport(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.store = Store(self.state)
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def create_pkg(self, name, **kwargs):
+        return self.store.create_pkg(create_pkg(self.state, name, **kwargs))
+
+    def cached(self, pkgDeclared):
+        """The cached exports of the package."""
+        return [
+            c for c in self.store.exports.memory.values()
+            if c["pkgVer"] == pkgDeclared.pkgVer.serialize()
+        ]
+
+    def test_dep_digest_changed(self):
+        export = "function(wake, pkg) {answer: 42}"
+        libA1 = self.create_pkg("libA", export=export, readme="one")
+        libA2 = self.create_pkg("libA", export=export, readme="two")
+        assert libA1.pkgVer != libA2.pkgVer
+        root = self.create_pkg(
+            "root",
+            deps=["libA"],
+            export="""function(wake, pkg) {
+                libA: pkg.deps.unrestricted.libA.pkgVer,
+            }""",
+        )
+        key = fake_request(root, "libA")
+
+        result = self.store.read_export(root, {key: libA1})
+        assert result.export == {"libA": libA1.pkgVer.serialize()}
+
+        result = self.store.read_export(root, {key: libA2})
+        assert len(self.cached(root)) == 1, "a digest-only change is a hit"
+        assert result.export == {"libA": libA2.pkgVer.serialize()}
+        assert result.deps["unrestricted"]["libA"]["pkgVer"] == (
+            libA2.pkgVer.serialize())
+
+    def test_dep_export_changed(self):
+        libA1 = self.create_pkg("libA",
+                                export="function(wake, pkg) {value: 1}")
+        libA2 = self.create_pkg("libA",
+                                export="function(wake, pkg) {value: 2}")
+        root = self.create_pkg(
+            "root",
+            deps=["libA"],
+            export="""function(wake, pkg) {
+                value: pkg.deps.unrestricted.libA.export.value,
+            }""",
+        )
+        key = fake_request(root, "libA")
+
+        assert self.store.read_export(root, {key: libA1}).export == {
+            "value": 1
+        }
+        assert self.store.read_export(root, {key: libA2}).export == {
+            "value": 2
+        }
+        assert len(self.cached(root)) == 2
+
+    def test_matches_export_tree(self):
+        # root -> libA -> libC
+        libC = self.create_pkg("libC",
+                               export="function(wake, pkg) {value: 3}")
+        libA = self.create_pkg(
+            "libA",
+            deps=["libC"],
+            export="""function(wake, pkg) {
+                value: pkg.deps.unrestricted.libC.export.value + 1,
+            }""")
+        root = self.create_pkg(
+            "root",
+            deps=["libA"],
+            export="""function(wake, pkg) {
+                libA: pkg.deps.unrestricted.libA,
+                paths: pkg.paths,
+            }""")
+        pkgsDefined = {
+            fake_request(root, "libA"): libA,
+            fake_request(libA, "libC"): libC,
+        }
+
+        expected = wakeold2.load.loadPkgExport(self.state, pkgsDefined, root)
+        assert expected.export["paths"] == ["./PKG.libsonnet", "./README.txt"]
+        result = self.store.read_export(root, pkgsDefined)
+        assert result.serialize() == expected.serialize()
+        assert json.dumps(result.serialize()) == json.dumps(
+            expected.serialize())
+
+        # The injected dep is exactly the dep of the exportTree path.
+        libA_export = self.store.read_export(libA, pkgsDefined)
+        assert json.dumps(as_dep(libA_export)) == json.dumps(
+            expected.deps["unrestricted"]["libA"])
+
+    def test_export_deps(self):
+        libA = self.create_pkg("libA",
+                               export="function(wake, pkg) {value: 1}")
+        root = self.create_pkg(
+            "root",
+            deps=["libA"],
+            export="""function(wake, pkg) {
+                value: pkg.deps.unrestricted.libA.export.value + 1,
+            }""")
+        libA_export = wakeold2.load.loadPkgExport(self.state, {}, libA)
+        # Only the injected export of libA is used: its PKG is not evaluated.
+        wakeold2.utils.dumpf(libA.pkg_file, "{")
+
+        result = wakeold2.load.loadPkgExportDeps(
+            self.state, root,
+            {fake_request(root, "libA"): as_dep(libA_export)})
+        assert result.export == {"value": 2}
+        assert result.deps["unrestricted"]["libA"] == as_dep(libA_export)
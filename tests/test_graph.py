@@ -0,0 +1,93 @@
+import unittest
+
+from wakeold2.digest import Digest
+from wakeold2.graph import CycleError, DepGraph, GraphBuilder
+from wakeold2.pkg import PkgReq, PkgVer
+from wakeold2.resolve import Resolver
+
+
+def pkg_ver(name, version="1.0.0"):
+    return PkgVer("fake", name, version, Digest("abcd" + name, "md5"))
+
+
+def req(name, semver="*"):
+    return PkgReq("fake", name, semver).serialize()
+
+
+class TestGraph(unittest.TestCase):
+    def setUp(self):
+        # libA -> libB -> libD
+        #      -> libC -> libD (restricted)
+        builder = GraphBuilder()
+        self.libA, self.libB, self.libC, self.libD = [
+            pkg_ver(n) for n in ("libA", "libB", "libC", "libD")
+        ]
+        builder.add_edge(self.libA, self.libB, "unrestricted")
+        builder.add_edge(self.libA, self.libC, "unrestricted")
+        builder.add_edge(self.libB, self.libD, "unrestricted")
+        builder.add_edge(self.libC, self.libD, "restricted")
+        self.builder = builder
+        self.graph = builder.build()
+        self.ids = [self.graph.ids[v] for v in (self.libA, self.libB,
+                                                self.libC, self.libD)]
+
+    def test_queries(self):
+        graph = self.graph
+        a, b, c, d = self.ids
+        assert len(graph) == 4 and graph.num_edges == 4
+        assert sorted(graph.deps(a)) == [b, c]
+        assert graph.deps(c, levels=["unrestricted"]) == []
+        assert sorted(graph.dependents(d)) == [b, c]
+        assert sorted(graph.reachable([b])) == [b, d]
+        assert sorted(graph.reachable([a], levels=["unrestricted"])) == [
+            a, b, c, d
+        ]
+        assert sorted(graph.reachable([c], levels=["unrestricted"])) == [c]
+        assert sorted(graph.dependents_of([d])) == [a, b, c, d]
+
+        order = graph.topological_order()
+        assert order.index(d) < order.index(b) < order.index(a)
+        assert order.index(c) < order.index(a)
+        assert graph.find_cycle() is None
+
+    def test_cycle(self):
+        self.builder.add_edge(self.libD, self.libA, "unrestricted")
+        graph = self.builder.build()
+        cycle = graph.find_cycle()
+        assert cycle[0] == cycle[-1] and len(cycle) == 4
+        with self.assertRaises(CycleError) as ctx:
+            graph.topological_order()
+        assert ctx.exception.cycle[0] == ctx.exception.cycle[-1]
+
+    def test_from_resolution(self):
+        resolver = Resolver()
+        resolver.add_pkg(self.libA, {"unrestricted": {"libB": req("libB")}})
+        resolver.add_pkg(self.libB, {"restricted": {"libD": req("libD")}})
+        resolver.add_pkg(self.libD, {})
+        chosen = resolver.resolve([self.libA])
+        graph = DepGraph.from_resolution(resolver, [self.libA], chosen)
+        assert [graph.nodes[n] for n in graph.topological_order()] == [
+            self.libD, self.libB, self.libA
+        ]
+
+        nx_graph = graph.to_networkx()
+        assert nx_graph.number_of_edges() == 2
+        assert [lvl for _, _, lvl in nx_graph.edges(data="lvl")
+                if lvl == "restricted"] == ["restricted"]
+
+    def test_global(self):
+        resolver = Resolver()
+        resolver.add_pkg(self.libA, {
+            "unrestricted": {"libB": req("libB")},
+            "global": {"libD": req("libD")},
+        })
+        resolver.add_pkg(self.libB, {"global": {"libD": req("libD")}})
+        resolver.add_pkg(self.libD, {})
+        chosen = resolver.resolve([self.libA])
+        graph = DepGraph.from_resolution(resolver, [self.libA], chosen)
+        a, b, d = [graph.ids[v] for v in (self.libA, self.libB, self.libD)]
+        assert sorted(graph.deps(a, levels=["global"])) == [d]
+        assert graph.deps(a, levels=["unrestricted"]) == [b]
+        assert sorted(graph.dependents(d)) == sorted([a, b])
+        assert [lvl for _, _, lvl in graph.to_networkx().edges(data="lvl")
+                ].count("global") == 2
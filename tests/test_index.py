@@ -0,0 +1,90 @@
+import os
+import unittest
+
+import wakeold2
+from wakeold2.digest import Digest
+from wakeold2.index import HttpIndex, RegistryIndex, load_requested, serve
+from wakeold2.pkg import PkgName, PkgReq, PkgVer
+from wakeold2.resolve import Resolver
+from wakeold2.semver import parse_req
+
+VERSIONS = ("0.9.0", "1.0.0-beta", "1.0.0", "1.1.0", "1.9.0", "2.0.0")
+
+
+def pkg_ver(name, version):
+    return PkgVer("fake", name, version, Digest("abcd" + name, "md5"))
+
+
+def req(name, semver):
+    return PkgReq("fake", name, semver).serialize()
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.dir = self.state.create_temp_dir(prefix="index-").dir
+        self.index = RegistryIndex(self.dir)
+        for version in reversed(VERSIONS):
+            self.index.add(pkg_ver("libE", version), {})
+        self.index.add(pkg_ver("libB", "1.2.0"),
+                       {"unrestricted": {"libE": req("libE", "^1")}})
+        for i in range(100):
+            self.index.add(pkg_ver("unused{}".format(i), "1.0.0"), {})
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_layout(self):
+        assert os.path.exists(os.path.join(self.dir, "fake", "li", "bE",
+                                           "libE"))
+        assert self.index.path(PkgName("fake", "ab")) == os.path.join(
+            self.dir, "fake", "2", "ab")
+        assert self.index.path(PkgName("fake", "abc")) == os.path.join(
+            self.dir, "fake", "3", "a", "abc")
+
+    def test_matching(self):
+        index_file = self.index.get(PkgName("fake", "libE"))
+        assert [v.version for v, _ in index_file.records()] == list(VERSIONS)
+
+        def matching(semver):
+            return [v.version
+                    for v, _ in index_file.matching(parse_req(semver))]
+
+        assert matching("^1") == ["1.9.0", "1.1.0", "1.0.0"]
+        assert matching(">1.0.0, <=1.9.0") == ["1.9.0", "1.1.0"]
+        assert matching("<0.9.1 || >=2") == ["2.0.0", "0.9.0"]
+        assert matching("^3") == []
+        assert self.index.get(PkgName("fake", "missing")).records() == []
+
+    def test_load_requested(self):
+        libA = pkg_ver("libA", "1.0.0")
+        resolver = Resolver()
+        resolver.add_pkg(libA, {
+            "unrestricted": {
+                "libB": req("libB", "*"),
+                "libE": req("libE", ">=1.1"),
+            }
+        })
+        touched = load_requested(self.index, resolver, [libA])
+        assert touched == {PkgName("fake", "libB"), PkgName("fake", "libE")}
+        assert set(self.index.files) == touched
+        resolved = resolver.resolve([libA])
+        assert sorted(v.version for v in resolved.values()) == [
+            "1.2.0", "1.9.0", "2.0.0"
+        ]
+
+    def test_http(self):
+        server = serve(self.dir)
+        try:
+            index = HttpIndex(
+                "http://127.0.0.1:{}".format(server.server_port),
+                self.state.create_temp_dir(prefix="cache-").dir)
+            libE = index.get(PkgName("fake", "libE"))
+            assert [v.version
+                    for v, _ in libE.matching(parse_req("^1"))] == [
+                        "1.9.0", "1.1.0", "1.0.0"
+                    ]
+            assert index.get(PkgName("fake", "missing")).records() == []
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,127 @@
+import unittest
+import os
+import shutil
+
+import wakeold2
+from wakeold2.constants import FILE_PKG_DEFAULT
+from wakeold2.ingest import Ingest, Pipeline, Stage, discover_pkg_files
+from wakeold2.store import Store
+
+DIR_JSONLY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "jsonly")
+
+
+def _check(value):
+    if value == 3:
+        raise ValueError(value)
+    return value
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline(self):
+        pipeline = Pipeline([
+            Stage("double", lambda v: v * 2, workers=3, queue_size=2),
+            Stage("check", _check, workers=2, queue_size=2),
+            Stage("odd", lambda v: v if v % 4 else None, workers=1),
+        ])
+        outputs = pipeline.run(iter(range(20)))
+        assert sorted(outputs) == [v * 2 for v in range(20) if v % 2]
+
+        stats = {s["name"]: s for s in pipeline.stats()}
+        assert stats["double"]["processed"] == 20
+        assert stats["check"]["processed"] == 20
+        assert stats["check"]["failed"] == 0
+        assert stats["odd"]["queueDepth"] == 0
+
+    def test_errors(self):
+        pipeline = Pipeline([Stage("check", _check, workers=2)])
+        assert sorted(pipeline.run(range(5))) == [0, 1, 2, 4]
+        assert [(name, item) for name, item, _ in pipeline.errors] == [
+            ("check", 3)
+        ]
+
+    def test_batches(self):
+        batches = []
+
+        def check_all(values):
+            batches.append(len(values))
+            return [ValueError(v) if v == 3 else v for v in values]
+
+        pipeline = Pipeline([Stage("check", check_all, batch_size=4)])
+        assert sorted(pipeline.run(range(10))) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+        assert [(name, item) for name, item, _ in pipeline.errors] == [
+            ("check", 3)
+        ]
+        assert sum(batches) == 10
+        assert max(batches) <= 4
+
+    def test_discover(self):
+        state = wakeold2.state.State()
+        try:
+            root = state.create_temp_dir().dir
+            for d in ("a", "a/nested", "b/c", "b/.wake/d"):
+                os.makedirs(os.path.join(root, d))
+                wakeold2.utils.dumpf(os.path.join(root, d, "PKG.libsonnet"),
+                                     "{}")
+            found = [
+                os.path.relpath(p, root)
+                for p in discover_pkg_files(root)
+            ]
+            assert found == ["a/PKG.libsonnet", "b/c/PKG.libsonnet"]
+        finally:
+            state.cleanup()
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.store = Store(self.state)
+        self.root = self.state.create_temp_dir(prefix="ingest-").dir
+        self.names = ["dir_paths", "file_paths", "simple-fake_deps"]
+        for name in self.names:
+            shutil.copytree(
+                os.path.join(DIR_JSONLY, name),
+                os.path.join(self.root, name),
+                ignore=shutil.ignore_patterns("__pycache__", "expected*"))
+        os.mkdir(os.path.join(self.root, "broken"))
+        wakeold2.utils.dumpf(
+            os.path.join(self.root, "broken", FILE_PKG_DEFAULT), "{")
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_run(self):
+        ingest = Ingest(self.store, workers={"copy": 1})
+        result = ingest.run(self.root)
+
+        expected = [
+            wakeold2.load.loadPkgDeclared(
+                self.state,
+                os.path.join(self.root, name, FILE_PKG_DEFAULT),
+                calc_digest=True,
+            ).pkgVer for name in self.names
+        ]
+        assert sorted(p.pkgVer for p in result) == sorted(expected)
+        assert [(name, os.path.basename(os.path.dirname(item)))
+                for name, item, _ in ingest.errors] == [("evaluate",
+                                                         "broken")]
+        for pkgVer in expected:
+            stored = self.store.read_pkg(pkgVer, skip_cache=True)
+            assert stored.pkgVer == pkgVer
+            assert stored.pkg_dir.startswith(self.store.dir)
+
+        stats = {s["name"]: s for s in ingest.stats()}
+        assert stats["discover"]["processed"] == 4
+        assert stats["copy"]["processed"] == 3
+
+        # Packages which are already in the store are not created again
+        for cached in (True, False):
+            if not cached:
+                self.store.packages.clear()
+            again = Ingest(self.store)
+            result = again.run(self.root)
+            assert sorted(p.pkgVer for p in result) == sorted(expected)
+            assert len(again.errors) == 1
+            for pkgVer in expected:
+                assert self.store.read_pkg(pkgVer).pkg_dir.startswith(
+                    self.store.dir)
@@ -0,0 +1,631 @@
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import oldwake
+from oldwake import store
+from oldwake.pkg import (Exec, PathRefPkg, PkgConfig, PkgManifest, PkgName,
+                         PkgSimple, PkgUnresolved)
+from oldwake.retrieve import (Prefetcher, RetrieveJob, Scheduler,
+                              make_content_jobs, make_jobs, parse_record,
+                              request_depths)
+from oldwake.utils import dumpf, jsondumpf
+
+LIB_A = "fake@libA@1.0.0@md5.aaaa1111"
+LIB_B = "fake@libB@1.0.0@md5.bbbb2222"
+LIB_C = "fake@libC@1.0.0@md5.eeee5555"
+LIB_D = "fake@libD@1.0.0@md5.ffff6666"
+ROOT = "fake@root@1.0.0@md5.cccc3333"
+REQ_A = "fake@libA@>=1.0.0"
+REQ_B = "fake@libB@>=1.0.0"
+
+
+def simple_pkg(pkg_ver, paths_def=(), pkgs=None):
+    namespace, name, version, hash_ = pkg_ver.split("@")
+    return PkgSimple(
+        state="done",
+        pkg_ver=pkg_ver,
+        namespace=namespace,
+        name=name,
+        version=version,
+        description=None,
+        fingerprint={"hash": hash_, "hashType": "md5"},
+        pkgs=pkgs or {},
+        paths=[],
+        paths_def=list(paths_def),
+        export=None,
+    )
+
+
+def store_pkg(config, pkg_ver, definition_only=False):
+    """Put a (fake) pkg in the store of the config."""
+    base = config.store.defined if definition_only else config.store.pkgs
+    pcache = store.shard_path(base, pkg_ver)
+    os.makedirs(os.path.join(pcache, ".wake"))
+    dumpf(os.path.join(pcache, "PKG.libsonnet"), "{}")
+    jsondumpf(store.pkg_meta_path(pcache), {"state": "declared"})
+    return pcache
+
+
+# A retriever which "retrieves" a dir per requested pkg name, logging its
+# runs. It fails on the pkg named "fail".
+RETRIEVER = """#!{python}
+import json
+import os
+import sys
+import time
+
+cmd = json.load(sys.stdin)
+with open({log!r}, "a") as fd:
+    fd.write(json.dumps({{"start": time.time(), "cmd": cmd}}) + "\\n")
+for req in cmd["pkgVersions"]:
+    name = req.split("@")[1]
+    if name == "fail":
+        sys.exit("failed to retrieve " + req)
+    time.sleep({sleep})
+    os.makedirs(os.path.join(".wake", "retrieved", name))
+    print(json.dumps({{"__WAKETYPE__": "retrievedPkg", "dir": name}}))
+    sys.stdout.flush()
+with open({log!r}, "a") as fd:
+    fd.write(json.dumps({{"end": time.time(), "cmd": cmd}}) + "\\n")
+"""
+
+
+def write_retriever(exec_path, log, sleep=0):
+    dumpf(exec_path, RETRIEVER.format(python=sys.executable, log=log,
+                                      sleep=sleep))
+    os.chmod(exec_path, 0o755)
+    return exec_path
+
+
+def read_runs(log):
+    """Return the ``[(start, end, cmd)]`` of the logged retriever runs, in
+    the order they started."""
+    if not os.path.exists(log):
+        return []
+    starts, ends = [], {}
+    with open(log) as fd:
+        for line in fd:
+            entry = json.loads(line)
+            key = json.dumps(entry["cmd"], sort_keys=True)
+            if "start" in entry:
+                starts.append((entry["start"], key, entry["cmd"]))
+            else:
+                ends[key] = entry["end"]
+    return [(start, ends.get(key), cmd) for start, key, cmd in sorted(starts)]
+
+
+def max_concurrent(runs):
+    events = sorted([(r[0], 1) for r in runs] + [(r[1], -1) for r in runs])
+    current = most = 0
+    for _, change in events:
+        current += change
+        most = max(most, current)
+    return most
+
+
+def fake_req(name):
+    return "fake@{}@>=1.0.0".format(name)
+
+
+def store_retriever(config, pkg_ver, log):
+    """Store a pkg containing a retriever, returning its Exec."""
+    write_retriever(os.path.join(store_pkg(config, pkg_ver), "retrieve.py"),
+                    log)
+    return Exec(PathRefPkg(pkg_ver, "retrieve.py"), container=None,
+                config=None, args=[], env={})
+
+
+def content_ver(name):
+    return "fake@{}@1.0.0@md5.abcd".format(name)
+
+
+def unresolved_pkg(pkg_req, exec_=None):
+    return PkgUnresolved(pkg_req, from_=None, using_pkg=ROOT, full={},
+                         exec_=exec_)
+
+
+class ConfigTestCase(unittest.TestCase):
+    """Run a Config in a temporary pkg and user directory."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="oldwake-")
+        self.base = os.path.join(self.dir, "base")
+        self.user = os.path.join(self.dir, "user")
+        os.makedirs(os.path.join(self.base, ".wake"))
+        os.makedirs(self.user)
+        dumpf(os.path.join(self.base, "PKG.libsonnet"), "{}")
+        dumpf(os.path.join(self.user, "user.jsonnet"), "{}")
+
+        self.cwd = os.getcwd()
+        self.wakepath = os.environ.get("WAKEPATH")
+        os.chdir(self.base)
+        os.environ["WAKEPATH"] = self.user
+        self.config = self.new_config()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.wakepath is None:
+            del os.environ["WAKEPATH"]
+        else:
+            os.environ["WAKEPATH"] = self.wakepath
+        shutil.rmtree(self.dir)
+
+    def new_config(self, cls=oldwake.Config):
+        """A config for a new build of the same pkg."""
+        config = cls()
+        config.init()
+        return config
+
+    def finish_definitions(self, config, pkg, pkg_vers):
+        """Finish a job which retrieved the definitions of the pkg_vers for
+        the pkg."""
+        job = RetrieveJob("/fake/retriever", [str(pkg.pkg_req)], pkgs=[pkg])
+        job.run_dir = config.store.get_retrieval_dir()
+        for pkg_ver in pkg_vers:
+            job.retrieved.setdefault(PkgName.from_pkg_ver(pkg_ver),
+                                     []).append(pkg_ver)
+        config.finish_retrieval(job, {})
+
+
+class CycleConfig(oldwake.Config):
+    """A Config whose root pkg always manifests as ``manifest``, recording
+    the requests it retrieves."""
+    def __init__(self):
+        super().__init__()
+        self.manifest = None
+        self.retrieve_calls = []
+
+    def run_pkg(self, pkg_config, locked=None):
+        return self.manifest
+
+    def retrieve_pkgs(self, pkgs, locked, depths):
+        self.retrieve_calls.append([str(pkg.pkg_req) for pkg in pkgs])
+
+
+class IngestConfig(oldwake.Config):
+    """A Config which records the retrieved pkgs instead of storing them."""
+    def __init__(self):
+        super().__init__()
+        self.ingested = []
+
+    def ingest_retrieved(self, job, pdir, locked, wanted=None):
+        self.ingested.append((job.exec_path, pdir))
+
+
+class FingerprintConfig(oldwake.Config):
+    """A Config which fingerprints a retrieved dir as the pkg_ver of its
+    name in ``pkg_vers``, instead of running it."""
+    def __init__(self):
+        super().__init__()
+        self.pkg_vers = {}
+
+    def fingerprint_retrieved(self, pkg_path):
+        ret_config = PkgConfig(pkg_path)
+        os.makedirs(ret_config.wakedir, exist_ok=True)
+        dumpf(ret_config.pkg_root, "{}")
+        jsondumpf(ret_config.path_local_deps, {})
+        jsondumpf(ret_config.pkg_fingerprint, {})
+        return ret_config, simple_pkg(
+            self.pkg_vers[os.path.basename(pkg_path)])
+
+
+class TestConfig(ConfigTestCase):
+    def test_create_defined_pkgs(self):
+        store_pkg(self.config, LIB_A)
+        store_pkg(self.config, LIB_B, definition_only=True)
+        locked = {
+            PkgName("fake", "libB"): LIB_B,
+            PkgName("fake", "libA"): LIB_A,
+        }
+
+        self.config.create_defined_pkgs(locked)
+        with open(self.config.pkgs_defined) as fd:
+            text = fd.read()
+        assert text.index(LIB_A) < text.index(LIB_B), "stable order"
+        assert self.config.store.get_pkg_path(LIB_B, def_okay=True) in text
+
+        mtime = os.stat(self.config.pkgs_defined).st_mtime
+        time.sleep(0.01)
+        self.config.create_defined_pkgs(dict(reversed(list(locked.items()))))
+        assert os.stat(self.config.pkgs_defined).st_mtime == mtime
+
+
+class TestLock(ConfigTestCase):
+    def test_inputs_fingerprint(self):
+        root_config = PkgConfig(self.base)
+        dumpf(os.path.join(self.base, "defs.libsonnet"), "{}")
+        local_pkgs = [(root_config, simple_pkg(ROOT, ["./defs.libsonnet"]))]
+
+        fingerprint = self.config.inputs_fingerprint(local_pkgs)
+        assert self.config.inputs_fingerprint(local_pkgs) == fingerprint
+
+        dumpf(os.path.join(self.base, "defs.libsonnet"), "{a: 1}")
+        changed = self.config.inputs_fingerprint(local_pkgs)
+        assert changed != fingerprint, "paths_def are hashed"
+
+        jsondumpf(root_config.path_local_deps, {"./dep": LIB_A})
+        assert self.config.inputs_fingerprint(local_pkgs) != changed, (
+            "local deps are hashed")
+
+    def test_use_lock(self):
+        store_pkg(self.config, LIB_A)
+        libB = store_pkg(self.config, LIB_B)
+        root_key = PkgName("fake", "root")
+        locked = {
+            root_key: ROOT,
+            PkgName("fake", "libA"): LIB_A,
+            PkgName("fake", "libB"): LIB_B,
+        }
+        self.config.dump_lock("abcd", locked, {root_key})
+
+        config = self.new_config()
+        root2 = "fake@root@1.0.0@md5.dddd4444"
+        relocked = {root_key: root2}
+        assert config.use_lock("abcd", relocked)
+        assert relocked.pop(root_key) == root2, "the local pkgs are kept"
+        assert relocked == {k: v for k, v in locked.items() if k != root_key}
+        assert not config.use_lock("other", {})
+
+        shutil.rmtree(libB)
+        assert not self.new_config().use_lock("abcd", {})
+
+    def test_dump_lock_unchanged(self):
+        locked = {PkgName("fake", "libA"): LIB_A}
+        self.config.dump_lock("abcd", locked, set())
+        mtime = os.stat(self.config.pkgs_locked).st_mtime
+        time.sleep(0.01)
+        self.new_config().dump_lock("abcd", locked, set())
+        assert os.stat(self.config.pkgs_locked).st_mtime == mtime
+
+
+    def test_bad_lock(self):
+        locked = {PkgName("fake", "libA"): LIB_A}
+        for text in ('{"fake@libA": "%s"}' % LIB_A,   # older format
+                     '{"fingerprint": "abcd", "pkgs": {"fa',
+                     '{"fingerprint": "abcd", "pkgs": ["fake@libA"]}',
+                     '[]'):
+            dumpf(self.config.pkgs_locked, text)
+            config = self.new_config()
+            assert config.locked_before == {}
+            assert not config.use_lock("abcd", {})
+            config.dump_lock("abcd", locked, set())
+            assert self.new_config().locked_before == {"fake@libA": LIB_A}
+
+
+class TestRetrieved(ConfigTestCase):
+    def test_retrieve_pkgs(self):
+        config = self.new_config(IngestConfig)
+        log = os.path.join(self.dir, "retrievers.log")
+        exec_x = store_retriever(config, LIB_A, log)
+        exec_y = store_retriever(config, LIB_B, log)
+        pkgs = [
+            unresolved_pkg(fake_req("c"), exec_x),
+            unresolved_pkg(fake_req("d"), exec_y),
+            unresolved_pkg(fake_req("e"), exec_x),
+        ]
+
+        config.retrieve_pkgs(pkgs, {}, {})
+        assert sorted(r[2]["pkgVersions"] for r in read_runs(log)) == [
+            [fake_req("c"), fake_req("e")],
+            [fake_req("d")],
+        ], "one request per retriever"
+        assert sorted(pdir for _, pdir in config.ingested) == ["c", "d", "e"]
+        assert sorted(config.retrieved) == [
+            fake_req("c"), fake_req("d"), fake_req("e")
+        ]
+
+    def test_retrieve_content(self):
+        config = self.new_config(IngestConfig)
+        log = os.path.join(self.dir, "retrievers.log")
+        config.retrievers[PkgName("fake", "libC")] = store_retriever(
+            config, LIB_A, log)
+        store_pkg(config, LIB_C, definition_only=True)
+
+        # The content is retrieved, but it is not ingested into the store.
+        with self.assertRaises(ValueError):
+            config.retrieve_content([LIB_A, LIB_C], {})
+        [(_, _, cmd)] = read_runs(log)
+        assert cmd["pkgVersions"] == [LIB_C], "only pkgs without content"
+        assert cmd["definitionOnly"] is False
+        assert [pdir for _, pdir in config.ingested] == ["libC"]
+
+    def test_retrieve_prefetched(self):
+        dumpf(os.path.join(self.user, "user.jsonnet"),
+              '{"retrieveJobsPerExec": 1}')
+        config = self.new_config(FingerprintConfig)
+        self.addCleanup(config.prefetcher.close)
+        config.pkg_vers = {"libC": LIB_C, "libD": LIB_D}
+        log = os.path.join(self.dir, "retrievers.log")
+        retriever = store_retriever(config, LIB_A, log)
+        for pkg_ver in (LIB_C, LIB_D):
+            config.retrievers[PkgName.from_pkg_ver(pkg_ver)] = retriever
+            store_pkg(config, pkg_ver, definition_only=True)
+
+        config.prefetcher.submit([LIB_C, LIB_D], config.retriever_path)
+        config.retrieve_content([LIB_C], {})
+        assert [r[2]["pkgVersions"] for r in read_runs(log)] == [
+            [LIB_C, LIB_D]
+        ], "retrieved by the prefetched job"
+        assert config.store.get_pkg_path(LIB_C) is not None
+        assert config.store.get_pkg_path(LIB_D) is None, "a wrong guess"
+
+    def test_keyed_by_fingerprint(self):
+        store_pkg(self.config, LIB_A, definition_only=True)
+        pkg = unresolved_pkg(REQ_A)
+        self.config.load_retrieved("abcd")
+        self.finish_definitions(self.config, pkg, [LIB_A])
+
+        config = self.new_config()
+        config.load_retrieved("abcd")
+        locked = {}
+        assert config.lock_retrieved(pkg, locked)
+        assert locked == {PkgName("fake", "libA"): LIB_A}
+
+        config = self.new_config()
+        config.load_retrieved("other")
+        assert not config.lock_retrieved(pkg, {}), "other inputs"
+
+    def test_run_cycle_handled(self):
+        store_pkg(self.config, LIB_B, definition_only=True)
+        self.config.load_retrieved("abcd")
+        self.finish_definitions(self.config, unresolved_pkg(REQ_B), [LIB_B])
+
+        config = self.new_config(CycleConfig)
+        config.manifest = PkgManifest(
+            root=simple_pkg(ROOT, pkgs={
+                "libA": {"pkgReq": REQ_A},
+                "libB": {"pkgReq": REQ_B},
+            }),
+            all_pkgs=[unresolved_pkg(REQ_A), unresolved_pkg(REQ_B)],
+        )
+        config.load_retrieved("abcd")
+        locked = {}
+        handled = set()
+
+        unresolved, _ = oldwake.run_cycle(config, None, locked, handled)
+        assert unresolved == 2
+        assert config.retrieve_calls == [[REQ_A]], "libB was retrieved before"
+        assert locked == {PkgName("fake", "libB"): LIB_B}
+        assert handled == {REQ_A, REQ_B}
+
+        unresolved, _ = oldwake.run_cycle(config, None, locked, handled)
+        assert unresolved == 2
+        assert config.retrieve_calls == [[REQ_A], []], "already handled"
+
+
+class TestRetrieve(unittest.TestCase):
+    def test_request_depths(self):
+        # root -> libA -> c, root -> libA -> d, root -> c
+        manifest = PkgManifest(
+            root=simple_pkg(ROOT, pkgs={
+                "libA": LIB_A,
+                "c": {"pkgReq": fake_req("c")},
+            }),
+            all_pkgs=[
+                simple_pkg(LIB_A, pkgs={
+                    "c": {"pkgReq": fake_req("c")},
+                    "d": {"pkgReq": fake_req("d")},
+                }),
+                unresolved_pkg(fake_req("c")),
+                unresolved_pkg(fake_req("d")),
+            ],
+        )
+        assert request_depths(manifest) == {
+            fake_req("c"): 1,
+            fake_req("d"): 2,
+        }
+
+    def test_make_jobs(self):
+        execs = {"a": "/x", "b": "/y", "c": "/x", "d": "/x"}
+        pkgs = [
+            unresolved_pkg(fake_req(n), exec_=execs[n])
+            for n in ("a", "b", "c", "d")
+        ]
+        depths = {fake_req("a"): 3, fake_req("b"): 2, fake_req("c"): 1}
+
+        jobs = make_jobs(pkgs, lambda exec_: exec_, depths)
+        assert [(j.exec_path, j.depth, j.reqs) for j in jobs] == [
+            ("/x", 0, [fake_req("d"), fake_req("c"), fake_req("a")]),
+            ("/y", 2, [fake_req("b")]),
+        ], "one job per exec, shallowest first"
+        assert jobs[0].pkgs == [pkgs[3], pkgs[2], pkgs[0]]
+
+    def test_make_content_jobs(self):
+        execs = {"a": "/x", "b": "/y", "c": "/x", "d": "/y", "e": "/x"}
+        jobs = make_content_jobs(["e", "d", "c", "b", "a"], execs.get, 2)
+        assert [(j.exec_path, j.reqs) for j in jobs] == [
+            ("/x", ["a", "e"]),
+            ("/x", ["c"]),
+            ("/y", ["b"]),
+            ("/y", ["d"]),
+        ]
+        assert not any(j.definition_only for j in jobs)
+
+    def test_parse_record(self):
+        assert parse_record(b'{"__WAKETYPE__": "retrievedPkg", "dir": "a"}\n'
+                            ) == "a"
+        assert parse_record(b"progress: 50%\n") is None
+        assert parse_record(b'{"__WAKETYPE__": "other", "dir": "a"}') is None
+        assert parse_record(b'["retrievedPkg"]') is None
+        for pdir in ("", ".", "..", "../a", "a/b", "/a"):
+            with self.assertRaises(ValueError):
+                parse_record(json.dumps({
+                    "__WAKETYPE__": "retrievedPkg",
+                    "dir": pdir
+                }).encode())
+
+
+class RetrieverTestCase(unittest.TestCase):
+    """Run retrievers with a store in a temporary directory."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="oldwake-")
+        self.store = store.Store(os.path.join(self.dir, "base"),
+                                 os.path.join(self.dir, "store"))
+        self.store.init_store()
+        self.log = os.path.join(self.dir, "retrievers.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def retriever(self, name, sleep=0):
+        return write_retriever(os.path.join(self.dir, name), self.log, sleep)
+
+
+class TestScheduler(RetrieverTestCase):
+    def run_jobs(self, scheduler, jobs):
+        pkgs, done = [], []
+        scheduler.run(
+            jobs,
+            lambda job, pdir: pkgs.append(pdir),
+            lambda job: done.append(job),
+        )
+        return pkgs, done
+
+    def test_run(self):
+        exec_path = self.retriever("x")
+        job = RetrieveJob(exec_path, [fake_req("a"), fake_req("b")])
+        pkgs, done = self.run_jobs(Scheduler(self.store), [job])
+        assert pkgs == ["a", "b"], "streamed"
+        assert done == [job]
+        assert job.ingested == {"a", "b"}
+        cmd = read_runs(self.log)[0][2]
+        assert cmd["pkgVersions"] == job.reqs
+        assert cmd["stream"] is True
+
+    def test_ingest_in_calling_thread(self):
+        exec_path = self.retriever("x")
+        job = RetrieveJob(exec_path, [fake_req(n) for n in ("a", "b", "c")])
+        calls = []
+
+        def on_pkg(job, pdir):
+            calls.append((threading.current_thread(), time.time()))
+            time.sleep(0.2)
+
+        Scheduler(self.store).run([job], on_pkg, lambda job: None)
+        assert [c[0] for c in calls] == [threading.current_thread()] * 3
+        [(_, end, _)] = read_runs(self.log)
+        assert end < calls[-1][1], "a slow ingestion doesn't stall retrieval"
+
+    def test_callback_failure(self):
+        slow = RetrieveJob(self.retriever("slow", sleep=5), [fake_req("a")])
+        fast = RetrieveJob(self.retriever("x"), [fake_req("b")], depth=1)
+
+        def on_pkg(job, pdir):
+            raise KeyError(pdir)
+
+        start = time.time()
+        with self.assertRaises(KeyError):
+            Scheduler(self.store).run([slow, fast], on_pkg, lambda job: None)
+        assert time.time() - start < 5, "the slow job was cancelled"
+        assert os.listdir(self.store.retrievals) == []
+
+    def test_limits(self):
+        execs = [self.retriever("x", sleep=0.3), self.retriever("y", 0.3)]
+        jobs = [
+            RetrieveJob(e, [fake_req("{}{}".format(e[-1], i))])
+            for e in execs for i in range(3)
+        ]
+        self.run_jobs(Scheduler(self.store, jobs=3, jobs_per_exec=1), jobs)
+
+        runs = read_runs(self.log)
+        assert len(runs) == 6
+        assert max_concurrent(runs) == 2
+        for exec_name in ("x", "y"):
+            assert max_concurrent([
+                r for r in runs if r[2]["pkgVersions"][0].split("@")[1]
+                .startswith(exec_name)
+            ]) == 1
+
+    def test_depth_order(self):
+        jobs = [
+            RetrieveJob(self.retriever(name), [fake_req(name)], depth=depth)
+            for name, depth in (("c", 2), ("a", 0), ("b", 1))
+        ]
+        self.run_jobs(Scheduler(self.store, jobs=1), jobs)
+        assert [r[2]["pkgVersions"] for r in read_runs(self.log)] == [
+            [fake_req("a")], [fake_req("b")], [fake_req("c")]
+        ]
+
+    def test_cancel_on_failure(self):
+        slow = RetrieveJob(self.retriever("slow", sleep=5), [fake_req("a")])
+        fail = RetrieveJob(self.retriever("x"), [fake_req("fail")], depth=1)
+        start = time.time()
+        with self.assertRaises(RuntimeError):
+            self.run_jobs(Scheduler(self.store), [slow, fail])
+        assert time.time() - start < 5, "the slow job was cancelled"
+        assert [r[1] for r in read_runs(self.log)] == [None, None]
+        assert os.listdir(self.store.retrievals) == []
+
+
+class TestPrefetcher(RetrieverTestCase):
+    def setUp(self):
+        super().setUp()
+        self.prefetcher = Prefetcher(self.store, budget=4, jobs_per_exec=1)
+
+    def tearDown(self):
+        self.prefetcher.close()
+        super().tearDown()
+
+    def submit(self, exec_path, *names):
+        self.prefetcher.submit([content_ver(n) for n in names],
+                               lambda pkg_ver: exec_path)
+
+    def test_take(self):
+        self.submit(self.retriever("x"), "a", "b")
+        [job] = self.prefetcher.take([content_ver("b")])
+        assert job.reqs == [content_ver("a"), content_ver("b")]
+        assert not job.definition_only
+        assert sorted(os.listdir(job.retrieved_dir())) == ["a", "b"]
+        assert job.ingested == set(), "left to the caller"
+        assert self.prefetcher.take([content_ver("a")]) == [], "taken"
+
+    def test_take_failed(self):
+        self.submit(self.retriever("x"), "fail")
+        assert self.prefetcher.take([content_ver("fail")]) == []
+        assert os.listdir(self.store.retrievals) == []
+
+    def test_budget(self):
+        exec_path = self.retriever("x")
+        self.submit(exec_path, "a", "b")
+        self.submit(exec_path, "b", "c", "d", "e")
+        self.submit(exec_path, "f")
+        assert self.prefetcher.submitted == {
+            content_ver(n) for n in ("a", "b", "c", "d")
+        }
+        assert [job.reqs for job, _ in self.prefetcher.pending] == [
+            [content_ver("a"), content_ver("b")],
+            [content_ver("c"), content_ver("d")],
+        ]
+
+    def test_discard(self):
+        slow = self.retriever("slow", sleep=5)
+        self.submit(slow, "a")
+        self.submit(slow, "b", "c")
+        self.submit(self.retriever("x"), "d")
+        discarded = self.prefetcher.pending[0][0]
+        start = time.time()
+        self.prefetcher.discard(
+            lambda pkg_ver: pkg_ver in (content_ver("a"), content_ver("b")))
+        assert time.time() - start < 5, "the slow job was cancelled"
+        assert [job.reqs for job, _ in self.prefetcher.pending] == [
+            [content_ver("b"), content_ver("c")],
+            [content_ver("d")],
+        ], "only jobs of which every pkgVer is wrong are discarded"
+
+        assert discarded.run_dir is None or not os.path.exists(
+            discarded.run_dir)
+        [job] = self.prefetcher.take([content_ver("d")])
+        assert job.reqs == [content_ver("d")]
+
+    def test_close(self):
+        self.submit(self.retriever("slow", sleep=5), "a")
+        start = time.time()
+        self.prefetcher.close()
+        assert time.time() - start < 5, "the slow job was cancelled"
+        assert self.prefetcher.loop is None
+        assert os.listdir(self.store.retrievals) == []
@@ -0,0 +1,67 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from oldwake import store
+from oldwake.utils import jsondumpf, dumpf
+
+PKG_VER = "fake@libA@1.0.0@md5.abcd1234"
+
+
+def create_pkg(pcache):
+    os.makedirs(pcache)
+    dumpf(os.path.join(pcache, "README.txt"), "libA")
+    os.mkdir(os.path.join(pcache, ".wake"))
+    jsondumpf(store.pkg_meta_path(pcache), {"state": "declared"})
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="oldwake-")
+        self.store = store.Store(os.path.join(self.dir, "base"),
+                                 os.path.join(self.dir, "store"))
+        self.store.init_store()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shard_path(self):
+        assert store.shard_path("/s", PKG_VER) == os.path.join(
+            "/s", "ab", PKG_VER)
+
+    def test_lookup(self):
+        assert self.store.get_pkg_path(PKG_VER) is None
+
+        create_pkg(store.shard_path(self.store.defined, PKG_VER))
+        assert self.store.get_pkg_path(PKG_VER) is None
+        assert self.store.get_pkg_path(PKG_VER, def_okay=True) == (
+            store.shard_path(self.store.defined, PKG_VER))
+
+        create_pkg(store.shard_path(self.store.pkgs, PKG_VER))
+        assert self.store.get_pkg_path(PKG_VER) == store.shard_path(
+            self.store.pkgs, PKG_VER)
+
+    def test_migrate_on_init(self):
+        # A store created before sharding
+        create_pkg(os.path.join(self.store.pkgs, PKG_VER))
+        create_pkg(os.path.join(self.store.defined, PKG_VER))
+
+        self.store.init_store()
+        assert sorted(os.listdir(self.store.pkgs)) == ["ab"]
+        assert sorted(os.listdir(self.store.defined)) == ["ab"]
+        pcache = self.store.get_pkg_path(PKG_VER)
+        assert pcache == store.shard_path(self.store.pkgs, PKG_VER)
+        assert os.path.exists(os.path.join(pcache, "README.txt"))
+
+    def test_quarantine(self):
+        pcache = store.shard_path(self.store.pkgs, PKG_VER)
+        create_pkg(pcache)
+        dumpf(store.pkg_meta_path(pcache), '{"state": ')
+
+        assert self.store.get_pkg_path(PKG_VER) is None
+        assert not os.path.exists(pcache)
+        quarantined = os.listdir(
+            os.path.join(os.path.dirname(pcache), store.DIR_QUARANTINE))
+        assert len(quarantined) == 1
+        assert quarantined[0].startswith(PKG_VER + ".")
@@ -0,0 +1,48 @@
+import copy
+import pickle
+import unittest
+
+from wakeold2.digest import Digest
+from wakeold2.pkg import PkgName, PkgReq, PkgRequest, PkgVer
+
+
+def pkg_ver(name, version="1.0.0"):
+    return PkgVer("fake", name, version, Digest("abcd" + name, "md5"))
+
+
+class TestIdentifiers(unittest.TestCase):
+    def test_immutable(self):
+        libA = pkg_ver("libA")
+        with self.assertRaises(AttributeError):
+            libA.version = "2.0.0"
+        with self.assertRaises(AttributeError):
+            libA.other = 1
+        with self.assertRaises(AttributeError):
+            del libA.name
+
+    def test_equality(self):
+        libA = pkg_ver("libA")
+        assert libA == pkg_ver("libA")
+        assert hash(libA) == hash(pkg_ver("libA"))
+        assert libA != pkg_ver("libA", "2.0.0")
+        assert len({libA, pkg_ver("libA"), pkg_ver("libB")}) == 2
+        assert PkgName("fake", "libA") < PkgName("fake", "libB")
+        with self.assertRaises(TypeError):
+            assert libA != PkgName("fake", "libA")
+
+    def test_deserialize(self):
+        libA = pkg_ver("libA")
+        string = libA.serialize()
+        assert PkgVer.deserialize(string) == libA
+        assert PkgVer.deserialize(string) is PkgVer.deserialize(string)
+        assert Digest.deserialize("md5.abcd") == Digest("abcd", "md5")
+
+        request = PkgRequest(libA, PkgReq("fake", "libB", ">=1.0"))
+        assert PkgRequest.deserialize(request.serialize()) == request
+        with self.assertRaises(ValueError):
+            PkgRequest.deserialize(string)
+
+    def test_copy(self):
+        request = PkgRequest(pkg_ver("libA"), PkgReq("fake", "libB", "*"))
+        assert pickle.loads(pickle.dumps(request)) == request
+        assert copy.deepcopy(request) == request
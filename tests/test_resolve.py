@@ -0,0 +1,183 @@
+import unittest
+
+from wakeold2.digest import Digest
+from wakeold2.pkg import PkgReq, PkgRequest, PkgVer
+from wakeold2.resolve import ResolveError, Resolver
+
+
+def pkg_ver(name, version):
+    return PkgVer("fake", name, version, Digest("abcd" + name, "md5"))
+
+
+def req(name, semver):
+    return PkgReq("fake", name, semver).serialize()
+
+
+def request(pkgVer, name, semver):
+    return PkgRequest(pkgVer, PkgReq("fake", name, semver)).serialize()
+
+
+class CountingResolver(Resolver):
+    """Count the requests which are chosen."""
+    def __init__(self):
+        super(CountingResolver, self).__init__()
+        self.chosen = 0
+
+    def _choose(self, request, pins, prefer):
+        self.chosen += 1
+        return super(CountingResolver, self)._choose(request, pins, prefer)
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.resolver = Resolver()
+        for version in ("1.0.0", "1.1.0", "1.9.0", "2.0.0", "2.5.0"):
+            self.resolver.add_pkg(pkg_ver("libE", version), {})
+
+    def test_latest(self):
+        # pkgA requires libB(>1.0) and libE(>=1.0, <3.0)
+        # libB requires libE(>=1.1, <2.0)
+        libA = pkg_ver("libA", "2.3.0")
+        libB = pkg_ver("libB", "1.2.0")
+        self.resolver.add_pkg(libA, {
+            "unrestricted": {
+                "libB": req("libB", ">1.0"),
+                "libE": req("libE", ">=1.0, <3.0"),
+            }
+        })
+        self.resolver.add_pkg(libB, {
+            "unrestricted": {
+                "libE": req("libE", ">=1.1, <2.0")
+            },
+        })
+        assert self.resolver.resolve([libA]) == {
+            request(libA, "libB", ">1.0"): libB,
+            request(libA, "libE", ">=1.0, <3.0"): pkg_ver("libE", "2.5.0"),
+            request(libB, "libE", ">=1.1, <2.0"): pkg_ver("libE", "1.9.0"),
+        }
+
+    def test_restricted(self):
+        libA = pkg_ver("libA", "1.0.0")
+        libB = pkg_ver("libB", "1.0.0")
+        self.resolver.add_pkg(libA, {
+            "restricted": {
+                "libB": req("libB", "*"),
+                "libE": req("libE", ">=1.0"),
+            }
+        })
+        self.resolver.add_pkg(libB,
+                              {"restricted": {
+                                  "libE": req("libE", "^1")
+                              }})
+        result = self.resolver.resolve([libA])
+        assert result[request(libA, "libE", ">=1.0")] == pkg_ver(
+            "libE", "1.9.0")
+        assert result[request(libB, "libE", "^1")] == pkg_ver("libE", "1.9.0")
+
+        libC = pkg_ver("libC", "1.0.0")
+        self.resolver.add_pkg(libC,
+                              {"restricted": {
+                                  "libE": req("libE", "^2")
+                              }})
+        libA2 = pkg_ver("libA", "2.0.0")
+        self.resolver.add_pkg(libA2, {
+            "restricted": {
+                "libB": req("libB", "*"),
+                "libC": req("libC", "*"),
+            }
+        })
+        with self.assertRaises(ResolveError) as err:
+            self.resolver.resolve([libA2])
+        assert sorted(err.exception.requests) == sorted([
+            request(libB, "libE", "^1"),
+            request(libC, "libE", "^2"),
+        ])
+
+    def test_restricted_major(self):
+        libA = pkg_ver("libA", "1.0.0")
+        self.resolver.add_pkg(libA, {
+            "restrictedMajor": {
+                "one": req("libE", "~1.0"),
+                "oneOrTwo": req("libE", "<=2"),
+                "two": req("libE", "2"),
+            }
+        })
+        result = self.resolver.resolve([libA])
+        assert result[request(libA, "libE", "~1.0")] == pkg_ver(
+            "libE", "1.0.0")
+        assert result[request(libA, "libE", "<=2")] == pkg_ver(
+            "libE", "2.5.0")
+        assert result[request(libA, "libE", "2")] == pkg_ver(
+            "libE", "2.5.0")
+
+    def test_no_match(self):
+        libA = pkg_ver("libA", "1.0.0")
+        self.resolver.add_pkg(libA, {"unrestricted": {"e": req("libE", ">3")}})
+        with self.assertRaises(ResolveError):
+            self.resolver.resolve([libA])
+
+    def test_incremental(self):
+        libA = pkg_ver("libA", "1.0.0")
+        self.resolver.add_pkg(libA, {
+            "unrestricted": {
+                "libE": req("libE", ">=1.0")
+            },
+            "restricted": {
+                "libE1": req("libE", "^1")
+            },
+        })
+        first = self.resolver.resolve([libA])
+        assert first[request(libA, "libE", ">=1.0")] == pkg_ver(
+            "libE", "2.5.0")
+
+        # Resolving continues in another invocation, after more versions
+        # were retrieved.
+        resolver = Resolver.deserialize(self.resolver.serialize())
+        assert resolver.pins == self.resolver.pins
+        assert resolver.resolve([libA]) == first
+
+        resolver.add_pkg(pkg_ver("libE", "1.9.5"), {})
+        resolver.add_pkg(pkg_ver("libE", "3.0.0"), {})
+        assert resolver.resolve([libA]) == {
+            request(libA, "libE", ">=1.0"): pkg_ver("libE", "3.0.0"),
+            request(libA, "libE", "^1"): pkg_ver("libE", "1.9.5"),
+        }
+
+    def test_rewalk(self):
+        resolver = CountingResolver()
+        for version in ("1.0.0", "1.1.0"):
+            resolver.add_pkg(pkg_ver("libE", version), {})
+        # root -> lib0..lib9 -> libE
+        root = pkg_ver("root", "1.0.0")
+        libs = [pkg_ver("lib{}".format(i), "1.0.0") for i in range(10)]
+        resolver.add_pkg(root, {
+            "unrestricted": {v.name: req(v.name, "*") for v in libs}
+        })
+        for i, lib in enumerate(libs):
+            resolver.add_pkg(lib, {
+                "restricted" if i % 2 else "unrestricted": {
+                    "libE": req("libE", "^1")
+                }
+            })
+        first = resolver.resolve([root])
+        # The restricted requests are chosen again once their bucket is
+        # pinned.
+        assert resolver.chosen == 20 + 5
+        assert resolver.resolve([root]) == first
+        assert resolver.chosen == 20 + 5, "nothing changed"
+
+        resolver.chosen = 0
+        libE = pkg_ver("libE", "1.2.0")
+        resolver.add_pkg(libE, {})
+        result = resolver.resolve([root])
+        # Only the requests of libE are chosen again, the restricted ones
+        # once more when the pin of their bucket moves to 1.2.0.
+        assert resolver.chosen == 10 + 5
+        expected = dict(first)
+        expected.update({request(lib, "libE", "^1"): libE for lib in libs})
+        assert result == expected
+
+        fresh = Resolver()
+        for pkgVer, depsReq in resolver.depsReq.items():
+            fresh.add_pkg(pkgVer, depsReq)
+        assert fresh.resolve([root]) == result
@@ -0,0 +1,95 @@
+import unittest
+import os
+
+import wakeold2
+from wakeold2.constants import FILE_PKG_DEFAULT
+from wakeold2.digest import DigestBuilder
+from wakeold2.pkg import PkgDeclared, PkgVer
+from wakeold2.scrub import CORRUPT, OK, Scrubber, Throttle
+from wakeold2.store import VerifiedMeta
+from wakeold2.tier import DirTier
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class TestThrottle(unittest.TestCase):
+    def test_rates(self):
+        clock = FakeClock()
+        throttle = Throttle(mb_per_sec=1, iops=10, clock=clock,
+                            sleep=clock.sleep)
+        throttle.consume(nbytes=2 * 1024 * 1024, ops=1)
+        assert clock.now == 2.0
+
+        for _ in range(10):
+            throttle.consume(ops=1)
+        assert abs(clock.now - 3.0) < 1e-9
+
+
+class TestScrubber(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.tier = DirTier(self.state.create_temp_dir(prefix="store-").dir)
+        self.src = self.state.create_temp_dir(prefix="src-").dir
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def create_pkg(self, name):
+        pkg_dir = os.path.join(self.src, name)
+        os.mkdir(pkg_dir)
+        for fname in (FILE_PKG_DEFAULT, "README.txt"):
+            wakeold2.utils.dumpf(os.path.join(pkg_dir, fname), name)
+        builder = DigestBuilder(pkg_dir)
+        builder.update_paths([
+            os.path.join(pkg_dir, fname)
+            for fname in (FILE_PKG_DEFAULT, "README.txt")
+        ])
+        pkgVer = PkgVer("fake", name, "1.0.0", builder.build())
+
+        pkg_path = self.tier.create_package(pkg_dir, pkgVer)
+        VerifiedMeta.from_pkg(
+            PkgDeclared(
+                pkg_file=os.path.join(pkg_path, FILE_PKG_DEFAULT),
+                pkgVer=pkgVer,
+                pkgOrigin=None,
+                paths={"./README.txt"},
+                depsReq={},
+            )).dump()
+        return pkgVer
+
+    def test_scrub(self):
+        libA = self.create_pkg("libA")
+        libB = self.create_pkg("libB")
+        wakeold2.utils.dumpf(
+            os.path.join(self.tier.pkg_path(libB), "README.txt"), "rot")
+
+        scrubber = Scrubber(self.tier)
+        assert scrubber.scrub_pkg(libA.serialize()) == OK
+        assert scrubber.scrub_pkg(libB.serialize()) == CORRUPT
+        assert not os.path.exists(self.tier.pkg_path(libB))
+        assert self.tier.list_pkg_vers() == [libA.serialize()]
+
+    def test_checkpoint(self):
+        pkgVers = sorted(
+            self.create_pkg("lib{}".format(i)).serialize() for i in range(3))
+        os.makedirs(os.path.join(self.tier.dir, "ab", "unknown"))
+
+        scrubber = Scrubber(self.tier)
+        report = scrubber.scrub(limit=2)
+        assert not report.complete
+        assert report.ok == pkgVers[:2]
+
+        report = scrubber.scrub()
+        assert report.complete
+        assert report.ok == pkgVers[2:]
+        assert report.unverified == ["unknown"]
+        assert scrubber.load_checkpoint() is None
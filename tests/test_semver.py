@@ -0,0 +1,103 @@
+import unittest
+
+from wakeold2 import semver
+from wakeold2.semver import (ReqRange, Version, VersionColumn,
+                             intersect_ranges, merge_ranges, parse_req,
+                             parse_version)
+
+
+def matching(semver, versions):
+    ranges = parse_req(semver)
+    return [
+        v for v in versions
+        if any(r.matches(parse_version(v)) for r in ranges)
+    ]
+
+
+VERSIONS = [
+    "0.0.3", "0.2.3", "0.2.9", "0.3.0", "1.0.0", "1.2.0-alpha.2",
+    "1.2.0-alpha.10", "1.2.0", "1.2.5", "1.3.0", "2.0.0-rc.1", "2.0.0",
+    "2.4.1", "3.0.0"
+]
+
+
+class TestSemver(unittest.TestCase):
+    def test_version_order(self):
+        ordered = sorted(VERSIONS, key=lambda v: parse_version(v).key)
+        assert ordered == VERSIONS
+        assert parse_version("1.2.3+build.5") == Version(1, 2, 3)
+        with self.assertRaises(ValueError):
+            parse_version("1.2")
+
+    def test_parse_req(self):
+        assert matching(">=1.2.0, <2.0.0", VERSIONS) == [
+            "1.2.0", "1.2.5", "1.3.0", "2.0.0-rc.1"
+        ]
+        assert matching("^1.2", VERSIONS) == ["1.2.0", "1.2.5", "1.3.0"]
+        assert matching("^0.2.3", VERSIONS) == ["0.2.3", "0.2.9"]
+        assert matching("~1.2.1", VERSIONS) == ["1.2.5"]
+        assert matching("1.2", VERSIONS) == ["1.2.0", "1.2.5"]
+        assert matching("=2.0.0", VERSIONS) == ["2.0.0"]
+        assert matching(">1.3", VERSIONS) == [
+            "2.0.0-rc.1", "2.0.0", "2.4.1", "3.0.0"
+        ]
+        assert matching("1.3 - 2.0", VERSIONS) == [
+            "1.3.0", "2.0.0-rc.1", "2.0.0"
+        ]
+        assert matching("<0.3 || >=3", VERSIONS) == [
+            "0.0.3", "0.2.3", "0.2.9", "3.0.0"
+        ]
+        assert matching("*", VERSIONS) == VERSIONS
+        assert matching("", VERSIONS) == VERSIONS
+        assert parse_req("^1.0 || 1.5.x") == parse_req("^1.0.0")
+        with self.assertRaises(ValueError):
+            parse_req(">=1.0 garbage")
+
+    def test_cache_bounded(self):
+        assert parse_version("4.5.6") is parse_version("4.5.6")
+        assert parse_req("^4.5") is parse_req("^4.5")
+        maxsize = semver._versions.maxsize
+        try:
+            semver._versions.maxsize = 2
+            semver._versions.clear()
+            for patch in range(4):
+                parse_version("4.5.{}".format(patch))
+            assert len(semver._versions.items) == 2
+        finally:
+            semver._versions.maxsize = maxsize
+
+    def test_ranges(self):
+        one, two, three = [parse_version(v) for v in ("1.0.0", "2.0.0",
+                                                      "3.0.0")]
+        merged = merge_ranges([
+            ReqRange(two, three),
+            ReqRange(one, two),
+            ReqRange.exact(three),
+        ])
+        assert merged == [ReqRange(one, three, high_inclusive=True)]
+        assert merge_ranges([ReqRange(one, two),
+                             ReqRange(two, three, low_inclusive=False)
+                             ]) == [
+                                 ReqRange(one, two),
+                                 ReqRange(two, three, low_inclusive=False),
+                             ]
+
+        both = intersect_ranges(parse_req("<2 || >=3"), parse_req(">=1.5"))
+        assert [str(r) for r in both] == [">=1.5.0, <2.0.0", ">=3.0.0"]
+        assert intersect_ranges(parse_req("<1"), parse_req(">=2")) == []
+
+    def test_version_column(self):
+        # Components which overflow the packing are compared by key.
+        versions = VERSIONS + ["4000000.1.0", "4000000.2.0-beta",
+                               "4000000.2.0", "4000001.0.0"]
+        column = VersionColumn()
+        for v in reversed(versions):
+            column.add(parse_version(v), v)
+        assert column.sorted_values() == versions
+
+        for semver in ("^1.2", ">=1.2.0-alpha.10, <2", "<0.3 || >=2.0.0-rc.1",
+                       ">4000000.1.0, <4000001", "=1.2.0", "^5"):
+            expected = matching(semver, versions)[::-1]
+            assert column.matching(parse_req(semver)) == expected, semver
+            assert column.latest(parse_req(semver)) == (
+                expected[0] if expected else None)
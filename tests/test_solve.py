@@ -0,0 +1,128 @@
+import unittest
+
+from wakeold2.digest import Digest
+from wakeold2.pkg import PkgReq, PkgRequest, PkgVer
+from wakeold2.resolve import ResolveError, Resolver
+from wakeold2.solve import C_BUCKET, C_REQUEST, C_ROOT, Solver, UnsatError
+
+
+def pkg_ver(name, version):
+    return PkgVer("fake", name, version, Digest("abcd" + name, "md5"))
+
+
+def req(name, semver):
+    return PkgReq("fake", name, semver).serialize()
+
+
+def request(pkgVer, name, semver):
+    return PkgRequest(pkgVer, PkgReq("fake", name, semver)).serialize()
+
+
+class TestSolver(unittest.TestCase):
+    def setUp(self):
+        self.resolver = Resolver()
+        for version in ("1.0.0", "1.9.0", "2.0.0", "2.5.0"):
+            self.resolver.add_pkg(pkg_ver("libE", version), {})
+        self.libA = pkg_ver("libA", "1.0.0")
+        self.libC = pkg_ver("libC", "1.0.0")
+        self.resolver.add_pkg(self.libC,
+                              {"restricted": {
+                                  "libE": req("libE", "^2")
+                              }})
+
+    def test_backtrack(self):
+        # The latest libB needs libE 1.x but libC needs libE 2.x: the older
+        # libB must be chosen.
+        libB1 = pkg_ver("libB", "1.0.0")
+        libB2 = pkg_ver("libB", "2.0.0")
+        self.resolver.add_pkg(libB1,
+                              {"restricted": {
+                                  "libE": req("libE", ">=2.0")
+                              }})
+        self.resolver.add_pkg(libB2,
+                              {"restricted": {
+                                  "libE": req("libE", "^1")
+                              }})
+        self.resolver.add_pkg(self.libA, {
+            "restricted": {
+                "libB": req("libB", "*"),
+                "libC": req("libC", "*"),
+            },
+            "unrestricted": {
+                "libE": req("libE", "<2"),
+            },
+        })
+        with self.assertRaises(ResolveError):
+            self.resolver.resolve([self.libA])
+
+        result = Solver(self.resolver).solve([self.libA])
+        libE = pkg_ver("libE", "2.5.0")
+        assert result == {
+            request(self.libA, "libB", "*"): libB1,
+            request(self.libA, "libC", "*"): self.libC,
+            request(self.libA, "libE", "<2"): pkg_ver("libE", "1.9.0"),
+            request(libB1, "libE", ">=2.0"): libE,
+            request(self.libC, "libE", "^2"): libE,
+        }
+
+    def test_unsat_core(self):
+        libB = pkg_ver("libB", "1.0.0")
+        libD = pkg_ver("libD", "1.0.0")
+        self.resolver.add_pkg(libB,
+                              {"restricted": {
+                                  "libE": req("libE", "^1")
+                              }})
+        self.resolver.add_pkg(libD, {})
+        self.resolver.add_pkg(self.libA, {
+            "restricted": {
+                "libB": req("libB", "*"),
+                "libC": req("libC", "*"),
+                "libD": req("libD", "*"),
+            }
+        })
+        with self.assertRaises(UnsatError) as err:
+            Solver(self.resolver).solve([self.libA])
+
+        core = sorted((c.kind, str(c.subject)) for c in err.exception.core)
+        assert [kind for kind, _ in core] == [
+            C_BUCKET, C_REQUEST, C_REQUEST, C_REQUEST, C_REQUEST, C_ROOT
+        ]
+        assert sorted(err.exception.requests) == sorted([
+            request(self.libA, "libB", "*"),
+            request(self.libA, "libC", "*"),
+            request(libB, "libE", "^1"),
+            request(self.libC, "libE", "^2"),
+        ])
+
+    def test_learned(self):
+        libB = pkg_ver("libB", "1.0.0")
+        self.resolver.add_pkg(libB,
+                              {"restricted": {
+                                  "libE": req("libE", "^1")
+                              }})
+        self.resolver.add_pkg(self.libA, {
+            "unrestricted": {
+                "libB": req("libB", "*"),
+            },
+            "restricted": {
+                "libE": req("libE", "*"),
+                "libC": req("libC", "<2"),
+            },
+        })
+        with self.assertRaises(UnsatError):
+            Solver(self.resolver).solve([self.libA])
+        assert self.resolver.learned
+
+        # Learned clauses are kept in the next invocation, and dropped
+        # once a version for one of their requests is added.
+        resolver = Resolver.deserialize(self.resolver.serialize())
+        assert resolver.learned == self.resolver.learned
+        with self.assertRaises(UnsatError):
+            Solver(resolver).solve([self.libA])
+
+        libC2 = pkg_ver("libC", "1.5.0")
+        resolver.add_pkg(libC2, {"restricted": {"libE": req("libE", "^1")}})
+        result = Solver(resolver).solve([self.libA])
+        assert result[request(self.libA, "libC", "<2")] == libC2
+        assert result[request(self.libA, "libE", "*")] == pkg_ver(
+            "libE", "1.9.0")
@@ -0,0 +1,98 @@
+import unittest
+import os
+import shutil
+import time
+
+import wakeold2
+from wakeold2.constants import DEFAULT_FILE_DIGEST, FILE_PKG_DEFAULT
+from wakeold2.digest import Digest
+from wakeold2.pkg import PkgDeclared, PkgVer
+from wakeold2.store import Store, VerifiedMeta
+from wakeold2.tier import DirTier, TieredStore
+
+DIR_TEST = os.path.dirname(os.path.abspath(__file__))
+PKG_LIBA = os.path.join(DIR_TEST, "jsonly", "exampleDeps", "libA-5.5.0",
+                        FILE_PKG_DEFAULT)
+
+
+class TestVerifiedMeta(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.pkg_dir = self.state.create_temp_dir(prefix="pkg-").dir
+        for fname in (FILE_PKG_DEFAULT, DEFAULT_FILE_DIGEST, "README.txt"):
+            wakeold2.utils.dumpf(os.path.join(self.pkg_dir, fname), fname)
+
+        self.pkgDeclared = PkgDeclared(
+            pkg_file=os.path.join(self.pkg_dir, FILE_PKG_DEFAULT),
+            pkgVer=PkgVer("fake", "libA", "1.0.0", Digest("abcd", "md5")),
+            pkgOrigin=None,
+            paths={"./README.txt"},
+            depsReq={},
+        )
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_roundtrip(self):
+        assert VerifiedMeta.load(self.pkg_dir) is None
+        VerifiedMeta.from_pkg(self.pkgDeclared).dump()
+
+        meta = VerifiedMeta.load(self.pkg_dir)
+        assert meta.pkgDeclared.serialize() == self.pkgDeclared.serialize()
+
+    def test_changed(self):
+        VerifiedMeta.from_pkg(self.pkgDeclared).dump()
+        time.sleep(0.01)
+        wakeold2.utils.dumpf(os.path.join(self.pkg_dir, "README.txt"), "bad")
+        assert VerifiedMeta.load(self.pkg_dir) is None
+
+    def test_removed(self):
+        VerifiedMeta.from_pkg(self.pkgDeclared).dump()
+        os.remove(os.path.join(self.pkg_dir, "README.txt"))
+        assert VerifiedMeta.load(self.pkg_dir) is None
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.store = Store(self.state)
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_read_export_read(self):
+        libA = wakeold2.load.loadPkgDeclared(self.state,
+                                             PKG_LIBA,
+                                             calc_digest=True)
+        libA = self.store.create_pkg(libA)
+        assert VerifiedMeta.load(libA.pkg_dir) is not None
+
+        export = self.store.read_export(libA, {})
+        assert export.export == {"answer": 42}
+        assert VerifiedMeta.load(libA.pkg_dir) is not None, "still verified"
+
+        result = self.store.read_pkg(libA.pkgVer, skip_cache=True)
+        assert result.serialize() == libA.serialize()
+
+    def test_corrupt_shared(self):
+        libA = wakeold2.load.loadPkgDeclared(self.state,
+                                             PKG_LIBA,
+                                             calc_digest=True)
+        shared = DirTier(self.state.create_temp_dir(prefix="shared-").dir)
+        corrupt = os.path.join(self.state.create_temp_dir().dir, "libA")
+        shutil.copytree(os.path.dirname(PKG_LIBA), corrupt)
+        with open(os.path.join(corrupt, FILE_PKG_DEFAULT), "a") as fd:
+            fd.write("// corrupt\n")
+        shared.create_package(corrupt, libA.pkgVer)
+
+        local = DirTier(self.state.create_temp_dir(prefix="local-").dir)
+        store = Store(self.state, tiers=TieredStore(local, shared=shared))
+        result = store.create_pkg(libA)
+        store.tiers.flush()
+        assert result.pkgVer == libA.pkgVer
+        assert len(os.listdir(os.path.join(shared.wake_dir,
+                                           "quarantine"))) == 1
+        shared_file = os.path.join(shared.pkg_path(libA.pkgVer),
+                                   FILE_PKG_DEFAULT)
+        assert "corrupt" not in wakeold2.utils.loadf(shared_file), (
+            "replaced in the shared tier")
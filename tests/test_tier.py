@@ -0,0 +1,120 @@
+import unittest
+import os
+
+import wakeold2
+from wakeold2.pkg import PkgVer, is_not_found
+from wakeold2.digest import Digest
+from wakeold2.bloom import BloomFilter
+from wakeold2.tier import DirTier, TieredStore
+
+
+def fake_pkg_ver(name, version="1.0.0"):
+    return PkgVer("fake", name, version, Digest("0123abcd" + name, "md5"))
+
+
+def create_pkg_dir(directory, name):
+    pkg_dir = os.path.join(directory, name)
+    os.mkdir(pkg_dir)
+    wakeold2.utils.dumpf(os.path.join(pkg_dir, "README.txt"), name)
+    return pkg_dir
+
+
+class TestTieredStore(unittest.TestCase):
+    def setUp(self):
+        self.state = wakeold2.state.State()
+        self.local = DirTier(self.state.create_temp_dir(prefix="local-").dir)
+        self.shared = DirTier(self.state.create_temp_dir(prefix="shared-").dir)
+        self.src = self.state.create_temp_dir(prefix="src-").dir
+
+    def tearDown(self):
+        self.state.cleanup()
+
+    def test_dir_tier(self):
+        libA = fake_pkg_ver("libA")
+        assert is_not_found(self.local.read_packages([libA])[0])
+
+        pkg_dir = create_pkg_dir(self.src, "libA")
+        pkg_path = self.local.create_package(pkg_dir, libA)
+        assert not os.path.exists(pkg_dir), "not kept"
+        assert self.local.read_packages([libA]) == [pkg_path]
+
+        # creating it again is a noop
+        pkg_dir = create_pkg_dir(self.src, "libA")
+        assert self.local.create_package(pkg_dir, libA, keep=True) == pkg_path
+        assert os.path.exists(pkg_dir), "kept"
+
+    def test_migrate_layout(self):
+        flat = self.state.create_temp_dir(prefix="flat-").dir
+        pkgVers = [fake_pkg_ver("lib{}".format(i)) for i in range(3)]
+        for v in pkgVers:
+            create_pkg_dir(flat, v.serialize())
+
+        tier = DirTier(flat)
+        assert tier.fanout == []
+        assert sorted(tier.list_pkg_vers()) == sorted(
+            v.serialize() for v in pkgVers)
+
+        tier.migrate_layout()
+        tier = DirTier(flat)
+        assert tier.fanout == [2]
+        for v in pkgVers:
+            assert tier.pkg_path(v) == os.path.join(flat, "01",
+                                                    v.serialize())
+        assert tier.read_packages(pkgVers) == [
+            tier.pkg_path(v) for v in pkgVers
+        ]
+        assert sorted(os.listdir(flat)) == [".wake", "01"]
+
+    def test_read_through(self):
+        libA = fake_pkg_ver("libA")
+        libB = fake_pkg_ver("libB")
+        self.shared.create_package(create_pkg_dir(self.src, "libA"), libA)
+
+        tiers = TieredStore(local=self.local, shared=self.shared)
+        result = tiers.read_packages([libA, libB])
+        assert result[0] == self.local.pkg_path(libA), "pulled up"
+        assert is_not_found(result[1])
+        assert os.path.exists(
+            os.path.join(self.local.pkg_path(libA), "README.txt"))
+
+    def test_write_back(self):
+        libA = fake_pkg_ver("libA")
+        tiers = TieredStore(local=self.local, shared=self.shared)
+        tiers.create_package(create_pkg_dir(self.src, "libA"), libA)
+        tiers.flush()
+        assert self.shared.read_packages([libA]) == [
+            self.shared.pkg_path(libA)
+        ]
+
+    def test_batch(self):
+        pkgVers = [fake_pkg_ver("lib{}".format(i)) for i in range(10)]
+        items = [(create_pkg_dir(self.src, "lib{}".format(i)), v)
+                 for i, v in enumerate(pkgVers)]
+        pkg_paths = self.local.create_packages(items[:5])
+        assert pkg_paths == [self.local.pkg_path(v) for v in pkgVers[:5]]
+
+        result = self.local.read_packages(pkgVers)
+        assert result[:5] == pkg_paths
+        assert all(is_not_found(r) for r in result[5:])
+        assert [r.pkgVer for r in result[5:]] == pkgVers[5:]
+
+    def test_filter_collisions(self):
+        libA, libB, libC = [fake_pkg_ver(n) for n in ("libA", "libB", "libC")]
+        self.local.create_packages([(create_pkg_dir(self.src, "libA"), libA),
+                                    (create_pkg_dir(self.src, "libB"), libB)])
+        # Force every key to collide, so libC is a false positive.
+        bfilter = BloomFilter(size=1, num_hashes=1)
+        for pkgVer in (libA, libB):
+            bfilter.add(pkgVer.serialize())
+        with open(self.local.filter.path, "wb") as fd:
+            fd.write(bfilter.serialize())
+        assert libC.serialize() in self.local.filter.refresh()
+
+        self.local.remove_package(libC)
+        assert self.local.quarantine_package(libC) is None
+        self.local.remove_package(libA)
+        DirTier(self.local.dir).remove_package(libA)
+        assert self.local.read_packages([libB]) == [
+            self.local.pkg_path(libB)
+        ], "only the removed packages left the filter"
+        assert is_not_found(self.local.read_packages([libA])[0])
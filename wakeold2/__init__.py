@@ -18,10 +18,20 @@
 """wake software's true potential"""
 from __future__ import unicode_literals
 
+from . import bloom
 from . import constants
 from . import digest
+from . import exports
+from . import graph
+from . import index
+from . import ingest
 from . import load
 from . import pkg
+from . import resolve
+from . import scrub
+from . import semver
+from . import solve
 from . import state
 from . import store
+from . import tier
 from . import utils
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Bloom filters used by store tiers to answer "definitely not here"."""
+
+from __future__ import unicode_literals
+
+import contextlib
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from . import utils
+
+try:
+    import fcntl
+except ImportError:  # i.e. windows
+    fcntl = None
+
+_HEADER = struct.Struct(">4sIII")
+_MAGIC = b"WKBF"
+_MAX_COUNT = 255
+
+
+class BloomFilter(utils.SafeObject):
+    """A counting Bloom filter of strings.
+
+    Each slot is a one byte counter instead of a bit so that keys can be
+    removed again (i.e. when a package is garbage collected). A key which is
+    not `in` the filter was definitely never added.
+    """
+    def __init__(self, size, num_hashes, counters=None, count=0):
+        if counters is None:
+            counters = bytearray(size)
+        assert len(counters) == size
+        self.size = size
+        self.num_hashes = num_hashes
+        self.counters = counters
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """Create a filter sized for `capacity` keys at the `error_rate`."""
+        capacity = max(capacity, 1)
+        size = int(-capacity * math.log(error_rate) / (math.log(2)**2))
+        num_hashes = int(round(float(size) / capacity * math.log(2)))
+        return cls(size=max(size, 8), num_hashes=max(num_hashes, 1))
+
+    @property
+    def capacity(self):
+        """The number of keys the filter was sized for."""
+        return int(self.size * math.log(2) / self.num_hashes)
+
+    def add(self, key):
+        counters = self.counters
+        for i in self._indexes(key):
+            if counters[i] < _MAX_COUNT:
+                counters[i] += 1
+        self.count += 1
+
+    def remove(self, key):
+        """Remove a key which was previously added.
+
+        Removing a key which was never added but matches as a false positive
+        would decrement the counters of other keys, so callers must know
+        that it was added (i.e. it was on disk, see `tier.DirTier`).
+        """
+        counters = self.counters
+        indexes = self._indexes(key)
+        if not all(counters[i] for i in indexes):
+            return
+        for i in indexes:
+            # Saturated counters can never be decremented safely.
+            if counters[i] < _MAX_COUNT:
+                counters[i] -= 1
+        self.count = max(self.count - 1, 0)
+
+    def __contains__(self, key):
+        counters = self.counters
+        return all(counters[i] for i in self._indexes(key))
+
+    def _indexes(self, key):
+        # Double hashing: derive all the indexes from a single md5.
+        raw = hashlib.md5(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack(">QQ", raw)
+        h2 |= 1
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def serialize(self):
+        """Serialize to bytes."""
+        header = _HEADER.pack(_MAGIC, self.size, self.num_hashes, self.count)
+        return header + bytes(self.counters)
+
+    @classmethod
+    def deserialize(cls, data):
+        """Deserialize from bytes."""
+        magic, size, num_hashes, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("not a bloom filter")
+        counters = bytearray(data[_HEADER.size:])
+        if len(counters) != size:
+            raise ValueError("truncated bloom filter")
+        return cls(size=size,
+                   num_hashes=num_hashes,
+                   counters=counters,
+                   count=count)
+
+
+class FilterFile(utils.SafeObject):
+    """A `BloomFilter` published in a file for other processes to read.
+
+    The file is always replaced atomically (by rename) and is reloaded when
+    its inode or mtime changes. Writers hold an exclusive lock on
+    `<path>.lock` while they read, modify and publish the filter, so updates
+    from concurrent writers (in any process) are never lost.
+    """
+    def __init__(self, path, rebuild_keys=None):
+        """
+        path: where the filter is published.
+        rebuild_keys: function returning all of the keys, used when the
+            filter doesn't exist yet or has outgrown its capacity. If None the
+            filter is read-only and `refresh` returns None when the file is
+            missing or invalid.
+        """
+        self.path = path
+        self.rebuild_keys = rebuild_keys
+        self.filter = None
+        self.stamp = None
+        self.lock = threading.RLock()
+        self.lock_path = path + ".lock"
+        self._lock_fd = None
+        self._lock_depth = 0
+
+    def refresh(self):
+        """Reload the published filter if it changed, returning it."""
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+                stamp = (stat.st_ino, stat.st_mtime)
+            except OSError:
+                stamp = None
+
+            if stamp is None:
+                self.rebuild()
+            elif stamp != self.stamp:
+                with open(self.path, 'rb') as fd:
+                    data = fd.read()
+                try:
+                    self.filter = BloomFilter.deserialize(data)
+                    self.stamp = stamp
+                except (ValueError, struct.error):
+                    self.rebuild()
+            return self.filter
+
+    def rebuild(self, extra_keys=()):
+        """Rebuild the filter from all of the keys (and `extra_keys`) and
+        publish it."""
+        with self.lock:
+            if self.rebuild_keys is None:
+                self.filter = None
+                self.stamp = None
+                return
+
+            with self._write_lock():
+                keys = list(self.rebuild_keys()) + list(extra_keys)
+                bfilter = BloomFilter.for_capacity(max(2 * len(keys), 1024))
+                for key in keys:
+                    bfilter.add(key)
+                self.filter = bfilter
+                self._dump()
+
+    def add(self, key):
+        self.add_all([key])
+
+    def add_all(self, keys):
+        """Add many keys, publishing the filter once."""
+        with self._write_lock():
+            bfilter = self.refresh()
+            for key in keys:
+                bfilter.add(key)
+            if bfilter.count > bfilter.capacity:
+                # The keys may not be on disk yet (see
+                # `tier.DirTier.create_packages`).
+                self.rebuild(extra_keys=keys)
+            else:
+                self._dump()
+
+    def remove(self, key):
+        """Remove a key which was added (see `BloomFilter.remove`)."""
+        with self._write_lock():
+            self.refresh().remove(key)
+            self._dump()
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """Lock the filter against writers in this and other processes.
+
+        Reentrant: `add_all` can `rebuild` while holding it.
+        """
+        with self.lock:
+            if self._lock_depth == 0:
+                self._lock_fd = os.open(self.lock_path,
+                                        os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    # Closing the file releases the lock.
+                    os.close(self._lock_fd)
+                    self._lock_fd = None
+
+    def _dump(self):
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, 'wb') as fd:
+            fd.write(self.filter.serialize())
+            utils.closefd(fd)
+        os.rename(tmp, self.path)
+        stat = os.stat(self.path)
+        self.stamp = (stat.st_ino, stat.st_mtime)
+
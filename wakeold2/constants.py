@@ -91,6 +91,7 @@ T_OBJECT = _wakeConstants["T_OBJECT"]
 T_PKG = _wakeConstants["T_PKG"]
 T_MODULE = _wakeConstants["T_MODULE"]
 T_PATH_REF_PKG = _wakeConstants["T_PATH_REF_PKG"]
+T_NOT_FOUND = _wakeConstants["T_NOT_FOUND"]
 
 S_UNRESOLVED = _wakeConstants["S_UNRESOLVED"]
 S_DECLARED = _wakeConstants["S_DECLARED"]
@@ -99,16 +100,31 @@ S_COMPLETED = _wakeConstants["S_COMPLETED"]
 
 C_READ_PKGS = _wakeConstants["C_READ_PKGS"]
 C_READ_PKGS_REQ = _wakeConstants["C_READ_PKGS_REQ"]
+C_STORE_READ_PKGS = _wakeConstants["C_STORE_READ_PKGS"]
+C_STORE_CREATE_PKG = _wakeConstants["C_STORE_CREATE_PKG"]
+
+# Levels of a pkg's `depsReq`
+D_UNRESTRICTED = "unrestricted"
+D_RESTRICTED = "restricted"
+D_RESTRICTED_MAJOR = "restrictedMajor"
+D_RESTRICTED_MINOR = "restrictedMinor"
+D_GLOBAL = "global"
+
+# Identifier strings whose deserialized values are kept (see pkg.PkgVer).
+DESERIALIZE_CACHE_SIZE = 100000
 
 DIR_WAKE = _wakeConstants["DIR_WAKE"]
 FILE_WAKELIB = _wakeConstants["FILE_WAKELIB"]  #wake.libsonnet
 FILE_PKG_DEFAULT = _wakeConstants["FILE_PKG_DEFAULT"]  # PKG.libsonnet
 FILE_PKGS = _wakeConstants["FILE_PKGS"]
+FILE_PKGS_LOCKED = "pkgsLocked.json"
 FILE_RUN_DIGEST = "wakeRunDigest.jsonnet"
 FILE_RUN_EXPORT = "wakeRunExport.jsonnet"
+FILE_RUN_EXPORT_DEPS = "wakeRunExportDeps.jsonnet"
 
 # Commong paths and data
 PATH_WAKELIB = os.path.join(DIR_WAKELIB, FILE_WAKELIB)
 _load_template = lambda f: loadf(os.path.join(DIR_WAKELIB, f))
 RUN_DIGEST_TEMPLATE = _load_template(FILE_RUN_DIGEST)
 RUN_EXPORT_TEMPLATE = _load_template(FILE_RUN_EXPORT)
+RUN_EXPORT_DEPS_TEMPLATE = _load_template(FILE_RUN_EXPORT_DEPS)
@@ -30,6 +30,7 @@ import hashlib
 
 import six
 
+from . import constants
 from . import utils
 
 DIGEST_TYPES = {
@@ -47,8 +48,10 @@ def calc_digest(pkgDigest):
     return builder.build()
 
 
-class Digest(utils.TupleObject):
+class Digest(utils.IdentObject):
     """Serializable digest."""
+    __slots__ = ('digest', 'digest_type')
+    _fields = __slots__
     SEP = '.'
 
     def __init__(self, digest, digest_type):
@@ -56,14 +59,15 @@ class Digest(utils.TupleObject):
             raise ValueError(digest)
         if not isinstance(digest_type, six.text_type):
             raise ValueError(digest)
-
-        self.digest = digest
         if digest_type not in DIGEST_TYPES:
             raise ValueError("digest_type must be one of: {}".format(
                 list(DIGEST_TYPES.keys())))
-        self.digest_type = digest_type
+        digest, digest_type = utils.intern(digest), utils.intern(digest_type)
+        utils.setattr_ident(self, 'digest', digest)
+        utils.setattr_ident(self, 'digest_type', digest_type)
+        utils.setattr_ident(self, '_hash', hash((digest_type, digest)))
 
-    @classmethod
+    @utils.lru_deserialize(constants.DESERIALIZE_CACHE_SIZE)
     def deserialize(cls, string):
         digest_type, digest = string.split(cls.SEP, 1)
         return cls(
@@ -89,8 +93,12 @@ class Digest(utils.TupleObject):
 
 
 class DigestBuilder(utils.SafeObject):
-    """Build a digest from input files and directories."""
-    def __init__(self, pkg_dir, digest_type='md5'):
+    """Build a digest from input files and directories.
+
+    If given, `throttle.consume(nbytes=0, ops=0)` is called for every file
+    opened and every block read, and may sleep to limit the I/O rate.
+    """
+    def __init__(self, pkg_dir, digest_type='md5', throttle=None):
         assert os.path.isabs(pkg_dir)
         if digest_type not in DIGEST_TYPES:
             raise NotImplementedError(
@@ -100,6 +108,7 @@ class DigestBuilder(utils.SafeObject):
         self.digest_type = digest_type
         self.hash_func = DIGEST_TYPES[digest_type]
         self.hashmap = {}
+        self.throttle = throttle
 
     def update_paths(self, paths):
         paths = sorted(paths)
@@ -142,11 +151,16 @@ class DigestBuilder(utils.SafeObject):
         assert os.path.isabs(fpath)
         hasher = self.hash_func()
         blocksize = 64 * 1024
+        throttle = self.throttle
         with open(fpath, 'rb') as fp:
+            if throttle:
+                throttle.consume(ops=1)
             while True:
                 data = fp.read(blocksize)
                 if not data:
                     break
+                if throttle:
+                    throttle.consume(nbytes=len(data), ops=1)
                 hasher.update(data)
         pkey = os.path.relpath(fpath, self.pkg_dir)
         self.hashmap[pkey] = hasher.hexdigest()
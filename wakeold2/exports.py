@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""A persistent cache of manifested package exports.
+
+Exports are cached by a package's own pkgVer and the *fingerprints* of its
+dependencies, which cover everything its export function can see of them
+(see `as_dep`): their pkgVer, paths, export and (recursively) deps.
+
+The digests of the deps' pkgVers are replaced by placeholders while the
+export is evaluated, fingerprinted and cached (see `mask_digests`), and put
+back into the result. So a dependency whose digest changes but whose export
+doesn't (i.e. its README is edited) doesn't invalidate its dependents, even
+when they use its pkgVer (i.e. through `wake.pathRef`). Digests are opaque:
+an export can pass them around, but must not compute with them.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import six
+
+from . import constants
+from . import pkg
+from . import utils
+
+# Replaces the digests of the deps' pkgVers, see `mask_digests`.
+DIGEST_PLACEHOLDER = "__WAKE_DIGEST_{}__"
+
+
+def request_keys(pkgDeclared):
+    """Return the `pkgsDefined` keys of every request of the package."""
+    return [key for _, _, key in request_items(pkgDeclared)]
+
+
+def request_items(pkgDeclared):
+    """Return `(lvl, name, requestKey)` of every request of the package."""
+    out = []
+    for lvl, reqs in sorted(six.iteritems(pkgDeclared.depsReq)):
+        for name, req in sorted(six.iteritems(reqs)):
+            key = pkg.PkgRequest(pkgDeclared.pkgVer,
+                                 pkg.PkgReq.deserialize(req)).serialize()
+            out.append((lvl, name, key))
+    return out
+
+
+def resolved_deps(pkgDeclared, pkgsDefined):
+    """Return the `{requestKey: PkgDeclared}` of the package's transitive
+    dependencies.
+
+    Raises KeyError if a request is not in `pkgsDefined`.
+    """
+    out = {}
+    visited = set()
+    todo = [pkgDeclared]
+    while todo:
+        current = todo.pop()
+        if current.pkgVer in visited:
+            continue
+        visited.add(current.pkgVer)
+        for key in request_keys(current):
+            dep = pkgsDefined[key]
+            out[key] = dep
+            todo.append(dep)
+    return out
+
+
+class ExportCache(utils.SafeObject):
+    """Cache of manifested `PkgExport`s shared by every build on the host.
+
+    An export is determined by its package and the packages its requests
+    resolved to, so entries are keyed by the pkgVer and the `fingerprint` of
+    each dependency (see `key`). Entries are kept in memory
+    and as json files in `directory`, which are replaced atomically.
+
+    Concurrent requests for the same key wait for a single evaluation.
+    """
+    def __init__(self, directory):
+        self.dir = directory
+        self.memory = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(pkgVer, fingerprints):
+        """The key of a pkgVer with its `{requestKey: fingerprint}`."""
+        value = [pkgVer.serialize(), sorted(six.iteritems(fingerprints))]
+        return hashlib.md5(canonical_json(value)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key + ".json")
+
+    def get(self, key, pkg_file):
+        """Get the cached export (for the package at pkg_file) or None."""
+        with self.lock:
+            cached = self.memory.get(key)
+        if cached is not None:
+            return pkg.PkgExport.deserialize(cached, pkg_file=pkg_file)
+
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            cached = utils.jsonloadf(path)
+            result = pkg.PkgExport.deserialize(cached, pkg_file=pkg_file)
+        except (ValueError, KeyError, TypeError):
+            return None
+        with self.lock:
+            self.memory[key] = cached
+        return result
+
+    def put(self, key, pkgExport):
+        cached = pkgExport.serialize()
+        path = self.path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(),
+                                    threading.current_thread().ident)
+        utils.jsondumpf(tmp, cached)
+        os.rename(tmp, path)
+        with self.lock:
+            self.memory[key] = cached
+
+    def get_or_load(self, key, pkg_file, load_fn):
+        """Get the cached export, calling `load_fn()` to load it if missing."""
+        while True:
+            result = self.get(key, pkg_file)
+            if result is not None:
+                return result
+
+            with self.lock:
+                if key in self.memory:
+                    # Put after our `get`, but before we took the lock.
+                    continue
+                event = self.pending.get(key)
+                if event is None:
+                    self.pending[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            result = load_fn()
+            self.put(key, result)
+            return result
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+
+def fingerprint(dep):
+    """Return the fingerprint of a manifested dep (see `as_dep`).
+
+    It is the hash of its canonical json, so the deps must be masked (see
+    `mask_digests`) for digest-only changes to keep the fingerprint.
+    """
+    return hashlib.md5(canonical_json(dep)).hexdigest()
+
+
+def as_dep(pkgExport):
+    """Return a PkgExport as it is manifested in the `deps` of its requester.
+
+    Keys are sorted (recursively) like jsonnet's manifest, so the result is
+    identical to the dep produced by the `exportTree` path.
+    """
+    dct = pkgExport.serialize()
+    del dct['pkg_file']
+    dct[constants.F_TYPE] = constants.T_PKG
+    dct[constants.F_STATE] = constants.S_DECLARED
+    return json.loads(canonical_json(dct).decode('utf-8'),
+                      object_pairs_hook=collections.OrderedDict)
+
+
+def mask_digests(deps):
+    """Replace the digests of every pkgVer in the manifested deps by
+    placeholders.
+
+    Returns `(masked, digests)`, where `digests` are the serialized digests
+    of the placeholders (see `unmask_digests`). Placeholders are numbered in
+    the canonical order of the deps, and equal digests get equal
+    placeholders.
+    """
+    digests = []
+    _collect_digests(deps, digests)
+    replace = [(d, DIGEST_PLACEHOLDER.format(i))
+               for i, d in enumerate(digests)]
+    return _replace_strings(deps, replace), digests
+
+
+def unmask_digests(pkgExport, digests):
+    """Return the PkgExport with the placeholders of `digests` (see
+    `mask_digests`) replaced by the digests."""
+    if not digests:
+        return pkgExport
+    replace = [(DIGEST_PLACEHOLDER.format(i), d)
+               for i, d in enumerate(digests)]
+    return pkg.PkgExport.deserialize(
+        _replace_strings(pkgExport.serialize(), replace),
+        pkg_file=pkgExport.pkg_file)
+
+
+def _collect_digests(value, digests):
+    if isinstance(value, dict):
+        if (value.get(constants.F_TYPE) == constants.T_PKG
+                and isinstance(value.get('pkgVer'), six.text_type)):
+            digest = pkg.PkgVer.deserialize(
+                value['pkgVer']).digest.serialize()
+            if digest not in digests:
+                digests.append(digest)
+        for key in sorted(value):
+            _collect_digests(value[key], digests)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_digests(item, digests)
+
+
+def _replace_strings(value, replace):
+    if isinstance(value, six.text_type):
+        for old, new in replace:
+            value = value.replace(old, new)
+        return value
+    if isinstance(value, dict):
+        return collections.OrderedDict(
+            (_replace_strings(k, replace), _replace_strings(v, replace))
+            for k, v in six.iteritems(value))
+    if isinstance(value, list):
+        return [_replace_strings(v, replace) for v in value]
+    return value
+
+
+def canonical_json(value):
+    """Encode a value as json bytes which are equal for equal values."""
+    return json.dumps(value, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""A compact dependency graph of pkgVers.
+
+PkgVers are interned to integer ids (in the order they were added) and the
+edges are kept in CSR (compressed sparse row) arrays: the deps of node `n`
+are `targets[offsets[n]:offsets[n + 1]]`, each tagged with the index of its
+level (see `LEVELS`) in `levels`. The reverse graph is built on first use.
+
+Every query is linear in the size of the graph.
+"""
+
+from __future__ import unicode_literals
+
+import array
+import collections
+
+import six
+
+from . import constants
+from . import utils
+
+LEVELS = (
+    constants.D_UNRESTRICTED,
+    constants.D_RESTRICTED,
+    constants.D_RESTRICTED_MAJOR,
+    constants.D_RESTRICTED_MINOR,
+    constants.D_GLOBAL,
+)
+_LEVEL_INDEX = {lvl: i for i, lvl in enumerate(LEVELS)}
+
+_ID_TYPE = 'i'
+_OFFSET_TYPE = 'l'
+
+
+class CycleError(ValueError):
+    """The graph has a cycle, `cycle` is its list of pkgVers."""
+    def __init__(self, msg, cycle):
+        super(CycleError, self).__init__(msg)
+        self.cycle = cycle
+
+
+class GraphBuilder(utils.SafeObject):
+    """Collect the nodes and edges of a `DepGraph`."""
+    def __init__(self):
+        self.ids = {}
+        self.nodes = []
+        self.sources = array.array(_ID_TYPE)
+        self.targets = array.array(_ID_TYPE)
+        self.levels = array.array('B')
+
+    def add_node(self, pkgVer):
+        """Return the id of the pkgVer, adding it if it is new."""
+        node = self.ids.get(pkgVer)
+        if node is None:
+            node = len(self.nodes)
+            self.ids[pkgVer] = node
+            self.nodes.append(pkgVer)
+        return node
+
+    def add_edge(self, pkgVer, dep, lvl):
+        """Add that pkgVer depends on dep at the level `lvl`."""
+        self.sources.append(self.add_node(pkgVer))
+        self.targets.append(self.add_node(dep))
+        self.levels.append(_LEVEL_INDEX[lvl])
+
+    def build(self):
+        offsets, order = _csr(len(self.nodes), self.sources)
+        return DepGraph(
+            ids=self.ids,
+            nodes=self.nodes,
+            offsets=offsets,
+            targets=array.array(_ID_TYPE, [self.targets[i] for i in order]),
+            levels=array.array('B', [self.levels[i] for i in order]),
+        )
+
+
+class DepGraph(utils.SafeObject):
+    """An immutable dependency graph in CSR form (see `GraphBuilder`)."""
+    def __init__(self, ids, nodes, offsets, targets, levels):
+        self.ids = ids
+        self.nodes = nodes
+        self.offsets = offsets
+        self.targets = targets
+        self.levels = levels
+        self._reverse = None
+
+    @classmethod
+    def from_resolution(cls, resolver, roots, chosen):
+        """Build the graph of what the roots resolved to.
+
+        resolver: the `resolve.Resolver` (for the requests of each pkgVer).
+        chosen: the `{requestKey: pkgVer}` of the resolution.
+        """
+        builder = GraphBuilder()
+        todo = collections.deque(roots)
+        for root in roots:
+            builder.add_node(root)
+        while todo:
+            pkgVer = todo.popleft()
+            for lvl, _, _, key, _ in resolver.requests[pkgVer]:
+                dep = chosen[key]
+                if dep not in builder.ids:
+                    todo.append(dep)
+                builder.add_edge(pkgVer, dep, lvl)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    def deps(self, node, levels=None):
+        """Return the ids of the direct deps of the node.
+
+        levels: if given, only the deps at these levels.
+        """
+        start, end = self.offsets[node], self.offsets[node + 1]
+        if levels is None:
+            return self.targets[start:end].tolist()
+        wanted = {_LEVEL_INDEX[lvl] for lvl in levels}
+        return [
+            self.targets[i] for i in range(start, end)
+            if self.levels[i] in wanted
+        ]
+
+    def dependents(self, node):
+        """Return the ids of the nodes which directly depend on the node."""
+        offsets, sources = self._reversed()
+        return sources[offsets[node]:offsets[node + 1]].tolist()
+
+    def reachable(self, roots, levels=None):
+        """Return the ids of the nodes reachable from the root ids
+        (including the roots), following only the given levels if any."""
+        wanted = None
+        if levels is not None:
+            wanted = {_LEVEL_INDEX[lvl] for lvl in levels}
+        return _walk(self.offsets, self.targets, roots,
+                     self.levels if wanted is not None else None, wanted)
+
+    def dependents_of(self, nodes):
+        """Return the ids of the nodes which (transitively) depend on the
+        nodes, including them."""
+        offsets, sources = self._reversed()
+        return _walk(offsets, sources, nodes)
+
+    def topological_order(self):
+        """Return the ids with every node after all of its deps.
+
+        Raises CycleError if there is a cycle.
+        """
+        order, cycle = self._postorder()
+        if cycle is not None:
+            raise CycleError(
+                "dependency cycle: {}".format(" -> ".join(
+                    six.text_type(self.nodes[n]) for n in cycle)),
+                [self.nodes[n] for n in cycle])
+        return order
+
+    def find_cycle(self):
+        """Return the ids of a cycle (the first node repeated last) or None.
+        """
+        return self._postorder()[1]
+
+    def _postorder(self):
+        """Depth first search, returning the nodes in post-order (deps first)
+        and the first cycle found (or None)."""
+        offsets, targets = self.offsets, self.targets
+        # 0: not visited, 1: on the stack, 2: done
+        state = bytearray(len(self.nodes))
+        order = []
+        for start in range(len(self.nodes)):
+            if state[start]:
+                continue
+            state[start] = 1
+            nodes = [start]
+            edges = [offsets[start]]
+            while nodes:
+                node = nodes[-1]
+                i = edges[-1]
+                if i == offsets[node + 1]:
+                    state[node] = 2
+                    order.append(node)
+                    nodes.pop()
+                    edges.pop()
+                    continue
+                edges[-1] = i + 1
+                dep = targets[i]
+                if not state[dep]:
+                    state[dep] = 1
+                    nodes.append(dep)
+                    edges.append(offsets[dep])
+                elif state[dep] == 1:
+                    return order, nodes[nodes.index(dep):] + [dep]
+        return order, None
+
+    def to_networkx(self):
+        """Export to a `networkx.MultiDiGraph` of pkgVers, with the level of
+        each edge in its `lvl` attribute."""
+        import networkx  # pylint: disable=import-error
+        graph = networkx.MultiDiGraph()
+        graph.add_nodes_from(self.nodes)
+        offsets, targets, levels = self.offsets, self.targets, self.levels
+        for node, pkgVer in enumerate(self.nodes):
+            for i in range(offsets[node], offsets[node + 1]):
+                graph.add_edge(pkgVer, self.nodes[targets[i]],
+                               lvl=LEVELS[levels[i]])
+        return graph
+
+    def _reversed(self):
+        if self._reverse is None:
+            offsets = self.offsets
+            sources = array.array(_ID_TYPE)
+            for node in range(len(self.nodes)):
+                sources.extend([node] * (offsets[node + 1] - offsets[node]))
+            rev_offsets, order = _csr(len(self.nodes), self.targets)
+            self._reverse = (rev_offsets,
+                             array.array(_ID_TYPE, [sources[i]
+                                                    for i in order]))
+        return self._reverse
+
+
+def _csr(num_nodes, sources):
+    """Counting sort of edges by their source.
+
+    Returns the offsets and the order of the edges (a stable permutation).
+    """
+    offsets = array.array(_OFFSET_TYPE, [0]) * (num_nodes + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for node in range(num_nodes):
+        offsets[node + 1] += offsets[node]
+    position = offsets[:-1]
+    order = array.array(_OFFSET_TYPE, [0]) * len(sources)
+    for edge, source in enumerate(sources):
+        order[position[source]] = edge
+        position[source] += 1
+    return offsets, order
+
+
+def _walk(offsets, targets, roots, levels=None, wanted=None):
+    seen = bytearray(len(offsets) - 1)
+    out = []
+    for root in roots:
+        if not seen[root]:
+            seen[root] = 1
+            out.append(root)
+    i = 0
+    while i < len(out):
+        node = out[i]
+        i += 1
+        for j in range(offsets[node], offsets[node + 1]):
+            if levels is not None and levels[j] not in wanted:
+                continue
+            target = targets[j]
+            if not seen[target]:
+                seen[target] = 1
+                out.append(target)
+    return out
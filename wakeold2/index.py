@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""A sparse registry index of the versions of packages and their requests.
+
+There is one file per pkgName, at a path sharded by the prefix of the name
+(like cargo's sparse index):
+
+    <namespace>/1/a
+    <namespace>/2/ab
+    <namespace>/3/a/abc
+    <namespace>/ab/cd/abcdef
+
+Each line of a file is a version record, sorted by version:
+
+    <version> TAB <digest> TAB <json depsReq> NEWLINE
+
+Files are read through `mmap` and searched by bisecting the byte offsets, so
+finding the versions matching a request only parses the matching records.
+`load_requested` fetches only the files of the pkgNames a graph references.
+
+An index is served from a local directory (`RegistryIndex`) or over http
+(`HttpIndex`, which caches the files it fetched; see `serve` for a local
+stand-in).
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import json
+import mmap
+import os
+import threading
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import SimpleHTTPServer
+from six.moves import urllib
+
+from . import digest
+from . import pkg
+from . import semver
+from . import utils
+
+_SEP = b"\t"
+_NEWLINE = b"\n"
+
+
+def name_path(pkgName):
+    """Return the relative path of the index file of a pkgName."""
+    name = pkgName.name
+    if len(name) <= 2:
+        prefix = [six.text_type(len(name))]
+    elif len(name) == 3:
+        prefix = ["3", name[0]]
+    else:
+        prefix = [name[:2], name[2:4]]
+    return "/".join([pkgName.namespace] + prefix + [name])
+
+
+def format_record(pkgVer, depsReq):
+    """Return the line of a version record."""
+    return _SEP.join([
+        pkgVer.version.encode('utf-8'),
+        pkgVer.digest.serialize().encode('utf-8'),
+        json.dumps(depsReq, sort_keys=True,
+                   ensure_ascii=False).encode('utf-8'),
+    ]) + _NEWLINE
+
+
+class IndexFile(utils.SafeObject):
+    """The sorted version records of a pkgName, read through mmap."""
+    def __init__(self, pkgName, path):
+        self.pkgName = pkgName
+        self.path = path
+        self.data = b""
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as fd:
+                self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def records(self):
+        """Return every `(pkgVer, depsReq)`, oldest first."""
+        return list(self._read(0, len(self.data)))
+
+    def matching(self, ranges):
+        """Return the `(pkgVer, depsReq)` in the ranges, latest first."""
+        out = []
+        for rng in reversed(ranges):
+            start = 0 if rng.low is None else self._bisect(
+                rng.low.key, right=not rng.low_inclusive)
+            end = len(self.data) if rng.high is None else self._bisect(
+                rng.high.key, right=rng.high_inclusive)
+            if start < end:
+                out.extend(reversed(list(self._read(start, end))))
+        return out
+
+    def _bisect(self, key, right=False):
+        """Return the offset of the first line whose version is >= key
+        (or > key if right)."""
+        data = self.data
+        low, high = 0, len(data)
+        while low < high:
+            mid = (low + high) // 2
+            start = data.rfind(_NEWLINE, 0, mid) + 1
+            end = data.find(_SEP, start)
+            version = semver.parse_version(data[start:end].decode('utf-8'))
+            if version.key < key or (right and version.key == key):
+                low = data.find(_NEWLINE, start) + 1
+            else:
+                high = start
+        return low
+
+    def _read(self, start, end):
+        data = self.data
+        while start < end:
+            line_end = data.find(_NEWLINE, start)
+            version, digest_str, depsReq = data[start:line_end].split(_SEP, 2)
+            yield pkg.PkgVer(
+                namespace=self.pkgName.namespace,
+                name=self.pkgName.name,
+                version=version.decode('utf-8'),
+                digest=digest.Digest.deserialize(digest_str.decode('utf-8')),
+            ), json.loads(depsReq.decode('utf-8'))
+            start = line_end + 1
+
+
+class RegistryIndex(utils.SafeObject):
+    """An index in a local directory."""
+    def __init__(self, directory):
+        self.dir = directory
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def path(self, pkgName):
+        return os.path.join(self.dir, *name_path(pkgName).split("/"))
+
+    def get(self, pkgName):
+        """Return the (cached) IndexFile of a pkgName."""
+        with self.lock:
+            index_file = self.files.get(pkgName)
+            if index_file is None:
+                index_file = IndexFile(pkgName, self.fetch(pkgName))
+                self.files[pkgName] = index_file
+            return index_file
+
+    def fetch(self, pkgName):
+        """Return the local path of the pkgName's file."""
+        return self.path(pkgName)
+
+    def add(self, pkgVer, depsReq):
+        """Add a version record, keeping the file sorted."""
+        pkgName = pkg.PkgName(pkgVer.namespace, pkgVer.name)
+        path = self.path(pkgName)
+        record = format_record(pkgVer, depsReq)
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'rb') as fd:
+                lines = fd.read().splitlines(True)
+        if record in lines:
+            return
+        lines.append(record)
+        lines.sort(key=_record_key)
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as fd:
+            fd.write(b"".join(lines))
+            utils.closefd(fd)
+        with self.lock:
+            index_file = self.files.pop(pkgName, None)
+        if index_file is not None:
+            index_file.close()
+        os.rename(tmp, path)
+
+    def add_declared(self, pkgDeclared):
+        self.add(pkgDeclared.pkgVer, pkgDeclared.depsReq)
+
+
+class HttpIndex(RegistryIndex):
+    """An index served over http, cached in a local directory.
+
+    Each file is downloaded once per HttpIndex (i.e. per build).
+    """
+    def __init__(self, url, cache_dir):
+        super(HttpIndex, self).__init__(cache_dir)
+        self.url = url.rstrip("/")
+
+    def fetch(self, pkgName):
+        path = self.path(pkgName)
+        url = "{}/{}".format(self.url,
+                             urllib.parse.quote(name_path(pkgName).encode(
+                                 'utf-8')))
+        try:
+            response = urllib.request.urlopen(url)
+        except urllib.error.HTTPError as err:
+            if err.code == 404:
+                return path
+            raise
+        try:
+            data = response.read()
+        finally:
+            response.close()
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = "{}.{}.tmp".format(path, threading.current_thread().ident)
+        with open(tmp, 'wb') as fd:
+            fd.write(data)
+        os.rename(tmp, path)
+        return path
+
+    def add(self, pkgVer, depsReq):
+        raise TypeError("an HttpIndex is read only")
+
+
+def serve(directory, port=0, host="127.0.0.1"):
+    """Serve the index in the directory over http, in a daemon thread.
+
+    Returns the server; its url is `http://host:server.server_port`.
+    """
+    directory = os.path.abspath(directory)
+
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = urllib.parse.unquote(path.split('?', 1)[0])
+            parts = [p for p in path.split('/') if p not in ('', '.', '..')]
+            return os.path.join(directory, *parts)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="wake-index")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def load_requested(index, resolver, roots):
+    """Add the versions matching the requests reachable from the roots to the
+    resolver. Only the files of referenced pkgNames are read.
+
+    roots: the root pkgVers, which must already be in the resolver.
+
+    Returns the pkgNames which were read.
+    """
+    seen = set(roots)
+    touched = set()
+    todo = collections.deque(roots)
+
+    while todo:
+        for _, pkgName, req, _, ranges in resolver.requests[todo.popleft()]:
+            if req in seen:
+                continue
+            seen.add(req)
+            touched.add(pkgName)
+            for pkgVer, depsReq in index.get(pkgName).matching(ranges):
+                if pkgVer in seen:
+                    continue
+                seen.add(pkgVer)
+                resolver.add_pkg(pkgVer, depsReq)
+                todo.append(pkgVer)
+    return touched
+
+
+def _record_key(line):
+    return semver.parse_version(
+        line.split(_SEP, 1)[0].decode('utf-8')).key, line
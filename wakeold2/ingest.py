@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Bulk ingest of many packages into a store.
+
+Ingesting is a pipeline of stages connected by bounded queues:
+
+    discover -> evaluate -> hash -> copy -> verify
+
+Each stage has its own worker threads, so the jsonnet evaluation of one
+package overlaps with the hashing of another and the copying of a third.
+The copy stage works on batches of whatever is queued, so the packages of a
+batch are created (and synced) together.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+
+from six.moves import queue
+
+from . import constants
+from . import digest
+from . import load
+from . import pkg
+from . import utils
+
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_WORKERS = {
+    "evaluate": 4,
+    "hash": 2,
+    "copy": 2,
+    "verify": 4,
+}
+DEFAULT_BATCH_SIZES = {
+    "copy": 16,
+}
+
+_DONE = object()
+
+
+class Stage(utils.SafeObject):
+    """A stage of a `Pipeline`.
+
+    `func` is called by `workers` threads on every item of the stage's input
+    queue. It returns the item for the next stage, or None to drop it.
+
+    If `batch_size` is more than 1, `func` is instead called with a list of
+    up to `batch_size` items which are already queued, and returns a list
+    of results in the same order. A result which is an exception fails its
+    item.
+    """
+    def __init__(self, name, func, workers=1, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.start_time = None
+        self.end_time = None
+
+    def stats(self):
+        """Return the throughput and queue depth of the stage."""
+        with self.lock:
+            start = self.start_time
+            end = self.end_time or time.time()
+            elapsed = end - start if start is not None else 0
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "queueDepth": self.queue.qsize(),
+                "perSec": self.processed / elapsed if elapsed else 0.0,
+            }
+
+
+class Pipeline(utils.SafeObject):
+    """Run items through a sequence of `Stage`s.
+
+    Failures of individual items are collected in `errors` as
+    `(stage name, item, exception)` and do not stop the pipeline.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.outputs = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def run(self, items):
+        """Feed the items into the first stage and wait for all stages.
+
+        Returns the outputs of the last stage (in no particular order).
+        """
+        threads = []
+        for i, stage in enumerate(self.stages):
+            nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            stage.running = stage.workers
+            stage.start_time = time.time()
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, nxt),
+                    name="wake-{}".format(stage.name),
+                )
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        first = self.stages[0].queue
+        for item in items:
+            first.put(item)
+        _put_done(self.stages[0])
+
+        for thread in threads:
+            thread.join()
+        return self.outputs
+
+    def stats(self):
+        """Return the stats of every stage. Can be called while running."""
+        return [stage.stats() for stage in self.stages]
+
+    def _work(self, stage, nxt):
+        done = False
+        while not done:
+            item = stage.queue.get()
+            if item is _DONE:
+                break
+
+            items = [item]
+            while len(items) < stage.batch_size:
+                try:
+                    item = stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                items.append(item)
+
+            try:
+                if stage.batch_size > 1:
+                    outs = stage.func(items)
+                else:
+                    outs = [stage.func(items[0])]
+            except (Exception, SystemExit) as err:  # pylint: disable=broad-except
+                # SystemExit: jsonnet failures go through `utils.fail`.
+                outs = [err] * len(items)
+
+            for item, out in zip(items, outs):
+                self._emit(stage, nxt, item, out)
+
+        # The last worker out tells the next stage.
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+            if last:
+                stage.end_time = time.time()
+        if last and nxt is not None:
+            _put_done(nxt)
+
+
+    def _emit(self, stage, nxt, item, out):
+        if isinstance(out, (Exception, SystemExit)):
+            with stage.lock:
+                stage.failed += 1
+            with self.lock:
+                self.errors.append((stage.name, item, out))
+            return
+
+        with stage.lock:
+            stage.processed += 1
+        if out is None:
+            return
+        if nxt is None:
+            with self.lock:
+                self.outputs.append(out)
+        else:
+            nxt.queue.put(out)
+
+
+def _put_done(stage):
+    """Tell every worker of the stage that there are no more items."""
+    for _ in range(stage.workers):
+        stage.queue.put(_DONE)
+
+
+class Ingest(utils.SafeObject):
+    """Ingest every package found in a directory into a `store.Store`.
+
+    `workers` overrides the number of threads of a stage by name (see
+    `DEFAULT_WORKERS`), as `batch_sizes` does for the size of its batches
+    (see `DEFAULT_BATCH_SIZES`). `stats()` can be polled from another thread
+    while `run` is in progress.
+    """
+    def __init__(self, store, workers=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_sizes=None):
+        self.store = store
+        self.state = store.state
+        self.discovered = 0
+        counts = dict(DEFAULT_WORKERS)
+        counts.update(workers or {})
+        sizes = dict(DEFAULT_BATCH_SIZES)
+        sizes.update(batch_sizes or {})
+        self.pipeline = Pipeline([
+            Stage(name,
+                  getattr(self, "_" + name),
+                  counts[name],
+                  queue_size,
+                  batch_size=sizes.get(name, 1))
+            for name in ("evaluate", "hash", "copy", "verify")
+        ])
+
+    def run(self, directory):
+        """Ingest the packages under the directory, returning their
+        PkgDeclared (in no particular order).
+
+        Packages which failed are in `self.errors`.
+        """
+        return self.pipeline.run(self._discover(directory))
+
+    @property
+    def errors(self):
+        return self.pipeline.errors
+
+    def stats(self):
+        """Return the stats of discovery and of every stage."""
+        return [{
+            "name": "discover",
+            "processed": self.discovered,
+        }] + self.pipeline.stats()
+
+    def _discover(self, directory):
+        for pkg_file in discover_pkg_files(directory):
+            self.discovered += 1
+            yield pkg_file
+
+    def _evaluate(self, pkg_file):
+        return load.loadPkgUnhashed(self.state, pkg_file)
+
+    def _hash(self, unhashed):
+        pkgVer = unhashed.pkgVer
+        return unhashed, pkg.PkgVer(
+            namespace=pkgVer.namespace,
+            name=pkgVer.name,
+            version=pkgVer.version,
+            digest=digest.calc_digest(unhashed),
+        )
+
+    def _copy(self, items):
+        """Copy a batch of packages into the local tier with a single
+        `create_packages`."""
+        out = [None] * len(items)
+        existing = self.store.tiers.read_packages(
+            [pkgVer for _, pkgVer in items])
+        create = []
+        staging = self.state.create_temp_dir(prefix="ingest-")
+        try:
+            for i, (unhashed, pkgVer) in enumerate(items):
+                if (pkgVer in self.store.packages
+                        or not pkg.is_not_found(existing[i])):
+                    out[i] = (pkgVer, None)
+                    continue
+
+                pkg_dir = os.path.join(staging.dir, str(i))
+                try:
+                    os.mkdir(pkg_dir)
+                    for path in unhashed.paths:
+                        utils.copytree(utils.pjoin(unhashed.pkg_dir, path),
+                                       utils.pjoin(pkg_dir, path))
+                except (IOError, OSError) as err:
+                    out[i] = err
+                    continue
+                create.append((i, pkg_dir, pkgVer))
+
+            pkg_paths = self.store.tiers.local.create_packages(
+                [(pkg_dir, pkgVer) for _, pkg_dir, pkgVer in create])
+            for (i, _, pkgVer), pkg_path in zip(create, pkg_paths):
+                out[i] = (pkgVer, pkg_path)
+            return out
+        finally:
+            staging.cleanup()
+
+    def _verify(self, item):
+        pkgVer, pkg_dir = item
+        if pkg_dir is None:
+            # Already cached or in a tier: verified (cheaply) by reading it.
+            return self.store.read_pkg(pkgVer)
+        return self.store.verify_created(pkgVer, pkg_dir)
+
+
+def discover_pkg_files(directory):
+    """Yield the PKG files under the directory.
+
+    The tree of a package is its own: the packages nested in it are not
+    discovered. Evaluating one writes a placeholder digest into the tree
+    while the outer package may be hashed.
+    """
+    for root, dirs, files in utils.walk(directory):
+        if constants.FILE_PKG_DEFAULT in files:
+            dirs[:] = []
+            yield os.path.join(root, constants.FILE_PKG_DEFAULT)
+            continue
+        # Never descend into wake's own directories.
+        dirs[:] = sorted(d for d in dirs if d != constants.DIR_WAKE)
@@ -19,6 +19,7 @@
 
 from __future__ import unicode_literals
 
+import json
 import os
 
 import six
@@ -27,6 +28,7 @@ from . import constants
 from . import utils
 from . import pkg
 from . import digest
+from . import exports
 
 
 def loadPkgDeclared(state, pkg_file, calc_digest=False, cleanup=True):
@@ -51,21 +53,15 @@ def loadPkgDeclared(state, pkg_file, calc_digest=False, cleanup=True):
         utils.dumpf(run_digest_path, run_digest_text)
 
         # Get a pkgDeclared with (potentially) the wrong digest value
-        pkgDeclared = pkg.PkgDeclared.deserialize(
-            utils.manifest_jsonnet(run_digest_path),
-            pkg_file=pkg_file,
-        )
+        pkgDeclared = _manifest_declared(run_digest_path, pkg_file)
 
         if calc_digest:
             # Dump real `.digest.json`
             digest_value = digest.calc_digest(pkgDeclared)
             utils.jsondumpf(digest_path, digest_value.serialize())
 
-            pkgDeclared = pkg.PkgDeclared.deserialize(
-                utils.manifest_jsonnet(run_digest_path),
-                pkg_file=pkg_file,
-            )
-            assert pkgDeclared.digest == digest_value
+            pkgDeclared = _manifest_declared(run_digest_path, pkg_file)
+            assert pkgDeclared.pkgVer.digest == digest_value
 
         return pkgDeclared
     finally:
@@ -74,13 +70,39 @@ def loadPkgDeclared(state, pkg_file, calc_digest=False, cleanup=True):
         state_dir.cleanup()
 
 
+def loadPkgUnhashed(state, pkg_file):
+    """Load a package with a fake digest, returning PkgDeclared.
+
+    Only the paths are valid, the digest of its pkgVer is fake. This lets the
+    (slow) evaluation and hashing of a package happen separately, see
+    `digest.calc_digest`.
+    """
+    pkg_dir = os.path.dirname(pkg_file)
+    digest_path = os.path.join(pkg_dir, constants.DEFAULT_FILE_DIGEST)
+
+    state_dir = state.create_temp_dir()
+    try:
+        utils.jsondumpf(digest_path, digest.Digest.fake().serialize())
+        run_digest_path = os.path.join(state_dir.dir,
+                                       constants.FILE_RUN_DIGEST)
+        utils.dumpf(run_digest_path, utils.format_run_digest(pkg_file))
+        return _manifest_declared(run_digest_path, pkg_file)
+    finally:
+        if os.path.exists(digest_path):
+            os.remove(digest_path)
+        state_dir.cleanup()
+
+
 def loadPkgExport(state, pkgsDefined, pkgDeclared):
     """Load the exports of the package.
 
     Params:
     State state: used to create a temporary directory for storing the
         custom-created jsonnet running script.
-    storeMap: dictionary of the expected lookup keys to the location of their PKG files.
+    pkgsDefined: dictionary of the expected lookup keys (see `PkgRequest`) to
+        the PkgDeclared they resolved to. Only the transitive closure of the
+        package's requests is dumped for jsonnet, so it can be the resolved
+        map of a whole workspace.
     """
 
     pkgs_defined_path = None
@@ -89,12 +111,10 @@ def loadPkgExport(state, pkgsDefined, pkgDeclared):
         # Dump the dependencies
         pkgs_defined_path = _dump_pkgs_defined(
             state_dir.dir,
-            pkgsDefined=pkgsDefined,
+            pkgsDefined=exports.resolved_deps(pkgDeclared, pkgsDefined),
         )
 
-        # Dump real `.digest.json`
-        utils.jsondumpf(pkgDeclared.pkg_digest,
-                        pkgDeclared.digest.serialize())
+        _dump_digest(pkgDeclared)
 
         # Put the jsonnet run file in place
         run_export_path = os.path.join(state_dir.dir,
@@ -115,16 +135,99 @@ def loadPkgExport(state, pkgsDefined, pkgDeclared):
         state_dir.cleanup()
 
 
+def loadPkgExportDeps(state, pkgDeclared, depsExported):
+    """Load the exports of the package from the exports of its deps.
+
+    Unlike `loadPkgExport` the deps' PKG files are not evaluated: their
+    (already manifested) exports are injected as json, so only the
+    package's own export function runs. Hidden fields and functions of the
+    deps' exports don't survive manifesting, so aren't available.
+
+    Params:
+    State state: used to create a temporary directory for storing the
+        custom-created jsonnet running script.
+    depsExported: dictionary of the package's request keys (see
+        `PkgRequest`) to the manifested dep they resolved to (see
+        `exports.as_dep`).
+    """
+    state_dir = state.create_temp_dir()
+    try:
+        deps_exported_path = os.path.join(state_dir.dir, "depsExported.json")
+        utils.jsondumpf(
+            deps_exported_path, {
+                key: depsExported[key]
+                for key in exports.request_keys(pkgDeclared)
+            })
+        _dump_digest(pkgDeclared)
+
+        run_export_path = os.path.join(state_dir.dir,
+                                       constants.FILE_RUN_EXPORT_DEPS)
+        utils.dumpf(
+            path=run_export_path,
+            string=utils.format_run_export_deps(
+                pkgDeclared.pkg_file,
+                deps_exported_path=deps_exported_path,
+            ),
+        )
+
+        pkgExport = utils.manifest_jsonnet(run_export_path)
+        return pkg.PkgExport.deserialize(pkgExport,
+                                         pkg_file=pkgDeclared.pkg_file)
+    finally:
+        state_dir.cleanup()
+
+
+def _dump_digest(pkgDeclared):
+    """Dump the real `.digest.json` of the package.
+
+    It is not rewritten if it is already correct, i.e. in the store, where
+    touching it would invalidate the package's `VerifiedMeta`.
+    """
+    value = pkgDeclared.pkgVer.digest.serialize()
+    if os.path.exists(pkgDeclared.pkg_digest):
+        try:
+            if utils.jsonloadf(pkgDeclared.pkg_digest) == value:
+                return
+        except ValueError:
+            pass
+    utils.jsondumpf(pkgDeclared.pkg_digest, value)
+
+
+def _manifest_declared(run_digest_path, pkg_file):
+    return pkg.PkgDeclared.deserialize(
+        utils.manifest_jsonnet(run_digest_path),
+        pkg_file=pkg_file,
+    )
+
+
 def _dump_pkgs_defined(directory, pkgsDefined):
     """Dump all the defined pkgs into a jsonnet file.
 
-    This allows them to be looked up by key.
+    Every unique pkgVer is imported once (in `pkgs`) and the request keys map
+    to their pkgVer, so that the export of a pkg reached through many
+    requests is only evaluated once (see `wake._private.exportTree`).
     """
+    unique = {}
+    for pkgDeclared in six.itervalues(pkgsDefined):
+        unique[pkgDeclared.pkgVer.serialize()] = pkgDeclared.pkg_file
+    pkgVers = sorted(unique)
+
     pkgs_defined_path = os.path.join(directory, "pkgsDefined.libsonnet")
     with open(pkgs_defined_path, 'wb') as fd:
-        fd.write(b"{\n")
-        for key, path in sorted(six.iteritems(pkgsDefined)):
-            line = "  \"{}\": (import \"{}\"),\n\n".format(key, path)
+        fd.write(b"{\n  pkgs: [\n")
+        for pkgVer in pkgVers:
+            line = "    (import \"{}\"),\n".format(unique[pkgVer])
+            fd.write(line.encode('utf-8'))
+        fd.write(b"  ],\n")
+
+        index = {pkgVer: i for i, pkgVer in enumerate(pkgVers)}
+        requests = {
+            key: pkgDeclared.pkgVer.serialize()
+            for key, pkgDeclared in six.iteritems(pkgsDefined)
+        }
+        for name, value in (("index", index), ("requests", requests)):
+            line = "  {}: {},\n".format(
+                name, json.dumps(value, sort_keys=True, ensure_ascii=False))
             fd.write(line.encode('utf-8'))
         fd.write(b"}\n")
 
@@ -24,12 +24,20 @@ from . import constants
 from . import utils
 from . import digest
 
+_intern = utils.intern
+_setattr = utils.setattr_ident
 
-class PkgName(utils.TupleObject):
+
+class PkgName(utils.IdentObject):
     """The namespace and name of a package."""
+    __slots__ = ('namespace', 'name')
+    _fields = __slots__
+
     def __init__(self, namespace, name):
-        self.namespace = namespace
-        self.name = name
+        namespace, name = _intern(namespace), _intern(name)
+        _setattr(self, 'namespace', namespace)
+        _setattr(self, 'name', name)
+        _setattr(self, '_hash', hash((namespace, name)))
 
     def __str__(self):
         return constants.WAKE_SEP.join((self.namespace, self.name))
@@ -41,17 +49,23 @@ class PkgName(utils.TupleObject):
         return (self.namespace, self.name)
 
 
-class PkgReq(utils.TupleObject):
+class PkgReq(utils.IdentObject):
     """A semver requirement for a package.
 
     Used to specify a dependency.
     """
-    def __init__(self, namespace, name, semver):
-        self.namespace = namespace
-        self.name = name
-        self.semver = semver
+    __slots__ = ('namespace', 'name', 'semver')
+    _fields = __slots__
 
-    @classmethod
+    def __init__(self, namespace, name, semver):
+        namespace, name = _intern(namespace), _intern(name)
+        semver = _intern(semver)
+        _setattr(self, 'namespace', namespace)
+        _setattr(self, 'name', name)
+        _setattr(self, 'semver', semver)
+        _setattr(self, '_hash', hash((namespace, name, semver)))
+
+    @utils.lru_deserialize(constants.DESERIALIZE_CACHE_SIZE)
     def deserialize(cls, string):
         """Deserialize."""
         split = string.split(constants.WAKE_SEP)
@@ -76,20 +90,42 @@ class PkgReq(utils.TupleObject):
         return (self.namespace, self.name, self.semver)
 
 
-class PkgRequest(utils.TupleObject):
+class PkgRequest(utils.IdentObject):
     """A request from a package for a package requirement semver.
 
     Used as a key in jsonnet when associating dependencies.
     """
+    __slots__ = ('requestingPkgVer', 'pkgReq', '_serialized')
+    _fields = ('requestingPkgVer', 'pkgReq')
+
     def __init__(self, requestingPkgVer, pkgReq):
-        self.requestingPkgVer = requestingPkgVer
-        self.pkgReq = pkgReq
+        _setattr(self, 'requestingPkgVer', requestingPkgVer)
+        _setattr(self, 'pkgReq', pkgReq)
+        _setattr(self, '_serialized', None)
+        _setattr(self, '_hash', hash((requestingPkgVer, pkgReq)))
+
+    @utils.lru_deserialize(constants.DESERIALIZE_CACHE_SIZE)
+    def deserialize(cls, string):
+        """Deserialize."""
+        split = string.split(constants.WAKE_SEP)
+        if len(split) != 7:
+            raise ValueError("Must have 7 components split by {}: {}".format(
+                constants.WAKE_SEP, string))
+        return cls(
+            requestingPkgVer=PkgVer.deserialize(
+                constants.WAKE_SEP.join(split[:4])),
+            pkgReq=PkgReq.deserialize(constants.WAKE_SEP.join(split[4:])),
+        )
 
     def serialize(self):
-        return constants.WAKE_SEP.join((
-            self.requestingPkgVer.serialize(),
-            self.pkgReq.serialize(),
-        ))
+        """Serialize (cached)."""
+        if self._serialized is None:
+            _setattr(
+                self, '_serialized', constants.WAKE_SEP.join((
+                    self.requestingPkgVer.serialize(),
+                    self.pkgReq.serialize(),
+                )))
+        return self._serialized
 
     def __str__(self):
         return self.serialize()
@@ -101,17 +137,23 @@ class PkgRequest(utils.TupleObject):
         return (self.requestingPkgVer, self.pkgReq)
 
 
-class PkgVer(utils.TupleObject):
+class PkgVer(utils.IdentObject):
     """A pkg at a specific version and hashed digest."""
+    __slots__ = ('namespace', 'name', 'version', 'digest', '_serialized')
+    _fields = ('namespace', 'name', 'version', 'digest')
 
     # pylint: disable=redefined-outer-name
     def __init__(self, namespace, name, version, digest):
-        self.namespace = namespace
-        self.name = name
-        self.version = version
-        self.digest = digest
-
-    @classmethod
+        namespace, name = _intern(namespace), _intern(name)
+        version = _intern(version)
+        _setattr(self, 'namespace', namespace)
+        _setattr(self, 'name', name)
+        _setattr(self, 'version', version)
+        _setattr(self, 'digest', digest)
+        _setattr(self, '_serialized', None)
+        _setattr(self, '_hash', hash((namespace, name, version, digest)))
+
+    @utils.lru_deserialize(constants.DESERIALIZE_CACHE_SIZE)
     def deserialize(cls, string):
         """Deserialize."""
         split = string.split(constants.WAKE_SEP)
@@ -128,13 +170,16 @@ class PkgVer(utils.TupleObject):
         )
 
     def serialize(self):
-        """Serialize."""
-        return constants.WAKE_SEP.join((
-            self.namespace,
-            self.name,
-            self.version,
-            self.digest.serialize(),
-        ))
+        """Serialize (cached)."""
+        if self._serialized is None:
+            _setattr(
+                self, '_serialized', constants.WAKE_SEP.join((
+                    self.namespace,
+                    self.name,
+                    self.version,
+                    self.digest.serialize(),
+                )))
+        return self._serialized
 
     def __str__(self):
         return self.serialize()
@@ -146,6 +191,38 @@ class PkgVer(utils.TupleObject):
         return (self.namespace, self.name, self.version, self.digest)
 
 
+class NotFound(utils.TupleObject):
+    """Returned by the store for a package that was not found."""
+    def __init__(self, pkgVer):
+        self.pkgVer = pkgVer
+
+    @classmethod
+    def deserialize(cls, dct):
+        """Deserialize."""
+        return cls(pkgVer=PkgVer.deserialize(dct['pkgVer']))
+
+    def serialize(self):
+        """Serialize."""
+        return {
+            constants.F_TYPE: constants.T_NOT_FOUND,
+            'pkgVer': self.pkgVer.serialize(),
+        }
+
+    def __repr__(self):
+        return "notFound:{}".format(self.pkgVer)
+
+    def _tuple(self):
+        return (self.pkgVer, )
+
+
+def is_not_found(value):
+    """Return whether a value returned by a store is a `NotFound`."""
+    if isinstance(value, NotFound):
+        return True
+    return (isinstance(value, dict)
+            and value.get(constants.F_TYPE) == constants.T_NOT_FOUND)
+
+
 class PkgDeclared(utils.SafeObject):
     """The items which are used in the pkg digest.
 
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Resolve the requests of packages to the pkgVers of available packages.
+
+This is the resolver sketched in DESIGN.md Appendix A. Each request is
+resolved to the latest available version matching it, except for the
+restricted levels of `depsReq`, where every request of a pkgName which lands
+in the same *bucket* must resolve to the same version:
+
+- `restricted`: one version per pkgName.
+- `restrictedMajor`: one version per pkgName and major version.
+- `restrictedMinor`: one version per pkgName and minor version.
+
+The requests of a bucket are combined by a `ReqMut` into a `ReqFinal` (the
+disjoint ranges satisfying all of them) and the latest version in it is
+chosen. Choosing a different version can change which packages are reachable,
+so this is repeated until the choices are stable.
+
+Buckets are global to the resolved graph instead of per restricted pool.
+
+A `Resolver` is incremental: it is meant to be kept (or `dump`ed and
+`load`ed) across build cycles while packages are added. The latest match of
+every pkgReq is memoized until a version of its pkgName is added, and the
+previous bucket choices are the starting point of the next `resolve`. The
+choice of every request is kept from the last walk (of the same roots) until
+a version of its pkgName is added or the pin of its bucket changes, so a
+round only re-chooses those requests and the requests of the pkgVers they
+newly reach.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import os
+
+import six
+
+from . import constants
+from . import pkg
+from . import semver
+from . import utils
+
+MAX_ROUNDS = 32
+
+BUCKET_DEPTH = {
+    constants.D_RESTRICTED: 0,
+    constants.D_RESTRICTED_MAJOR: 1,
+    constants.D_RESTRICTED_MINOR: 2,
+}
+
+
+class ResolveError(ValueError):
+    """The requests cannot be resolved.
+
+    `requests` are the request keys involved.
+    """
+    def __init__(self, msg, requests=()):
+        super(ResolveError, self).__init__(msg)
+        self.requests = list(requests)
+
+
+class ReqMut(utils.SafeObject):
+    """The combined constraints of requests which must choose one version."""
+    def __init__(self, pkgName, ranges=None):
+        self.pkgName = pkgName
+        self.ranges = list(ranges or [semver.ReqRange()])
+        self.requests = []
+        self.preferred = None
+
+    def extend_constraints(self, requestKey, ranges):
+        """Constrain to the ranges (of a request)."""
+        self.ranges = semver.intersect_ranges(self.ranges, ranges)
+        self.requests.append(requestKey)
+
+    def finalize(self):
+        return ReqFinal(self.pkgName, self.ranges, self.requests)
+
+
+class ReqFinal(utils.SafeObject):
+    """The sorted, disjoint ranges which satisfy every request of a ReqMut.
+    """
+    def __init__(self, pkgName, ranges, requests):
+        self.pkgName = pkgName
+        self.ranges = tuple(ranges)
+        self.requests = tuple(requests)
+
+    def is_empty(self):
+        return not self.ranges
+
+    def choose(self, available):
+        """Return the latest available pkgVer matching, or None."""
+        return available.choose_latest(self.pkgName, self.ranges)
+
+    def __repr__(self):
+        return "final:{}({})".format(
+            self.pkgName, " || ".join(str(r) for r in self.ranges))
+
+
+class PkgsAvailable(utils.SafeObject):
+    """The pkgVers available for every pkgName, in `semver.VersionColumn`s.
+    """
+    def __init__(self):
+        self.versions = {}
+        self.pkgVers = set()
+
+    def add(self, pkgVer):
+        """Add a pkgVer. Raises ValueError if its version is invalid."""
+        version = semver.parse_version(pkgVer.version)
+        if pkgVer in self.pkgVers:
+            return
+        pkgName = pkg.PkgName(pkgVer.namespace, pkgVer.name)
+        versions = self.versions.get(pkgName)
+        if versions is None:
+            versions = semver.VersionColumn()
+            self.versions[pkgName] = versions
+        versions.add(version, pkgVer)
+        self.pkgVers.add(pkgVer)
+
+    def get(self, pkgName):
+        """Return the sorted pkgVers of a pkgName."""
+        versions = self.versions.get(pkgName)
+        return versions.sorted_values() if versions is not None else ()
+
+    def matching(self, pkgName, ranges):
+        """Return the pkgVers in the (sorted, disjoint) ranges, latest first.
+        """
+        versions = self.versions.get(pkgName)
+        if versions is None:
+            return []
+        return versions.matching(ranges)
+
+    def choose_latest(self, pkgName, ranges):
+        """Return the latest pkgVer in the (sorted, disjoint) ranges or None.
+        """
+        versions = self.versions.get(pkgName)
+        if versions is None:
+            return None
+        return versions.latest(ranges)
+
+
+class Resolver(utils.SafeObject):
+    """Resolve requests against the packages which were added.
+
+    State kept between calls:
+    - pins: the version chosen for every bucket by the last `resolve`.
+    - learned: clauses learned by `solve.Solver`, in its stable format.
+    """
+    def __init__(self, available=None):
+        self.available = available or PkgsAvailable()
+        self.requests = {}
+        self.depsReq = {}
+        self.pins = {}
+        self.learned = []
+        self._latest = {}
+        self._reqs_of = collections.defaultdict(set)
+        self._clear_walk()
+
+    def add_pkg(self, pkgVer, depsReq):
+        """Add an available package and its requests.
+
+        Adding a pkgVer which is already known is a noop.
+        """
+        if pkgVer in self.requests:
+            return
+        self.available.add(pkgVer)
+        # Memoized matches of the pkgName may now be outdated.
+        pkgName = pkg.PkgName(pkgVer.namespace, pkgVer.name)
+        for req in self._reqs_of.pop(pkgName, ()):
+            self._latest.pop(req, None)
+            self._stale.update(self._req_keys.get(req, ()))
+
+        requests = []
+        for lvl, reqs in sorted(six.iteritems(depsReq)):
+            for _, req in sorted(six.iteritems(reqs)):
+                pkgReq = pkg.PkgReq.deserialize(req)
+                requests.append((
+                    lvl,
+                    pkg.PkgName(pkgReq.namespace, pkgReq.name),
+                    req,
+                    # == PkgRequest(pkgVer, pkgReq).serialize()
+                    constants.WAKE_SEP.join((pkgVer.serialize(), req)),
+                    semver.parse_req(pkgReq.semver),
+                ))
+        self.requests[pkgVer] = requests
+        self.depsReq[pkgVer] = depsReq
+
+    def add_declared(self, pkgDeclared):
+        self.add_pkg(pkgDeclared.pkgVer, pkgDeclared.depsReq)
+
+    def resolve(self, roots, prefer=None):
+        """Return the `{requestKey: pkgVer}` of every request reachable from
+        the root pkgVers.
+
+        prefer: `{preference_key(requestKey): pkgVer}` of versions to keep
+            (i.e. from a lockfile) when they still match, instead of the
+            latest.
+
+        Raises ResolveError if a request matches no available version or the
+        requests of a restricted bucket have no version in common.
+        """
+        prefer = prefer or {}
+        context = (list(roots), dict(prefer))
+        if context != self._context:
+            self._clear_walk()
+        try:
+            chosen = self._resolve(roots, prefer)
+        except Exception:
+            self._clear_walk()
+            raise
+        self._context = context
+        return chosen
+
+    def _resolve(self, roots, prefer):
+        pins = self.pins
+        dirty, self._stale = self._stale, set()
+        for _ in range(MAX_ROUNDS):
+            changed = self._walk(roots, pins, prefer, dirty)
+            new_pins = {
+                bucket: pkgVer
+                for bucket, pkgVer in six.iteritems(pins)
+                if bucket in self._buckets and bucket not in changed
+            }
+            for bucket in changed:
+                if bucket not in self._buckets:
+                    continue
+                mut = self._mut(bucket)
+                final = mut.finalize()
+                pkgVer = mut.preferred
+                if pkgVer is None or not _matches(pkgVer, final.ranges):
+                    pkgVer = final.choose(self.available)
+                if pkgVer is None:
+                    raise ResolveError(
+                        "No version of {} matches all of {}".format(
+                            final.pkgName, final.requests),
+                        final.requests)
+                new_pins[bucket] = pkgVer
+            if new_pins == pins:
+                return self._chosen()
+            dirty = set()
+            for bucket, pkgVer in six.iteritems(new_pins):
+                pin = pins.get(bucket)
+                if pin is None or pin != pkgVer:
+                    dirty.update(self._buckets[bucket])
+            pins = self.pins = new_pins
+        raise ResolveError(
+            "Restricted choices did not converge in {} rounds".format(
+                MAX_ROUNDS))
+
+    def serialize(self):
+        """Serialize the packages and the state kept between calls."""
+        return {
+            "pkgs": {
+                pkgVer.serialize(): depsReq
+                for pkgVer, depsReq in six.iteritems(self.depsReq)
+            },
+            "pins": sorted([
+                lvl, pkgName.namespace, pkgName.name,
+                list(bucket), pkgVer.serialize()
+            ] for (lvl, pkgName, bucket), pkgVer in six.iteritems(self.pins)),
+            "learned": self.learned,
+        }
+
+    @classmethod
+    def deserialize(cls, dct):
+        resolver = cls()
+        for pkgVer, depsReq in sorted(six.iteritems(dct["pkgs"])):
+            resolver.add_pkg(pkg.PkgVer.deserialize(pkgVer), depsReq)
+        for lvl, namespace, name, bucket, pkgVer in dct["pins"]:
+            resolver.pins[(lvl, pkg.PkgName(namespace, name),
+                           tuple(bucket))] = pkg.PkgVer.deserialize(pkgVer)
+        resolver.learned = dct["learned"]
+        return resolver
+
+    def dump(self, path):
+        """Persist the resolver so the next invocation can continue."""
+        tmp = path + ".tmp"
+        utils.jsondumpf(tmp, self.serialize(), indent=None)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a dumped resolver, or return a new one if there is none."""
+        if not os.path.exists(path):
+            return cls()
+        return cls.deserialize(utils.jsonloadf(path))
+
+    def _clear_walk(self):
+        """Forget the choices of the last walk, so the next is a full one."""
+        self._context = None
+        # {(lvl, requestKey): (pkgVer, request, dep, bucket, version,
+        #                     preferred)}
+        self._choices = {}
+        self._visited = set()
+        self._buckets = {}
+        self._req_keys = {}
+        # Keys of the choices whose pkgReq has a new latest match.
+        self._stale = set()
+
+    def _walk(self, roots, pins, prefer, dirty):
+        """Choose a pkgVer for every reachable request, using the pinned
+        version of its bucket if it matches.
+
+        Only the `dirty` requests and the requests of the pkgVers which are
+        newly reached are chosen, the others keep the choice of the last
+        walk. Returns the buckets whose requests were chosen again.
+        """
+        changed = set()
+        todo = [r for r in roots if r not in self._visited]
+        self._visited.update(todo)
+        moved = False
+        for key in sorted(dirty):
+            old = self._choices.get(key)
+            if old is not None:
+                moved |= self._update(old[0], old[1], pins, prefer, changed,
+                                      todo)
+        while todo:
+            pkgVer = todo.pop()
+            for request in self.requests[pkgVer]:
+                self._update(pkgVer, request, pins, prefer, changed, todo)
+        if moved:
+            self._prune(roots, changed)
+        return changed
+
+    def _update(self, pkgVer, request, pins, prefer, changed, todo):
+        """Choose the request again, returning whether its pkgVer changed.
+        """
+        key = (request[0], request[3])
+        choice = (pkgVer, request) + self._choose(request, pins, prefer)
+        old = self._choices.get(key)
+        if old is not None:
+            self._forget(key, old, changed)
+        self._choices[key] = choice
+        _, _, dep, bucket, _, _ = choice
+        self._req_keys.setdefault(request[2], set()).add(key)
+        if bucket is not None:
+            self._buckets.setdefault(bucket, set()).add(key)
+            changed.add(bucket)
+        if dep not in self._visited:
+            self._visited.add(dep)
+            todo.append(dep)
+        return old is not None and old[2] != dep
+
+    def _choose(self, request, pins, prefer):
+        """Return the `(dep, bucket, version, preferred)` of a request."""
+        lvl, pkgName, req, key, ranges = request
+        dep = self._latest.get(req)
+        if dep is None:
+            dep = self.available.choose_latest(pkgName, ranges)
+            if dep is not None:
+                self._latest[req] = dep
+                self._reqs_of[pkgName].add(req)
+        if dep is None:
+            raise ResolveError(
+                "No version of {} matches {}".format(pkgName, key), [key])
+        preferred = prefer.get(preference_key(key)) if prefer else None
+        if preferred is not None:
+            if preferred in self.requests and _matches(preferred, ranges):
+                dep = preferred
+            else:
+                preferred = None
+
+        depth = BUCKET_DEPTH.get(lvl)
+        if depth is None:
+            return dep, None, None, preferred
+        version = semver.parse_version(dep.version)
+        bucket = (lvl, pkgName, version.key[:depth])
+        pin = pins.get(bucket)
+        if pin is not None and _matches(pin, ranges):
+            dep = pin
+        return dep, bucket, version, preferred
+
+    def _forget(self, key, choice, changed):
+        _, request, _, bucket, _, _ = choice
+        keys = self._req_keys[request[2]]
+        keys.discard(key)
+        if not keys:
+            del self._req_keys[request[2]]
+        if bucket is not None:
+            keys = self._buckets[bucket]
+            keys.discard(key)
+            if not keys:
+                del self._buckets[bucket]
+            changed.add(bucket)
+
+    def _prune(self, roots, changed):
+        """Forget the requests of the pkgVers which are no longer reached."""
+        reached = set(roots)
+        todo = list(roots)
+        while todo:
+            for request in self.requests[todo.pop()]:
+                dep = self._choices[(request[0], request[3])][2]
+                if dep not in reached:
+                    reached.add(dep)
+                    todo.append(dep)
+        for pkgVer in self._visited - reached:
+            for request in self.requests[pkgVer]:
+                key = (request[0], request[3])
+                choice = self._choices.pop(key, None)
+                if choice is not None:
+                    self._forget(key, choice, changed)
+        self._visited = reached
+
+    def _chosen(self):
+        """Return the `{requestKey: pkgVer}` of the reached requests."""
+        chosen = {}
+        for pkgVer in self._visited:
+            for request in self.requests[pkgVer]:
+                chosen[request[3]] = self._choices[(request[0], request[3])][2]
+        return chosen
+
+    def _mut(self, bucket):
+        """Combine the requests of a bucket."""
+        lvl, pkgName, _ = bucket
+        mut = None
+        for key in sorted(self._buckets[bucket]):
+            _, request, _, _, version, preferred = self._choices[key]
+            if mut is None:
+                mut = ReqMut(
+                    pkgName,
+                    [semver.bucket_range(version, BUCKET_DEPTH[lvl])])
+            mut.extend_constraints(request[3], request[4])
+            if preferred is not None:
+                mut.preferred = preferred
+        return mut
+
+
+def preference_key(requestKey):
+    """The key of a request without the version and digest of the requesting
+    pkg, so that preferences survive changes to it."""
+    parts = requestKey.split(constants.WAKE_SEP)
+    return constants.WAKE_SEP.join(parts[:2] + parts[4:])
+
+
+def _matches(pkgVer, ranges):
+    version = semver.parse_version(pkgVer.version)
+    return any(rng.matches(version) for rng in ranges)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Scrub a store tier: re-hash its packages against their recorded digests.
+
+This keeps integrity checking off of the build's hot path while still
+catching bit-rot. Run it as a subcommand or daemon with::
+
+    python -m wakeold2.scrub STORE_DIR --mb-per-sec 20 --iops 200
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import bisect
+import os
+import sys
+import time
+
+from . import digest
+from . import pkg
+from . import store
+from . import tier
+from . import utils
+
+FILE_SCRUB_CHECKPOINT = "scrub.json"
+
+OK = "ok"
+CORRUPT = "corrupt"
+UNVERIFIED = "unverified"
+
+
+class Throttle(utils.SafeObject):
+    """Limit I/O to `mb_per_sec` megabytes and `iops` operations per second.
+
+    Either limit can be None (unlimited). `consume` sleeps until the I/O it is
+    told about fits within the budget.
+    """
+    def __init__(self, mb_per_sec=None, iops=None, clock=time.time,
+                 sleep=time.sleep):
+        self.bytes_per_sec = mb_per_sec * 1024 * 1024 if mb_per_sec else None
+        self.iops = iops
+        self.clock = clock
+        self.sleep = sleep
+        # The time at which the bytes/ops consumed so far are paid for.
+        self._bytes_until = None
+        self._ops_until = None
+
+    def consume(self, nbytes=0, ops=0):
+        now = self.clock()
+        wait = 0
+        if self.bytes_per_sec and nbytes:
+            self._bytes_until = (max(self._bytes_until or now, now) +
+                                 float(nbytes) / self.bytes_per_sec)
+            wait = max(wait, self._bytes_until - now)
+        if self.iops and ops:
+            self._ops_until = (max(self._ops_until or now, now) +
+                               float(ops) / self.iops)
+            wait = max(wait, self._ops_until - now)
+        if wait > 0:
+            self.sleep(wait)
+
+
+class ScrubReport(utils.SafeObject):
+    """The result of a scrub: the serialized pkgVers by result."""
+    def __init__(self):
+        self.ok = []
+        self.corrupt = []
+        self.unverified = []
+        self.complete = False
+
+    def add(self, entry, result):
+        getattr(self, result).append(entry)
+
+    def __repr__(self):
+        return "ScrubReport(ok={}, corrupt={}, unverified={}, complete={})".format(
+            len(self.ok), len(self.corrupt), len(self.unverified),
+            self.complete)
+
+
+class Scrubber(utils.SafeObject):
+    """Re-hash the packages of a `tier.DirTier` against their digests.
+
+    The paths of each package come from the `store.VerifiedMeta` sidecar
+    written when the store verified it; packages without one are reported as
+    unverified. Corrupt packages are moved to the tier's quarantine.
+
+    Progress is saved to a checkpoint after every package so that an
+    interrupted scrub resumes where it left off.
+    """
+    def __init__(self, dir_tier, throttle=None, checkpoint_path=None):
+        self.tier = dir_tier
+        self.throttle = throttle
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(dir_tier.wake_dir,
+                                           FILE_SCRUB_CHECKPOINT)
+        self.checkpoint_path = checkpoint_path
+
+    def scrub(self, limit=None):
+        """Scrub the packages after the checkpoint, at most `limit` of them.
+
+        The checkpoint is reset once the whole tier has been scrubbed.
+        """
+        entries = sorted(self.tier.list_pkg_vers())
+        last = self.load_checkpoint()
+        if last is not None:
+            entries = entries[bisect.bisect_right(entries, last):]
+
+        report = ScrubReport()
+        for count, entry in enumerate(entries):
+            if limit is not None and count >= limit:
+                return report
+            report.add(entry, self.scrub_pkg(entry))
+            self.dump_checkpoint(entry)
+
+        self.dump_checkpoint(None)
+        report.complete = True
+        return report
+
+    def scrub_pkg(self, entry):
+        """Scrub a single (serialized) pkgVer, returning the result."""
+        try:
+            pkgVer = pkg.PkgVer.deserialize(entry)
+        except ValueError:
+            return UNVERIFIED
+
+        pkg_dir = self.tier.pkg_path(pkgVer)
+        meta = store.VerifiedMeta.load(pkg_dir, check_snapshot=False)
+        if meta is None:
+            return UNVERIFIED
+
+        if meta.pkgDeclared.pkgVer != pkgVer:
+            self.tier.quarantine_package(pkgVer)
+            return CORRUPT
+
+        builder = digest.DigestBuilder(
+            pkg_dir,
+            digest_type=pkgVer.digest.digest_type,
+            throttle=self.throttle,
+        )
+        try:
+            builder.update_paths(
+                utils.joinpaths(pkg_dir, meta.pkgDeclared.paths))
+            value = builder.build()
+        except (IOError, OSError, TypeError, ValueError):
+            value = None
+
+        if value is None or value != pkgVer.digest:
+            self.tier.quarantine_package(pkgVer)
+            return CORRUPT
+        return OK
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            return utils.jsonloadf(self.checkpoint_path)['last']
+        except (ValueError, KeyError):
+            return None
+
+    def dump_checkpoint(self, last):
+        utils.jsondumpf(self.checkpoint_path, {'last': last})
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Re-hash the packages of a store directory against their '
+        'digests, quarantining the corrupt ones.')
+    parser.add_argument('store_dir', help='the store directory to scrub')
+    parser.add_argument('--mb-per-sec',
+                        type=float,
+                        help='limit reads to this many MB per second')
+    parser.add_argument('--iops',
+                        type=float,
+                        help='limit reads to this many operations per second')
+    parser.add_argument('--limit',
+                        type=int,
+                        help='scrub at most this many packages per pass')
+    parser.add_argument(
+        '--interval',
+        type=float,
+        help='run as a daemon, sleeping this many seconds between passes')
+    args = parser.parse_args(argv[1:])
+
+    scrubber = Scrubber(
+        tier.DirTier(os.path.abspath(args.store_dir)),
+        throttle=Throttle(mb_per_sec=args.mb_per_sec, iops=args.iops),
+    )
+    while True:
+        report = scrubber.scrub(limit=args.limit)
+        print(report)
+        for entry in report.corrupt:
+            print("quarantined: {}".format(entry))
+
+        if args.interval is None:
+            return 1 if report.corrupt else 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
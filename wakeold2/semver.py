@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Semantic versions and the requirements (semvers) of a `PkgReq`.
+
+A requirement is parsed into a sorted list of disjoint `ReqRange`s, i.e.
+`>=1.2, <3 || ^4.1` is `[1.2.0, 3.0.0) [4.1.0, 5.0.0)`. The supported syntax
+is the npm/cargo one:
+
+- `1.2.3`, `=1.2.3`, `1.2` (which is `1.2.x`) and `*`
+- `>=`, `>`, `<=`, `<` with a version
+- `^1.2.3` (same major) and `~1.2.3` (same minor)
+- `1.2 - 2.0` (inclusive hyphen ranges)
+- comparators separated by spaces or commas, alternatives by `||`
+"""
+
+from __future__ import unicode_literals
+
+import array
+import bisect
+import re
+
+from . import constants
+from . import utils
+
+_VERSION_RE = re.compile(r'^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?'
+                         r'(?:\+[0-9A-Za-z.-]+)?$')
+_PARTIAL_RE = re.compile(r'^v?(\d+|[xX*])(?:\.(\d+|[xX*]))?'
+                         r'(?:\.(\d+|[xX*]))?(?:-([0-9A-Za-z.-]+))?'
+                         r'(?:\+[0-9A-Za-z.-]+)?$')
+_COMPARATOR_RE = re.compile(r'(>=|<=|>|<|=|\^|~)?\s*([^\s,<>=^~]+)')
+
+# The key of a release sorts after all of its pre-releases.
+_RELEASE = (1, )
+
+# Versions are packed into one unsigned integer with a field per component
+# and a bit for "is a release", so that a column of them can be bisected in C.
+# Components which overflow their field saturate it (and every field after
+# it): packing is then ordered like the keys but not unique.
+try:
+    _PACK_TYPE, _PACK_BITS = 'Q', 21
+    array.array(_PACK_TYPE)
+except ValueError:  # python2 has no 'Q'
+    _PACK_TYPE, _PACK_BITS = 'L', 10
+_PACK_MAX = (1 << _PACK_BITS) - 1
+
+# Parsed strings, bounded like the deserialized identifiers (see pkg.PkgVer).
+_versions = utils.LruCache(constants.DESERIALIZE_CACHE_SIZE)
+_reqs = utils.LruCache(constants.DESERIALIZE_CACHE_SIZE)
+
+
+class Version(utils.TupleObject):
+    """A semantic version. Build metadata is ignored."""
+    def __init__(self, major, minor, patch, prerelease=()):
+        self.major = major
+        self.minor = minor
+        self.patch = patch
+        self.prerelease = tuple(prerelease)
+        self.key = (major, minor, patch,
+                    (0, tuple(_pre_key(p) for p in self.prerelease))
+                    if self.prerelease else _RELEASE)
+        self.packed = _pack(major, minor, patch, not self.prerelease)
+
+    @classmethod
+    def deserialize(cls, string):
+        """Parse an exact version, i.e. `1.2.3-alpha.1`."""
+        match = _VERSION_RE.match(string.strip())
+        if match is None:
+            raise ValueError("Invalid version: {!r}".format(string))
+        major, minor, patch, prerelease = match.groups()
+        return cls(
+            int(major),
+            int(minor),
+            int(patch),
+            prerelease.split('.') if prerelease else (),
+        )
+
+    def serialize(self):
+        out = "{}.{}.{}".format(self.major, self.minor, self.patch)
+        if self.prerelease:
+            out += "-" + ".".join(self.prerelease)
+        return out
+
+    def __str__(self):
+        return self.serialize()
+
+    def __repr__(self):
+        return "version:{}".format(self)
+
+    def _tuple(self):
+        return self.key
+
+
+def parse_version(string):
+    """Return the (cached) `Version` of the string."""
+    version = _versions.get(string)
+    if version is None:
+        version = Version.deserialize(string)
+        _versions.put(string, version)
+    return version
+
+
+class ReqRange(utils.TupleObject):
+    """A range of versions.
+
+    `low` and `high` are `Version`s, or None when unbounded. Each bound can be
+    inclusive or exclusive. An exact version has `low == high`, both
+    inclusive.
+    """
+    def __init__(self, low=None, high=None, low_inclusive=True,
+                 high_inclusive=False):
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive if low is not None else True
+        self.high_inclusive = high_inclusive if high is not None else True
+
+    @classmethod
+    def exact(cls, version):
+        return cls(version, version, True, True)
+
+    def is_exact(self):
+        return (self.low is not None and self.high is not None
+                and self.low.key == self.high.key and self.low_inclusive
+                and self.high_inclusive)
+
+    def is_empty(self):
+        if self.low is None or self.high is None:
+            return False
+        if self.low.key == self.high.key:
+            return not (self.low_inclusive and self.high_inclusive)
+        return self.low.key > self.high.key
+
+    def matches(self, version):
+        """Return whether the version is in the range."""
+        key = version.key
+        if self.low is not None:
+            if key < self.low.key or (key == self.low.key
+                                      and not self.low_inclusive):
+                return False
+        if self.high is not None:
+            if key > self.high.key or (key == self.high.key
+                                       and not self.high_inclusive):
+                return False
+        return True
+
+    def intersect(self, other):
+        """Return the range of versions in both ranges (possibly empty)."""
+        low, low_inclusive = _max_low(self, other)
+        high, high_inclusive = _min_high(self, other)
+        return ReqRange(low, high, low_inclusive, high_inclusive)
+
+    def low_key(self):
+        """Sort key of the lower bound."""
+        if self.low is None:
+            return (0, )
+        return (1, self.low.key, 0 if self.low_inclusive else 1)
+
+    def high_key(self):
+        """Sort key of the upper bound."""
+        if self.high is None:
+            return (2, )
+        return (1, self.high.key, 1 if self.high_inclusive else 0)
+
+    def serialize(self):
+        if self.is_exact():
+            return "={}".format(self.low)
+        parts = []
+        if self.low is not None:
+            parts.append("{}{}".format(">=" if self.low_inclusive else ">",
+                                       self.low))
+        if self.high is not None:
+            parts.append("{}{}".format("<=" if self.high_inclusive else "<",
+                                       self.high))
+        return ", ".join(parts) or "*"
+
+    def __str__(self):
+        return self.serialize()
+
+    def __repr__(self):
+        return "range:{}".format(self)
+
+    def _tuple(self):
+        return (self.low_key(), self.high_key())
+
+
+def parse_req(semver):
+    """Return the (cached) sorted, disjoint `ReqRange`s of a semver string.
+
+    Raises ValueError if it is invalid.
+    """
+    ranges = _reqs.get(semver)
+    if ranges is None:
+        ranges = tuple(_parse_req(semver))
+        _reqs.put(semver, ranges)
+    return ranges
+
+
+def merge_ranges(ranges):
+    """Return the union of the ranges as sorted, disjoint ranges."""
+    out = []
+    for rng in sorted(ranges, key=ReqRange.low_key):
+        if rng.is_empty():
+            continue
+        if out and _touches(out[-1], rng):
+            last = out[-1]
+            if rng.high_key() > last.high_key():
+                out[-1] = ReqRange(last.low, rng.high, last.low_inclusive,
+                                   rng.high_inclusive)
+            continue
+        out.append(rng)
+    return out
+
+
+def intersect_ranges(left, right):
+    """Return the intersection of two lists of sorted, disjoint ranges."""
+    out = []
+    i = j = 0
+    while i < len(left) and j < len(right):
+        rng = left[i].intersect(right[j])
+        if not rng.is_empty():
+            out.append(rng)
+        if left[i].high_key() < right[j].high_key():
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def bucket_range(version, depth):
+    """The range of versions sharing the first `depth` components.
+
+    depth=0 is every version, 1 is the same major and 2 the same minor.
+    """
+    if depth == 0:
+        return ReqRange()
+    parts = [version.major, version.minor][:depth]
+    return ReqRange(_floor(parts, ('0', )), _bump(parts, depth - 1))
+
+
+class VersionColumn(utils.SafeObject):
+    """Values sorted by their `Version`, for matching whole requirements.
+
+    The packed versions are kept in an `array`, so the slice of the column
+    in a range is found with two C bisects instead of a comparison per
+    version. Added values are buffered and merged on the next query.
+    """
+    def __init__(self):
+        self.packed = array.array(_PACK_TYPE)
+        self.keys = []
+        self.values = []
+        self.pending = []
+
+    def add(self, version, value):
+        self.pending.append((version, value))
+
+    def __len__(self):
+        return len(self.values) + len(self.pending)
+
+    def sorted_values(self):
+        """Return the values, oldest first."""
+        self._merge()
+        return self.values
+
+    def slices(self, ranges):
+        """Return the `(start, end)` slices of the values in each of the
+        (sorted, disjoint) ranges."""
+        self._merge()
+        out = []
+        for rng in ranges:
+            start = 0 if rng.low is None else self._bisect(
+                rng.low, right=not rng.low_inclusive)
+            end = len(self.values) if rng.high is None else self._bisect(
+                rng.high, right=rng.high_inclusive)
+            if start < end:
+                out.append((start, end))
+        return out
+
+    def matching(self, ranges):
+        """Return the values in the ranges, latest first."""
+        out = []
+        for start, end in reversed(self.slices(ranges)):
+            out.extend(reversed(self.values[start:end]))
+        return out
+
+    def latest(self, ranges):
+        """Return the latest value in the ranges or None."""
+        slices = self.slices(ranges)
+        if not slices:
+            return None
+        return self.values[slices[-1][1] - 1]
+
+    def _bisect(self, version, right):
+        packed = self.packed
+        start = bisect.bisect_left(packed, version.packed)
+        end = bisect.bisect_right(packed, version.packed, start)
+        if end - start <= 1 and (start == end
+                                 or self.keys[start] == version.key):
+            # Unique packing: no need to compare the keys.
+            return end if right and start < end else start
+        if right:
+            return bisect.bisect_right(self.keys, version.key, start, end)
+        return bisect.bisect_left(self.keys, version.key, start, end)
+
+    def _merge(self):
+        if not self.pending:
+            return
+        entries = list(zip(self.keys, self.packed, self.values))
+        entries.extend((version.key, version.packed, value)
+                       for version, value in self.pending)
+        entries.sort(key=lambda e: e[0])  # stable: in the order added
+        self.keys = [e[0] for e in entries]
+        self.packed = array.array(_PACK_TYPE, [e[1] for e in entries])
+        self.values = [e[2] for e in entries]
+        self.pending = []
+
+
+def _parse_req(semver):
+    semver = (semver or "").strip()
+    ranges = []
+    for alternative in semver.split("||"):
+        ranges.append(_parse_alternative(alternative.strip()))
+    return merge_ranges(ranges)
+
+
+def _parse_alternative(alternative):
+    if alternative in ("", "*"):
+        return ReqRange()
+
+    if " - " in alternative:
+        low, high = alternative.split(" - ", 1)
+        low_parts, low_pre = _parse_partial(low)
+        high_parts, high_pre = _parse_partial(high)
+        rng = ReqRange(_floor(low_parts, low_pre), None)
+        if high_parts:
+            rng = rng.intersect(_comparator("<=", high_parts, high_pre))
+        return rng
+
+    rng = ReqRange()
+    end = 0
+    for match in _COMPARATOR_RE.finditer(alternative):
+        if alternative[end:match.start()].strip(" ,"):
+            raise ValueError("Invalid semver: {!r}".format(alternative))
+        end = match.end()
+        parts, pre = _parse_partial(match.group(2))
+        rng = rng.intersect(_comparator(match.group(1) or "=", parts, pre))
+    if alternative[end:].strip(" ,"):
+        raise ValueError("Invalid semver: {!r}".format(alternative))
+    return rng
+
+
+def _comparator(op, parts, pre):
+    # pylint: disable=too-many-return-statements
+    if not parts:
+        # A wildcard: `>=*` and friends are all "any".
+        return ReqRange() if op != "<" else ReqRange(
+            Version(0, 0, 0), Version(0, 0, 0), True, False)
+
+    floor = _floor(parts, pre)
+    if op == "=":
+        if len(parts) == 3:
+            return ReqRange.exact(floor)
+        return ReqRange(floor, _bump(parts, len(parts) - 1))
+    if op == ">=":
+        return ReqRange(floor, None)
+    if op == ">":
+        if len(parts) == 3:
+            return ReqRange(floor, None, low_inclusive=False)
+        return ReqRange(_bump(parts, len(parts) - 1), None)
+    if op == "<":
+        return ReqRange(None, floor)
+    if op == "<=":
+        if len(parts) == 3:
+            return ReqRange(None, floor, high_inclusive=True)
+        return ReqRange(None, _bump(parts, len(parts) - 1))
+    if op == "^":
+        # Bump the first non-zero component (or the last one given).
+        idx = 0
+        while idx < len(parts) - 1 and parts[idx] == 0:
+            idx += 1
+        return ReqRange(floor, _bump(parts, idx))
+    if op == "~":
+        return ReqRange(floor, _bump(parts, min(len(parts) - 1, 1)))
+    raise ValueError("Unknown operator: {}".format(op))
+
+
+def _parse_partial(string):
+    """Return the given numeric components and the prerelease."""
+    match = _PARTIAL_RE.match(string.strip())
+    if match is None:
+        raise ValueError("Invalid version: {!r}".format(string))
+    parts = []
+    for part in match.groups()[:3]:
+        if part is None or part in "xX*":
+            break
+        parts.append(int(part))
+    prerelease = match.group(4)
+    return parts, tuple(prerelease.split('.')) if prerelease else ()
+
+
+def _floor(parts, pre):
+    parts = list(parts) + [0] * (3 - len(parts))
+    return Version(parts[0], parts[1], parts[2], pre)
+
+
+def _bump(parts, idx):
+    """The first version after every version starting with parts[:idx+1]."""
+    bumped = list(parts[:idx + 1]) + [0] * (2 - idx)
+    bumped[idx] += 1
+    # The lowest pre-release of a version is `-0`.
+    return Version(bumped[0], bumped[1], bumped[2], ('0', ))
+
+
+def _max_low(left, right):
+    if left.low_key() >= right.low_key():
+        return left.low, left.low_inclusive
+    return right.low, right.low_inclusive
+
+
+def _min_high(left, right):
+    if left.high_key() <= right.high_key():
+        return left.high, left.high_inclusive
+    return right.high, right.high_inclusive
+
+
+def _touches(left, right):
+    """Whether `right` (which starts after left) overlaps or abuts left."""
+    if left.high is None or right.low is None:
+        return True
+    if left.high.key != right.low.key:
+        return left.high.key > right.low.key
+    return left.high_inclusive or right.low_inclusive
+
+
+def _pack(major, minor, patch, release):
+    packed = 0
+    saturated = False
+    for part in (major, minor, patch):
+        saturated = saturated or part > _PACK_MAX
+        packed = (packed << _PACK_BITS) | (_PACK_MAX if saturated else part)
+    return (packed << 1) | (1 if saturated or release else 0)
+
+
+def _pre_key(identifier):
+    # Numeric identifiers sort before (and numerically among) alphanumerics.
+    if identifier.isdigit():
+        return (0, int(identifier), "")
+    return (1, 0, identifier)
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Solve restricted dependencies exactly with conflict-driven clause learning.
+
+The greedy `resolve.Resolver.resolve` picks the latest match of each request
+and can fail when a restricted bucket needs an older version of a package
+further up the graph. `Solver` encodes the graph as boolean clauses instead:
+
+- a *selected* variable for every pkgVer which any reachable request can
+  match, and a *pool* variable for every (restricted level, pkgVer), which
+  implies the pkgVer is selected.
+- root pkgVers are selected.
+- a selected pkgVer requires one of the variables matching each request:
+  selected pkgVers for unrestricted requests, pool variables otherwise.
+- at most one pool variable of a bucket (see `resolve`) is true.
+
+Decisions select the newest candidate of the first unsatisfied request (in
+the order pkgs were selected, most constrained requests first), so the
+solution is the greedy one wherever that is possible. Conflicts are analyzed
+to their first unique implication point, learned as clauses, and the search
+jumps back non-chronologically.
+
+If there is no solution, `UnsatError.core` is a minimal set of roots,
+requests and buckets which cannot all hold.
+
+Learned clauses are kept in `Resolver.learned` between solves (and dumps).
+Each records the constraints it was derived from with a signature of their
+clauses, and is only reused while all of them are unchanged, i.e. until a
+new version matching one of the requests involved is added.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import json
+
+import six
+
+from . import resolve
+from . import semver
+from . import utils
+
+C_ROOT = "root"
+C_REQUEST = "request"
+C_BUCKET = "bucket"
+
+MAX_LEARNED = 10000
+MAX_LEARNED_ORIGINS = 64
+
+
+class Constraint(utils.TupleObject):
+    """A constraint of the problem, as reported in an unsatisfiable core.
+
+    kind is one of:
+    - C_ROOT: subject is the root pkgVer.
+    - C_REQUEST: subject is the request key.
+    - C_BUCKET: subject is `(lvl, pkgName, bucket)`.
+    """
+    def __init__(self, kind, subject):
+        self.kind = kind
+        self.subject = subject
+
+    def __str__(self):
+        if self.kind == C_BUCKET:
+            lvl, pkgName, bucket = self.subject
+            return "{}: one version of {} for {}".format(
+                lvl, pkgName, ".".join(str(b) for b in bucket) or "all")
+        return "{}: {}".format(self.kind, self.subject)
+
+    def __repr__(self):
+        return "constraint:{}".format(self)
+
+    def _tuple(self):
+        return (self.kind, str(self.subject))
+
+
+class UnsatError(resolve.ResolveError):
+    """The requests have no solution. `core` explains why."""
+    def __init__(self, core):
+        super(UnsatError, self).__init__(
+            "Unsatisfiable requests:\n" + "\n".join("- {}".format(c)
+                                                    for c in core),
+            [c.subject for c in core if c.kind == C_REQUEST],
+        )
+        self.core = core
+
+
+class Solver(utils.SafeObject):
+    """Solve the requests of the packages added to a `resolve.Resolver`."""
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def solve(self, roots, minimize=True, prefer=None):
+        """Return the `{requestKey: pkgVer}` of every request reachable from
+        the roots.
+
+        `prefer` is as in `resolve.Resolver.resolve`: the preferred version
+        of a request is decided before the newer ones.
+
+        Raises UnsatError with a core of constraints if there is no solution.
+        The core is minimal (removing any constraint makes the rest
+        satisfiable) if `minimize`.
+        """
+        resolver = self.resolver
+        encoding = _Encoding(resolver.available, resolver.requests, roots,
+                             prefer)
+        everything = set(range(len(encoding.constraints)))
+        cdcl = _Cdcl(encoding, everything,
+                     _restore_learned(encoding, resolver.learned))
+        ok, result = cdcl.solve()
+        resolver.learned = (resolver.learned + _stable_learned(
+            encoding, cdcl.learned))[-MAX_LEARNED:]
+        if ok:
+            return encoding.chosen(roots, result)
+
+        core = _minimize(encoding, result) if minimize else result
+        raise UnsatError([encoding.constraints[i] for i in sorted(core)])
+
+
+class _Encoding(object):
+    """The clauses of the problem.
+
+    Variables are positive ints and literals are +var (true) or -var
+    (false). Every clause belongs to a constraint (an index into
+    `constraints`), or to None if it only defines a pool variable.
+    """
+    def __init__(self, available, requests, roots, prefer=None):
+        self.pkgs = [None]
+        self.keys = [None]
+        self.clauses_of = collections.defaultdict(list)
+        self._signatures = {}
+        self.selected = {}
+        self.pool = {}
+        self.constraints = []
+        self.clauses = []
+        self.requirements = collections.defaultdict(list)
+        self.picks = collections.defaultdict(list)
+        self._todo = collections.deque()
+
+        for root in roots:
+            self._add(Constraint(C_ROOT, root), [[self._select(root)]])
+
+        buckets = collections.OrderedDict()
+        matching = {}
+        while self._todo:
+            pkgVer = self._todo.popleft()
+            var = self.selected[pkgVer]
+            for lvl, pkgName, req, key, ranges in requests.get(pkgVer, ()):
+                lits = matching.get((lvl, req))
+                if lits is None:
+                    lits = self._matching(available, buckets, lvl, pkgName,
+                                          ranges)
+                    matching[(lvl, req)] = lits
+                if prefer:
+                    preferred = prefer.get(resolve.preference_key(key))
+                    lits = self._prefer(lits, preferred)
+
+                index = self._add(Constraint(C_REQUEST, key),
+                                  [[-var] + lits])
+                self.requirements[var].append(index)
+                self.picks[var].append((key, lits))
+
+        for (lvl, pkgName, bucket), members in six.iteritems(buckets):
+            if len(members) < 2:
+                continue
+            members = list(members)
+            clauses = []
+            for i, left in enumerate(members):
+                for right in members[i + 1:]:
+                    clauses.append([-left, -right])
+            self._add(Constraint(C_BUCKET, (lvl, pkgName, bucket)), clauses)
+
+        for indexes in six.itervalues(self.requirements):
+            indexes.sort(key=lambda i: len(self.clauses[i][1]))
+
+    def chosen(self, roots, assignment):
+        """Return the `{requestKey: pkgVer}` reachable in the solution."""
+        out = {}
+        visited = set(roots)
+        todo = list(roots)
+        while todo:
+            var = self.selected[todo.pop()]
+            for key, lits in self.picks[var]:
+                lit = next(l for l in lits if assignment[l])
+                dep = self.pkgs[lit]
+                out[key] = dep
+                if dep not in visited:
+                    visited.add(dep)
+                    todo.append(dep)
+        return out
+
+    def _matching(self, available, buckets, lvl, pkgName, ranges):
+        """Return the literals which satisfy a request, newest first."""
+        depth = resolve.BUCKET_DEPTH.get(lvl)
+        lits = []
+        for candidate in available.matching(pkgName, ranges):
+            lit = self._select(candidate)
+            if depth is not None:
+                lit = self._pool(lvl, candidate, lit)
+                version = semver.parse_version(candidate.version)
+                bucket = (lvl, pkgName, version.key[:depth])
+                members = buckets.setdefault(bucket,
+                                             collections.OrderedDict())
+                members[lit] = None
+            lits.append(lit)
+        return lits
+
+    def signature(self, index):
+        """Return a hash of the clauses of a constraint which is stable
+        across encodings."""
+        signature = self._signatures.get(index)
+        if signature is None:
+            clauses = sorted(
+                sorted([lit > 0] + self.keys[abs(lit)] for lit in lits)
+                for lits in self.clauses_of[index])
+            signature = hashlib.md5(
+                json.dumps(clauses).encode('utf-8')).hexdigest()
+            self._signatures[index] = signature
+        return signature
+
+    def var_of(self):
+        """Return the `{(lvl, pkgVer string): var}` of every variable."""
+        return {tuple(key): var for var, key in enumerate(self.keys) if key}
+
+    def _prefer(self, lits, preferred):
+        """Move the literal of the preferred pkgVer (if any) first."""
+        if preferred is None:
+            return lits
+        for i, lit in enumerate(lits):
+            if self.pkgs[lit] == preferred:
+                return [lit] + lits[:i] + lits[i + 1:]
+        return lits
+
+    def _new_var(self, pkgVer, lvl=None):
+        self.pkgs.append(pkgVer)
+        self.keys.append([lvl, pkgVer.serialize()])
+        return len(self.pkgs) - 1
+
+    def _select(self, pkgVer):
+        var = self.selected.get(pkgVer)
+        if var is None:
+            var = self._new_var(pkgVer)
+            self.selected[pkgVer] = var
+            self._todo.append(pkgVer)
+        return var
+
+    def _pool(self, lvl, pkgVer, selected):
+        var = self.pool.get((lvl, pkgVer))
+        if var is None:
+            var = self._new_var(pkgVer, lvl)
+            self.pool[(lvl, pkgVer)] = var
+            self.clauses.append((None, [-var, selected]))
+        return var
+
+    def _add(self, constraint, clauses):
+        """Add the clauses of a constraint, returning the index of the last.
+        """
+        self.constraints.append(constraint)
+        index = len(self.constraints) - 1
+        for lits in clauses:
+            self.clauses.append((index, lits))
+            self.clauses_of[index].append(lits)
+        return len(self.clauses) - 1
+
+
+class _Cdcl(object):
+    """A CDCL search over the clauses of the active constraints.
+
+    Every clause tracks the constraints it was derived from, so a conflict
+    without decisions yields the constraints which caused it.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, encoding, active, learned=()):
+        self.encoding = encoding
+        nvars = len(encoding.pkgs)
+        self.value = [None] * nvars
+        self.level = [0] * nvars
+        self.reason = [None] * nvars
+        self.origin0 = [None] * nvars
+        self.trail = []
+        self.trail_lim = []
+        self.decide_lim = []
+        self.qhead = 0
+        self.dhead = 0
+        self.watches = collections.defaultdict(list)
+        self.clauses = []
+        self.origins = []
+        self.active = []
+        self.units = []
+        self.learned = []
+
+        for constraint, lits in encoding.clauses:
+            self._add(
+                lits,
+                frozenset() if constraint is None else frozenset([constraint]),
+                constraint is None or constraint in active,
+            )
+        for lits, origin in learned:
+            if origin <= active:
+                self._add(lits, origin, True)
+
+    def solve(self):
+        """Return `(True, assignment)` or `(False, core)`."""
+        for index in self.units:
+            lit = self.clauses[index][0]
+            val = self._value(lit)
+            if val is False:
+                return False, self._core(index)
+            if val is None:
+                self._enqueue(lit, index)
+
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                if not self.trail_lim:
+                    return False, self._core(conflict)
+                learnt, level, origin = self._analyze(conflict)
+                self.learned.append((list(learnt), origin))
+                self._backtrack(level)
+                self.clauses.append(learnt)
+                self.origins.append(origin)
+                self.active.append(True)
+                index = len(self.clauses) - 1
+                if len(learnt) > 1:
+                    self._watch(index)
+                self._enqueue(learnt[0], index)
+                continue
+
+            lit = self._decide()
+            if lit is None:
+                return True, _Assignment(self.value)
+            self.trail_lim.append(len(self.trail))
+            self.decide_lim.append(self.dhead)
+            self._enqueue(lit, None)
+
+    def _add(self, lits, origin, active):
+        self.clauses.append(list(lits))
+        self.origins.append(origin)
+        self.active.append(active)
+        if not active:
+            return
+        if len(lits) == 1:
+            self.units.append(len(self.clauses) - 1)
+        else:
+            self._watch(len(self.clauses) - 1)
+
+    def _value(self, lit):
+        val = self.value[abs(lit)]
+        if val is None or lit > 0:
+            return val
+        return not val
+
+    def _watch(self, index):
+        lits = self.clauses[index]
+        self.watches[lits[0]].append(index)
+        self.watches[lits[1]].append(index)
+
+    def _enqueue(self, lit, reason):
+        var = abs(lit)
+        self.value[var] = lit > 0
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(lit)
+        if not self.trail_lim:
+            origin = set(self.origins[reason])
+            for other in self.clauses[reason]:
+                if other != lit:
+                    origin.update(self.origin0[abs(other)])
+            self.origin0[var] = frozenset(origin)
+
+    def _propagate(self):
+        """Propagate the trail, returning a conflicting clause or None."""
+        while self.qhead < len(self.trail):
+            false_lit = -self.trail[self.qhead]
+            self.qhead += 1
+            watching = self.watches[false_lit]
+            keep = []
+            for i, index in enumerate(watching):
+                lits = self.clauses[index]
+                if lits[0] == false_lit:
+                    lits[0], lits[1] = lits[1], lits[0]
+                if self._value(lits[0]) is True:
+                    keep.append(index)
+                    continue
+
+                for k in range(2, len(lits)):
+                    if self._value(lits[k]) is not False:
+                        lits[1], lits[k] = lits[k], lits[1]
+                        self.watches[lits[1]].append(index)
+                        break
+                else:
+                    keep.append(index)
+                    if self._value(lits[0]) is False:
+                        keep.extend(watching[i + 1:])
+                        self.watches[false_lit] = keep
+                        return index
+                    self._enqueue(lits[0], index)
+            self.watches[false_lit] = keep
+        return None
+
+    def _analyze(self, conflict):
+        """Learn the first UIP clause of a conflict.
+
+        Returns the clause, the level to jump back to and its origin.
+        """
+        current = len(self.trail_lim)
+        learnt = [None]
+        origin = set()
+        seen = set()
+        pending = 0
+        lit = None
+        index = conflict
+        position = len(self.trail) - 1
+        while True:
+            origin.update(self.origins[index])
+            for other in self.clauses[index]:
+                if other == lit:
+                    continue
+                var = abs(other)
+                if var in seen:
+                    continue
+                if self.level[var] == 0:
+                    origin.update(self.origin0[var])
+                    continue
+                seen.add(var)
+                if self.level[var] == current:
+                    pending += 1
+                else:
+                    learnt.append(other)
+
+            while abs(self.trail[position]) not in seen:
+                position -= 1
+            lit = self.trail[position]
+            position -= 1
+            pending -= 1
+            if pending == 0:
+                break
+            index = self.reason[abs(lit)]
+
+        learnt[0] = -lit
+        level = 0
+        if len(learnt) > 1:
+            best = max(range(1, len(learnt)),
+                       key=lambda i: self.level[abs(learnt[i])])
+            learnt[1], learnt[best] = learnt[best], learnt[1]
+            level = self.level[abs(learnt[1])]
+        return learnt, level, frozenset(origin)
+
+    def _backtrack(self, level):
+        if len(self.trail_lim) <= level:
+            return
+        start = self.trail_lim[level]
+        for lit in self.trail[start:]:
+            var = abs(lit)
+            self.value[var] = None
+            self.reason[var] = None
+        del self.trail[start:]
+        self.qhead = len(self.trail)
+        self.dhead = self.decide_lim[level]
+        del self.trail_lim[level:]
+        del self.decide_lim[level:]
+
+    def _decide(self):
+        """Return the newest candidate of the first unsatisfied request, or
+        None if every request of every selected pkg is satisfied.
+
+        Requests of the pkgs before `dhead` were satisfied below the current
+        decision level, so they are not checked again.
+        """
+        encoding = self.encoding
+        while self.dhead < len(self.trail):
+            lit = self.trail[self.dhead]
+            for index in encoding.requirements.get(lit, ()) if lit > 0 else ():
+                if not self.active[index]:
+                    continue
+                choice = None
+                for candidate in encoding.clauses[index][1][1:]:
+                    val = self._value(candidate)
+                    if val is True:
+                        break
+                    if val is None and choice is None:
+                        choice = candidate
+                else:
+                    return choice
+            self.dhead += 1
+        return None
+
+    def _core(self, index):
+        core = set(self.origins[index])
+        for lit in self.clauses[index]:
+            core.update(self.origin0[abs(lit)] or ())
+        return core
+
+
+class _Assignment(object):
+    """The truth of literals in a solution. Unassigned variables are false.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __getitem__(self, lit):
+        return bool(self.value[abs(lit)]) == (lit > 0)
+
+
+def _stable_learned(encoding, learned):
+    """Return the learned clauses in the format kept by the Resolver."""
+    out = []
+    for lits, origin in learned:
+        if len(origin) > MAX_LEARNED_ORIGINS:
+            continue
+        out.append({
+            "lits": [[lit > 0] + encoding.keys[abs(lit)] for lit in lits],
+            "origins": [[
+                encoding.constraints[index].kind,
+                str(encoding.constraints[index].subject),
+                encoding.signature(index),
+            ] for index in sorted(origin)],
+        })
+    return out
+
+
+def _restore_learned(encoding, learned):
+    """Return the learned clauses whose constraints are all unchanged."""
+    if not learned:
+        return []
+    constraints = {(c.kind, str(c.subject)): index
+                   for index, c in enumerate(encoding.constraints)}
+    var_of = encoding.var_of()
+    out = []
+    for clause in learned:
+        origin = []
+        for kind, subject, signature in clause["origins"]:
+            index = constraints.get((kind, subject))
+            if index is None or encoding.signature(index) != signature:
+                break
+            origin.append(index)
+        else:
+            try:
+                lits = [
+                    var_of[(lvl, pkgVer)] * (1 if positive else -1)
+                    for positive, lvl, pkgVer in clause["lits"]
+                ]
+            except KeyError:
+                continue
+            out.append((lits, frozenset(origin)))
+    return out
+
+
+def _minimize(encoding, core):
+    """Drop constraints from an unsatisfiable core while it stays
+    unsatisfiable."""
+    core = set(core)
+    for constraint in sorted(core):
+        if constraint not in core:
+            continue
+        ok, smaller = _Cdcl(encoding, core - set([constraint])).solve()
+        if not ok:
+            core = set(smaller)
+    return core
@@ -20,71 +20,305 @@
 from __future__ import unicode_literals
 
 import os
-import shutil
+
+import six
 
 from . import constants
+from . import exports
 from . import utils
 from . import load
+from . import pkg
+from . import tier
+
+FILE_VERIFIED = "verified.json"
 
 
 class Store(utils.SafeObject):
-    """Basic store supporting CRUD operations."""
-    def __init__(self, state):
+    """Basic store supporting CRUD operations.
+
+    The package directories are kept in a `tier.TieredStore`. If no tiers are
+    given the store uses a single local tier in a temporary directory.
+
+    Every verified package gets a `VerifiedMeta` sidecar so that verifying it
+    again only costs a `stat` of its files, unless `deep` is requested.
+
+    Manifested exports are cached in an `exports.ExportCache` in the local
+    tier, so they are shared by every build using it.
+    """
+    def __init__(self, state, tiers=None):
         self.state = state
-        self.temp_dir = self.state.create_temp_dir(prefix="store-")
-        self.dir = self.temp_dir.dir
+        self.temp_dir = None
+        if tiers is None:
+            self.temp_dir = self.state.create_temp_dir(prefix="store-")
+            tiers = tier.TieredStore(local=tier.DirTier(self.temp_dir.dir))
+        self.tiers = tiers
+        self.dir = tiers.local.dir
         self.packages = {}
+        self.exports = exports.ExportCache(
+            os.path.join(tiers.local.wake_dir, "exports"))
 
     def create_pkg(self, pkgDigest):
         """Insert a pkgDigest into the store and return with updated paths."""
-        pkgVerStr = pkgDigest.pkgVer.serialize()
-        pkg_dir = os.path.join(self.dir, pkgVerStr)
-
-        if pkgDigest.pkgVer in self.packages:
-            assert os.path.exists(pkg_dir)
-            existing = self.read_pkg(pkgDigest.pkgVer)
-            if existing == pkgDigest.pkgVer:
-                # it already exists
-                return existing
-
-            # It exists but is invalid. Start from scratch.
-            shutil.rmtree(pkg_dir)
-
-        os.mkdir(pkg_dir)
-        for path in pkgDigest.paths:
-            src = utils.pjoin(pkgDigest.pkg_dir, path)
-            dst = utils.pjoin(pkg_dir, path)
-            utils.copytree(src, dst)
-
-        result = self.read_pkg(
-            pkgDigest.pkgVer,
-            skip_cache=True,
-            check_cache=False,
-        )
+        return self.create_pkgs([pkgDigest])[0]
+
+    def create_pkgs(self, pkgDigests):
+        """Insert many pkgDigests into the store, returning them with updated
+        paths (in order).
+
+        The new packages are created in the local tier as a single batch.
+        """
+        pkgVers = [d.pkgVer for d in pkgDigests]
+        results = [self.packages.get(v) for v in pkgVers]
+        missing = [i for i, r in enumerate(results) if r is None]
+        pkg_dirs = self.tiers.read_packages([pkgVers[i] for i in missing])
+
+        create = []
+        for i, pkg_dir in zip(missing, pkg_dirs):
+            if not pkg.is_not_found(pkg_dir):
+                # A tier (i.e. a neighbour's shared store) already has it.
+                try:
+                    results[i] = self._verify_pkg(pkgVers[i], pkg_dir)
+                    continue
+                except ValueError:
+                    # It exists but is invalid. Start from scratch.
+                    self.tiers.quarantine_package(pkgVers[i])
+            create.append(i)
+
+        staging = self.state.create_temp_dir(prefix="create-")
+        try:
+            items = []
+            for i in create:
+                pkgDigest = pkgDigests[i]
+                pkg_dir = os.path.join(staging.dir, str(i))
+                os.mkdir(pkg_dir)
+                for path in pkgDigest.paths:
+                    src = utils.pjoin(pkgDigest.pkg_dir, path)
+                    dst = utils.pjoin(pkg_dir, path)
+                    utils.copytree(src, dst)
+                items.append((pkg_dir, pkgVers[i]))
+            pkg_dirs = self.tiers.local.create_packages(items)
+        finally:
+            staging.cleanup()
+
+        for i, pkg_dir in zip(create, pkg_dirs):
+            results[i] = self.verify_created(pkgVers[i], pkg_dir)
+
+        return results
 
-        if result.pkgVer.digest != pkgDigest.pkgVer.digest:
+    def verify_created(self, pkgVer, pkg_dir):
+        """Verify a package which was just created in the local tier.
+
+        The package is evaluated and hashed from its new location. If it is
+        valid it gets a sidecar, is cached and is pushed to the shared tier.
+        """
+        result = self._load_pkg(pkg_dir)
+        if result.pkgVer.digest != pkgVer.digest:
+            self.tiers.remove_package(pkgVer)
             raise ValueError(
                 "The given pkgDigest had an invalid digest value: {} != {}".
-                format(result.pkgVer.digest, pkgDigest.pkgVer.digest))
+                format(result.pkgVer.digest, pkgVer.digest))
 
+        VerifiedMeta.from_pkg(result).dump()
         self.packages[result.pkgVer] = result
+        self.tiers.push(result.pkgVer)
         return result
 
-    def read_pkg(self, pkgVer, skip_cache=False, check_cache=False):
+    def read_export(self, pkgDeclared, pkgsDefined):
+        """Get the PkgExport of a package, loading it only if it is not cached.
+
+        The exports of the dependencies are read first: the package is only
+        re-evaluated if its pkgVer or the fingerprint of a dependency
+        changed, which ignores the digests of the deps (see
+        `exports.mask_digests`). When it is, the deps' exports are injected
+        as json so only its own export function runs.
+
+        pkgsDefined: `{requestKey: PkgDeclared}` of the resolved dependencies
+            (see `load.loadPkgExport`).
+        """
+        return self._read_export(pkgDeclared, pkgsDefined, memo={})
+
+    def _read_export(self, pkgDeclared, pkgsDefined, memo):
+        pkgVer = pkgDeclared.pkgVer
+        if pkgVer in memo:
+            return memo[pkgVer]
+
+        depExports = {
+            key: self._read_export(pkgsDefined[key], pkgsDefined, memo)
+            for key in exports.request_keys(pkgDeclared)
+        }
+        depsExported, digests = exports.mask_digests({
+            key: exports.as_dep(e)
+            for key, e in six.iteritems(depExports)
+        })
+        fingerprints = {
+            key: exports.fingerprint(dep)
+            for key, dep in six.iteritems(depsExported)
+        }
+        result = self.exports.get_or_load(
+            exports.ExportCache.key(pkgVer, fingerprints),
+            pkgDeclared.pkg_file,
+            lambda: load.loadPkgExportDeps(self.state, pkgDeclared,
+                                           depsExported),
+        )
+        result = exports.unmask_digests(result, digests)
+        memo[pkgVer] = result
+        return result
+
+    def read_pkg(self, pkgVer, skip_cache=False, check_cache=False,
+                 deep=False):
         """Get a package from the store.
 
-        The cache can also be skipped and optionally checked.
+        Packages which are not cached are read through the tiers. The cache
+        can also be skipped and optionally checked.
+
+        Packages read from the tiers are only re-evaluated and re-hashed if
+        their files changed since they were last verified, or if `deep`.
+        """
+        if skip_cache and not check_cache:
+            pkg_dir = self.tiers.read_package(pkgVer)
+            if pkg.is_not_found(pkg_dir):
+                raise KeyError(pkgVer)
+            meta = None if deep else VerifiedMeta.load(pkg_dir)
+            if meta is not None:
+                return meta.pkgDeclared
+            return self._load_pkg(pkg_dir)
+
+        result = self.read_pkgs([pkgVer], check_cache=check_cache,
+                                deep=deep)[0]
+        if pkg.is_not_found(result):
+            raise KeyError(pkgVer)
+        return result
+
+    def read_pkgs(self, pkgVers, check_cache=False, deep=False):
+        """Get many packages from the store.
+
+        Returns a PkgDeclared or NotFound for each pkgVer, in order. Packages
+        which are not cached (or all of them if `check_cache`) are read through
+        the tiers as a single batch.
+        """
+        results = [None] * len(pkgVers)
+        missing = []
+        for i, pkgVer in enumerate(pkgVers):
+            cached = None if check_cache else self.packages.get(pkgVer)
+            if cached is None:
+                missing.append(i)
+            else:
+                results[i] = cached
+
+        pkg_dirs = self.tiers.read_packages([pkgVers[i] for i in missing])
+        for i, pkg_dir in zip(missing, pkg_dirs):
+            if pkg.is_not_found(pkg_dir):
+                results[i] = pkg_dir
+            else:
+                results[i] = self._verify_pkg(pkgVers[i], pkg_dir, deep=deep)
+
+        return results
+
+    def _verify_pkg(self, pkgVer, pkg_dir, deep=False):
+        """Load the package in the store, checking it and caching it."""
+        meta = None if deep else VerifiedMeta.load(pkg_dir)
+        if meta is not None and meta.pkgDeclared.pkgVer == pkgVer:
+            result = meta.pkgDeclared
+        else:
+            result = self._load_pkg(pkg_dir)
+            if result.pkgVer != pkgVer:
+                raise ValueError("{} in the store is invalid: {}".format(
+                    pkgVer, result.pkgVer))
+            VerifiedMeta.from_pkg(result).dump()
+
+        self.packages[pkgVer] = result
+        return result
+
+    def _load_pkg(self, pkg_dir):
+        pkg_file = os.path.join(pkg_dir, constants.FILE_PKG_DEFAULT)
+        return load.loadPkgDeclared(self.state,
+                                    pkg_file,
+                                    calc_digest=True,
+                                    cleanup=False)
+
+
+class VerifiedMeta(utils.SafeObject):
+    """Sidecar of a package in the store which was verified.
+
+    Contains the evaluated PkgDeclared (including the digest in its pkgVer)
+    and a snapshot of the `stat` of all of its files when it was verified.
+    It is stored in `{pkgPath}/.wake/verified.json`, which is not part of
+    the package's digest.
+    """
+    def __init__(self, pkgDeclared, snapshot):
+        self.pkgDeclared = pkgDeclared
+        self.snapshot = snapshot
+
+    @classmethod
+    def from_pkg(cls, pkgDeclared):
+        """Snapshot a package which was just verified."""
+        return cls(
+            pkgDeclared=pkgDeclared,
+            snapshot=stat_snapshot(pkgDeclared.pkg_dir, pkgDeclared.paths),
+        )
+
+    @staticmethod
+    def path(pkg_dir):
+        return os.path.join(pkg_dir, constants.DIR_WAKE, FILE_VERIFIED)
+
+    @classmethod
+    def load(cls, pkg_dir, check_snapshot=True):
+        """Load the sidecar of the package.
+
+        Returns None if it doesn't exist, is invalid or (if `check_snapshot`)
+        the package's files changed since it was written.
         """
-        if skip_cache or check_cache:
-            # TODO: on exception, delete the file
-            pkg_dir = os.path.join(self.dir, pkgVer.serialize())
+        meta_path = cls.path(pkg_dir)
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            dct = utils.jsonloadf(meta_path)
             pkg_file = os.path.join(pkg_dir, constants.FILE_PKG_DEFAULT)
-            result = load.loadPkgDigest(self.state,
-                                        pkg_file,
-                                        calc_digest=True,
-                                        cleanup=False)
-            if check_cache:
-                assert result.pkgVer == pkgVer
-            return result
-
-        return self.packages[pkgVer]
+            pkgDeclared = pkg.PkgDeclared.deserialize(dct['pkgDeclared'],
+                                                      pkg_file=pkg_file)
+            snapshot = dct['snapshot']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+        if check_snapshot and (snapshot is None or snapshot != stat_snapshot(
+                pkg_dir, pkgDeclared.paths)):
+            return None
+        return cls(pkgDeclared=pkgDeclared, snapshot=snapshot)
+
+    def dump(self):
+        meta_path = self.path(self.pkgDeclared.pkg_dir)
+        meta_dir = os.path.dirname(meta_path)
+        if not os.path.exists(meta_dir):
+            os.mkdir(meta_dir)
+        utils.jsondumpf(meta_path, {
+            'pkgDeclared': self.pkgDeclared.serialize(),
+            'snapshot': self.snapshot,
+        })
+
+
+def stat_snapshot(pkg_dir, paths):
+    """Return `{relpath: [size, mtime, inode]}` of every file in the paths
+    (and the digest file) of a package, or None if any are missing."""
+    snapshot = {}
+
+    def add(fpath):
+        stat = os.stat(fpath)
+        mtime = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+        relpath = os.path.relpath(fpath, pkg_dir)
+        snapshot[relpath] = [stat.st_size, mtime, stat.st_ino]
+
+    try:
+        add(os.path.join(pkg_dir, constants.DEFAULT_FILE_DIGEST))
+        for path in sorted(paths):
+            fpath = utils.pjoin(pkg_dir, path)
+            if not os.path.isdir(fpath):
+                add(fpath)
+                continue
+            for root, _dirs, files in utils.walk(fpath):
+                for fname in files:
+                    add(os.path.join(root, fname))
+    except OSError:
+        return None
+
+    return snapshot
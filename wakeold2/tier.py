@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+# ⏾🌊🛠 wake software's true potential
+#
+# Copyright (C) 2019 Rett Berg <github.com/vitiral>
+#
+# The source code is Licensed under either of
+#
+# * Apache License, Version 2.0, ([LICENSE-APACHE](LICENSE-APACHE) or
+#   http://www.apache.org/licenses/LICENSE-2.0)
+# * MIT license ([LICENSE-MIT](LICENSE-MIT) or
+#   http://opensource.org/licenses/MIT)
+#
+# at your option.
+#
+# Unless you explicitly state otherwise, any contribution intentionally submitted
+# for inclusion in the work by you, as defined in the Apache-2.0 license, shall
+# be dual licensed as above, without any additional terms or conditions.
+"""Store tiers: the places a store keeps package directories.
+
+Every tier supports the `readPackages` and `createPackage` semantics of the
+store exec (see SPC-store in DESIGN.md):
+
+- `read_packages(pkgVers)` returns a `pkgPath` or `NotFound` for each pkgVer.
+- `create_package(pkg_dir, pkgVer, keep)` creates the package entry from a
+  directory, moving it unless `keep` is set, and returns its `pkgPath`.
+
+A `TieredStore` stacks a fast local tier, an optional shared directory tier
+and an optional remote tier.
+
+Tiers can publish a `bloom.FilterFile` of the pkgVers they contain so that
+lookups which are definitely misses never touch a slow tier.
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import jshlib
+from six.moves import queue
+
+from . import bloom
+from . import constants
+from . import utils
+from . import pkg
+
+FILE_FILTER = "filter.bin"
+FILE_LAYOUT = "layout.json"
+
+# The width of each level of shard directories. Two hex characters of the
+# digest gives 256 shards per level.
+DEFAULT_FANOUT = [2]
+
+
+class DirTier(utils.SafeObject):
+    """A tier kept in a directory, i.e. on a local SSD or a shared NFS mount.
+
+    Entries are created in a staging directory inside the tier and then
+    renamed into place, so concurrent builders sharing the directory never
+    observe a partial package.
+
+    The tier publishes a filter of its pkgVers in `.wake/filter.bin`, which is
+    updated on every create and remove.
+
+    Entries are sharded into directories named by prefixes of their digest
+    (`ab/<pkgVer>` for the default fanout), so no directory grows huge and
+    lookups never list a directory. The fanout is recorded in
+    `.wake/layout.json`; tiers created before sharding have no layout file
+    and stay flat until `migrate_layout` is run on them.
+    """
+    def __init__(self, directory):
+        self.dir = directory
+        self.wake_dir = os.path.join(directory, constants.DIR_WAKE)
+        self.staging_dir = os.path.join(self.wake_dir, "tmp")
+        self.layout_path = os.path.join(self.wake_dir, FILE_LAYOUT)
+        is_new = not os.path.exists(self.wake_dir) and not [
+            e for e in os.listdir(directory) if e != constants.DIR_WAKE
+        ]
+        if not os.path.exists(self.staging_dir):
+            os.makedirs(self.staging_dir)
+        if is_new:
+            _dump_layout(self.layout_path, DEFAULT_FANOUT)
+        self.fanout = _load_layout(self.layout_path)
+        self.filter = bloom.FilterFile(
+            os.path.join(self.wake_dir, FILE_FILTER),
+            rebuild_keys=self.list_pkg_vers,
+        )
+
+    def pkg_path(self, pkgVer):
+        """The path the package has (or would have) in this tier."""
+        return _entry_path(self.dir, self.fanout, pkgVer)
+
+    def list_pkg_vers(self):
+        """List the serialized pkgVers in the tier.
+
+        This walks every shard, so is only used for maintenance (rebuilding
+        the filter, scrubbing, migrating).
+        """
+        return _list_entries(self.dir, self.fanout)
+
+    def read_packages(self, pkgVers):
+        """Return the `pkgPath` or `NotFound` of each pkgVer."""
+        bfilter = self.filter.refresh()
+        out = []
+        for pkgVer in pkgVers:
+            pkg_path = self.pkg_path(pkgVer)
+            if pkgVer.serialize() in bfilter and os.path.isdir(pkg_path):
+                out.append(pkg_path)
+            else:
+                out.append(pkg.NotFound(pkgVer))
+        return out
+
+    def create_package(self, pkg_dir, pkgVer, keep=False):
+        """Create the package from a directory, returning its `pkgPath`."""
+        return self.create_packages([(pkg_dir, pkgVer)], keep=keep)[0]
+
+    def create_packages(self, items, keep=False):
+        """Create many packages from `(pkg_dir, pkgVer)` items.
+
+        The batch shares a single update of the published filter, which is
+        made before the packages are renamed into place: every package in
+        the tier is in the filter, even if the builder dies in between.
+        Only the created packages and the directory entries pointing at them
+        are synced. Returns the `pkgPath` of each item, in order.
+        """
+        out = []
+        keys = []
+        staged = []
+        created_paths = []
+        bfilter = self.filter.refresh()
+        staging = tempfile.mkdtemp(prefix="create-", dir=self.staging_dir)
+        try:
+            for i, (pkg_dir, pkgVer) in enumerate(items):
+                dst = self.pkg_path(pkgVer)
+                out.append(dst)
+                if os.path.exists(dst):
+                    if not keep:
+                        utils.rmtree(pkg_dir)
+                    if pkgVer.serialize() not in bfilter:
+                        # i.e. a concurrent update of the filter was lost
+                        keys.append(pkgVer.serialize())
+                    continue
+
+                tmp = os.path.join(staging, str(i))
+                if keep:
+                    shutil.copytree(pkg_dir, tmp)
+                else:
+                    _move(pkg_dir, tmp)
+                keys.append(pkgVer.serialize())
+                staged.append((tmp, dst))
+
+            if keys:
+                self.filter.add_all(keys)
+            for tmp, dst in staged:
+                _makedirs(os.path.dirname(dst))
+                try:
+                    os.rename(tmp, dst)
+                except OSError:
+                    # Another builder may have created it first.
+                    if not os.path.isdir(dst):
+                        raise
+                    continue
+                created_paths.append(dst)
+        finally:
+            utils.rmtree(staging)
+
+        for pkg_path in created_paths:
+            _sync_tree(pkg_path)
+        if keys:
+            _sync_dir(self.dir, *set(os.path.dirname(p) for p in out))
+            # A concurrent rebuild from the disk may have dropped them.
+            bfilter = self.filter.refresh()
+            lost = [k for k in keys if k not in bfilter]
+            if lost:
+                self.filter.add_all(lost)
+        return out
+
+    def remove_package(self, pkgVer):
+        """Remove the package from the tier (if it exists).
+
+        The package is renamed out of place first, so only the one of
+        concurrent removers which took it removes it from the filter.
+        """
+        staging = tempfile.mkdtemp(prefix="remove-", dir=self.staging_dir)
+        try:
+            self._take_package(pkgVer, os.path.join(staging, "pkg"))
+        finally:
+            utils.rmtree(staging)
+
+    def quarantine_package(self, pkgVer):
+        """Move a corrupt package out of the tier into `.wake/quarantine/`.
+
+        Returns the quarantined path (None if the package doesn't exist).
+        """
+        quarantine_dir = os.path.join(self.wake_dir, "quarantine")
+        _makedirs(quarantine_dir)
+        dst = os.path.join(
+            quarantine_dir,
+            "{}.{}".format(pkgVer.serialize(), int(time.time())),
+        )
+        return dst if self._take_package(pkgVer, dst) else None
+
+    def _take_package(self, pkgVer, dst):
+        """Rename the package to `dst` and remove it from the filter.
+
+        Returns False if the package doesn't exist (i.e. it was taken by
+        someone else): the filter is only changed for the keys which were
+        on disk, removing a key which only matches as a false positive
+        would remove other keys.
+        """
+        pkg_path = self.pkg_path(pkgVer)
+        try:
+            os.rename(pkg_path, dst)
+        except OSError:
+            if os.path.isdir(pkg_path):
+                raise
+            return False
+        self.filter.remove(pkgVer.serialize())
+        return True
+
+    def migrate_layout(self, fanout=None):
+        """Move every entry to the layout of `fanout` (default: sharded).
+
+        The new layout is recorded first, so builders running concurrently
+        create entries in the new layout and at worst miss entries which
+        have not been moved yet.
+        """
+        if fanout is None:
+            fanout = DEFAULT_FANOUT
+        old_fanout = self.fanout
+        entries = _list_entries(self.dir, old_fanout)
+
+        _dump_layout(self.layout_path, fanout)
+        self.fanout = fanout
+        parents = set()
+        for entry in entries:
+            pkgVer = pkg.PkgVer.deserialize(entry)
+            src = _entry_path(self.dir, old_fanout, pkgVer)
+            dst = self.pkg_path(pkgVer)
+            if src == dst:
+                continue
+            parents.add(os.path.dirname(dst))
+            _makedirs(os.path.dirname(dst))
+            try:
+                os.rename(src, dst)
+            except OSError:
+                if not os.path.isdir(dst):
+                    raise
+                utils.rmtree(src)
+        _remove_empty_shards(self.dir, old_fanout)
+        _sync_dir(self.dir, *parents)
+
+    def __repr__(self):
+        return "DirTier({})".format(self.dir)
+
+
+class ExecTier(utils.SafeObject):
+    """A tier behind a store `exec` which speaks the JSH store API.
+
+    This is typically a local stand-in service for a remote store which
+    makes the packages it returns available on the local filesystem.
+
+    If the service publishes a `bloom.FilterFile` at `filter_path` then
+    pkgVers which are not in it are never requested.
+    """
+    def __init__(self, exec_path, filter_path=None):
+        self.exec_path = exec_path
+        self.filter = None
+        if filter_path is not None:
+            self.filter = bloom.FilterFile(filter_path)
+
+    def _call(self, method, params):
+        returncode, outputs, logs = jshlib.run_jsh(
+            self.exec_path,
+            method,
+            params=params,
+        )
+        if returncode != 0:
+            raise RuntimeError("{} {} failed (rc={}): {}".format(
+                self.exec_path, method, returncode, logs))
+        return outputs
+
+    def read_packages(self, pkgVers):
+        """Return the `pkgPath` or `NotFound` of each pkgVer."""
+        out = [pkg.NotFound(v) for v in pkgVers]
+        query = list(range(len(pkgVers)))
+        bfilter = self.filter.refresh() if self.filter is not None else None
+        if bfilter is not None:
+            query = [i for i in query if pkgVers[i].serialize() in bfilter]
+        if not query:
+            return out
+
+        outputs = self._call(constants.C_STORE_READ_PKGS, {
+            "versions": [pkgVers[i].serialize() for i in query],
+        })
+        if len(outputs) != len(query):
+            raise ValueError("{} returned {} results for {} versions".format(
+                self.exec_path, len(outputs), len(query)))
+
+        for i, result in zip(query, outputs):
+            if not pkg.is_not_found(result):
+                out[i] = result
+        return out
+
+    def create_packages(self, items, keep=False):
+        """Create many packages from `(pkg_dir, pkgVer)` items."""
+        return [
+            self.create_package(pkg_dir, pkgVer, keep=keep)
+            for pkg_dir, pkgVer in items
+        ]
+
+    def create_package(self, pkg_dir, pkgVer, keep=False):
+        """Create the package from a directory, returning its `pkgPath`."""
+        outputs = self._call(constants.C_STORE_CREATE_PKG, {
+            "dir": pkg_dir,
+            "pkgVer": pkgVer.serialize(),
+            "keep": keep,
+        })
+        return outputs[0]["pkgPath"]
+
+    def __repr__(self):
+        return "ExecTier({})".format(self.exec_path)
+
+
+class TieredStore(utils.SafeObject):
+    """A stack of tiers which is read through and written back.
+
+    - `local`: the fast tier. Every package read from a slower tier is pulled
+      up into it and every new package is written to it.
+    - `shared` (optional): a directory shared between builders. New packages
+      are pushed to it asynchronously, as are packages pulled from `remote`.
+    - `remote` (optional): the slowest tier, typically an `ExecTier`.
+    """
+    def __init__(self, local, shared=None, remote=None):
+        self.local = local
+        self.shared = shared
+        self.remote = remote
+        self.tiers = [t for t in (local, shared, remote) if t is not None]
+        # {pkgVer: tier} of the packages pulled up from a slower tier.
+        self.pulled_from = {}
+        self._pusher = None
+        if shared is not None:
+            self._pusher = _Pusher(local, shared)
+
+    def read_package(self, pkgVer):
+        """Return the `pkgPath` or `NotFound` of a pkgVer."""
+        return self.read_packages([pkgVer])[0]
+
+    def read_packages(self, pkgVers):
+        """Read the pkgVers through the tiers.
+
+        Returns the local `pkgPath` or `NotFound` of each pkgVer, in order.
+        """
+        results = [None] * len(pkgVers)
+        missing = list(range(len(pkgVers)))
+        for tier in self.tiers:
+            if not missing:
+                break
+
+            found = tier.read_packages([pkgVers[i] for i in missing])
+            hits = []
+            still_missing = []
+            for i, pkg_path in zip(missing, found):
+                if pkg.is_not_found(pkg_path):
+                    still_missing.append(i)
+                else:
+                    hits.append(i)
+                    results[i] = pkg_path
+
+            if tier is not self.local and hits:
+                # Pull the hits up into the local tier
+                pulled = self.local.create_packages(
+                    [(results[i], pkgVers[i]) for i in hits],
+                    keep=True,
+                )
+                for i, pkg_path in zip(hits, pulled):
+                    results[i] = pkg_path
+                    self.pulled_from[pkgVers[i]] = tier
+                    if tier is self.remote:
+                        # Make it available to our neighbours as well.
+                        self.push(pkgVers[i])
+
+            missing = still_missing
+
+        for i in missing:
+            results[i] = pkg.NotFound(pkgVers[i])
+        return results
+
+    def create_package(self, pkg_dir, pkgVer, keep=False):
+        """Create the package in the local tier and push it to the shared one.
+        """
+        return self.create_packages([(pkg_dir, pkgVer)], keep=keep)[0]
+
+    def create_packages(self, items, keep=False):
+        """Create `(pkg_dir, pkgVer)` items in the local tier as one batch and
+        push them to the shared one."""
+        pkg_paths = self.local.create_packages(items, keep=keep)
+        for _, pkgVer in items:
+            self.push(pkgVer)
+        return pkg_paths
+
+    def remove_package(self, pkgVer):
+        """Remove the package from the local tier."""
+        self.local.remove_package(pkgVer)
+
+    def quarantine_package(self, pkgVer):
+        """Quarantine a corrupt package in the local tier.
+
+        If it was pulled from a slower tier it is quarantined in the shared
+        tier as well (where a package pulled from the remote was pushed), so
+        that the package created again is pushed to replace it.
+        """
+        pulled = self.pulled_from.pop(pkgVer, None)
+        if pulled is not None and self.shared is not None:
+            self.flush()
+            self.shared.quarantine_package(pkgVer)
+        return self.local.quarantine_package(pkgVer)
+
+    def push(self, pkgVer):
+        """Asynchronously push a local package to the shared tier."""
+        if self._pusher is not None:
+            self._pusher.push(pkgVer)
+
+    def flush(self):
+        """Block until all pushes to the shared tier have completed."""
+        if self._pusher is not None:
+            self._pusher.flush()
+
+
+class _Pusher(object):
+    """Push packages from one tier to another in a background thread."""
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def push(self, pkgVer):
+        self.queue.put(pkgVer)
+
+    def flush(self):
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            pkgVer = self.queue.get()
+            try:
+                src_path = self.src.read_packages([pkgVer])[0]
+                dst_path = self.dst.read_packages([pkgVer])[0]
+                if pkg.is_not_found(dst_path) and not pkg.is_not_found(
+                        src_path):
+                    self.dst.create_package(src_path, pkgVer, keep=True)
+            except Exception as err:  # pylint: disable=broad-except
+                # Failing to share a package is not fatal for the build.
+                sys.stderr.write("WARN: failed pushing {} to {}: {}\n".format(
+                    pkgVer, self.dst, err))
+            finally:
+                self.queue.task_done()
+
+
+def _sync_tree(directory):
+    """Flush the files and directories under the directory to disk."""
+    for root, _, files in utils.walk(directory):
+        for name in files:
+            _fsync(os.path.join(root, name))
+        _fsync(root)
+
+
+def _sync_dir(*directories):
+    """Flush the directories' entries to disk."""
+    for directory in directories:
+        _fsync(directory)
+
+
+def _fsync(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # i.e. a dangling symlink
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not every filesystem (or platform) can fsync a directory.
+        pass
+    finally:
+        os.close(fd)
+
+
+def _entry_path(directory, fanout, pkgVer):
+    """The path of a pkgVer in a directory with the given fanout."""
+    digest = pkgVer.digest.digest
+    parts = [directory]
+    start = 0
+    for width in fanout:
+        parts.append(digest[start:start + width])
+        start += width
+    parts.append(pkgVer.serialize())
+    return os.path.join(*parts)
+
+
+def _list_entries(directory, fanout):
+    """List the entries of a directory with the given fanout."""
+    dirs = [directory]
+    for width in fanout:
+        dirs = [
+            os.path.join(d, e) for d in dirs for e in os.listdir(d)
+            if len(e) == width
+        ]
+    return [e for d in dirs for e in os.listdir(d) if e != constants.DIR_WAKE]
+
+
+def _load_layout(layout_path):
+    """Load the fanout of a tier. Tiers without a layout file are flat."""
+    if not os.path.exists(layout_path):
+        return []
+    return utils.jsonloadf(layout_path)['fanout']
+
+
+def _dump_layout(layout_path, fanout):
+    tmp = "{}.{}.tmp".format(layout_path, os.getpid())
+    utils.jsondumpf(tmp, {'fanout': fanout})
+    os.rename(tmp, layout_path)
+
+
+def _makedirs(directory):
+    # Tolerate concurrent builders creating the same shard.
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def _remove_empty_shards(directory, fanout):
+    if not fanout:
+        return
+    for e in os.listdir(directory):
+        shard_dir = os.path.join(directory, e)
+        if len(e) != fanout[0] or not os.path.isdir(shard_dir):
+            continue
+        _remove_empty_shards(shard_dir, fanout[1:])
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+
+
+def _move(src, dst):
+    """Move a directory, copying it if it is on another filesystem."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        shutil.copytree(src, dst)
+        shutil.rmtree(src)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Migrate a store directory to the sharded layout.')
+    parser.add_argument('store_dir', help='the store directory to migrate')
+    parser.add_argument(
+        '--fanout',
+        type=int,
+        nargs='*',
+        help='width of each level of shards (default: {})'.format(
+            ' '.join(str(w) for w in DEFAULT_FANOUT)))
+    args = parser.parse_args(argv[1:])
+    DirTier(os.path.abspath(args.store_dir)).migrate_layout(args.fanout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
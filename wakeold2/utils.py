@@ -27,6 +27,15 @@ import os
 import json
 import subprocess
 import shutil
+import threading
+from collections import OrderedDict
+
+import six
+
+try:
+    from functools import lru_cache
+except ImportError:  # python2
+    lru_cache = None  # pylint: disable=invalid-name
 
 from . import constants
 from .constants import loadf
@@ -64,6 +73,8 @@ class SafeObject(object):
 # pylint: disable=protected-access
 class TupleObject(object):
     """An object which can be represented as a tuple for comparisons."""
+    __slots__ = ()
+
     def _tuple(self):
         """Override this to return a tuple of only basic types."""
         raise NotImplementedError("Must implement _tuple")
@@ -101,6 +112,113 @@ class TupleObject(object):
         return self._tuple() >= other._tuple()
 
 
+# Sets the fields of an IdentObject from its `__init__`.
+setattr_ident = object.__setattr__  # pylint: disable=invalid-name
+
+
+class IdentObject(TupleObject):
+    """An immutable TupleObject with `__slots__` and a precomputed hash.
+
+    Used for identifiers, of which there can be millions. Subclasses set
+    their fields (listed in `_fields` in the order of their `__init__`
+    arguments) and `_hash` (the hash of their `_tuple`) with
+    `setattr_ident`.
+    """
+    __slots__ = ('_hash', )
+    _fields = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(
+            self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(
+            self.__class__.__name__))
+
+    def __reduce__(self):
+        return (self.__class__,
+                tuple(getattr(self, f) for f in self._fields))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other.__class__ is not self.__class__:
+            self._check_class(other)
+        return self._hash == other._hash and self._tuple() == other._tuple()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+if six.PY2:
+    _interned = {}
+
+    def intern(string):
+        """Return the canonical copy of an identifier string."""
+        return _interned.setdefault(string, string)
+else:
+    intern = sys.intern  # pylint: disable=invalid-name
+
+
+class LruCache(SafeObject):
+    """A thread safe mapping which keeps the `maxsize` most recently used
+    items."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+def lru_deserialize(maxsize):
+    """Decorate a `deserialize(cls, string)` classmethod to cache its results
+    for the `maxsize` most recently used strings.
+
+    The results must be immutable.
+    """
+    def decorator(func):
+        if lru_cache is not None:
+            return classmethod(lru_cache(maxsize)(func))
+
+        def deserialize(cls, string):
+            key = (cls, string)
+            value = cache.get(key)
+            if value is None:
+                value = func(cls, string)
+                cache.put(key, value)
+            return value
+
+        cache = LruCache(maxsize)
+        deserialize.__doc__ = func.__doc__
+        deserialize.__name__ = func.__name__
+        return classmethod(deserialize)
+
+    return decorator
+
+
 def pjoin(base, p):
     if p.startswith('./'):
         p = p[2:]
@@ -140,6 +258,15 @@ def format_run_export(pkgFile, pkgs_defined_path):
     return templ.replace("PKGS_DEFINED", pkgs_defined_path)
 
 
+def format_run_export_deps(pkgFile, deps_exported_path):
+    """Returned the wake jsonnet for getting a pkg export from the already
+    exported deps."""
+    templ = constants.RUN_EXPORT_DEPS_TEMPLATE
+    templ = templ.replace("WAKE_LIB", constants.PATH_WAKELIB)
+    templ = templ.replace("PKG_FILE", pkgFile)
+    return templ.replace("DEPS_EXPORTED", deps_exported_path)
+
+
 def fail(msg):
     msg = "FAIL: {}\n".format(msg)
     sys.stderr.write(msg)
@@ -112,7 +112,8 @@ C {
     [C.F_STATE]: C.S_DECLARED,
     pkgVer: pkgVer,
     pkgOrigin: pkgOrigin,
-    paths: U.arrayDefault(paths),
+    // The pkg file is always one of the paths (as in python's PkgDeclared).
+    paths: std.set(U.arrayDefault(paths) + ['./' + C.FILE_PKG_DEFAULT]),
     depsReq: U.objDefault(depsReq),
 
     // lazy functions
@@ -187,110 +188,78 @@ C {
     local P = self
 
     ,
-    // Looks up all items in the dependency tree
-    lookupDeps(requestingPkgVer, depsReq):
-      local lookupPkg = function(requestingPkgVer, category, pkgReq)
-        local pkgKey = std.join(C.WAKE_SEP, [
-          requestingPkgVer,
-          pkgReq,
-        ]);
-
-        P.pkgsDefined[pkgKey];
-
-      // Lookup all packages in deps
-      local lookupPkgs = function(category, depPkgs) {
-        [k]: lookupPkg(requestingPkgVer, category, depPkgs[k])
-        for k in std.objectFields(depPkgs)
-      };
+    // Resolve the deps of the root pkg and call the export of it and of every
+    // pkg in its dependency tree.
+    //
+    // NOTE: wake._private.pkgsDefined is **injected** by
+    // wakeRunExport.jsonnet. It has the form:
+    //   pkgs: [pkg functions (PKG.libsonnet imports)],
+    //   index: {pkgVer: index in pkgs},
+    //   requests: {pkgKey: pkgVer},
+    //
+    // Every unique pkgVer is resolved and exported once and shared by all of
+    // its requesters, so a wide diamond costs linear time instead of time
+    // proportional to the number of paths. This relies on locals and array
+    // elements being evaluated at most once (object fields are not cached).
+    exportTree(wake, pkg):
+      local defined = P.pkgsDefined;
+      local index = defined.index, requests = defined.requests;
+
+      local exportPkg = function(pkg)
+        P.callExport(wake, pkg, function(pkgKey)
+          assert pkgKey in requests : 'pkgKey=%s not found' % [pkgKey];
+          exported[index[requests[pkgKey]]]),
+
+      exported = [
+        exportPkg(defined.pkgs[i](wake))
+        for i in std.range(0, std.length(defined.pkgs) - 1)
+      ];
+
+      exportPkg(pkg)
 
-      // Return the looked up dependencies
-      {
-        unrestricted: lookupPkgs('unrestricted', depsReq.unrestricted),
-        restricted: lookupPkgs('restricted', depsReq.restricted),
-        restrictedMajor: lookupPkgs('restrictedMajor', depsReq.restrictedMajor),
-        restrictedMinor: lookupPkgs('restrictedMinor', depsReq.restrictedMinor),
-        global: lookupPkgs('global', depsReq.global),
-      }
+    ,
+    // Call the export of a pkg whose deps were already exported.
+    //
+    // depsExported is {pkgKey: manifested dep}, injected as plain json by
+    // wakeRunExportDeps.jsonnet. The PKG files of the deps are never
+    // evaluated, so the cost doesn't grow with the depth of the tree.
+    exportWithDeps(wake, pkg, depsExported):
+      P.callExport(wake, pkg, function(pkgKey)
+        assert pkgKey in depsExported : 'pkgKey=%s not found' % [pkgKey];
+        depsExported[pkgKey])
 
     ,
-    // Resolve the dependencies for all sub pkgs
-    recursePkgResolve(wake, pkg):
+    // Set the deps of a pkg and call its export (at most once).
+    //
+    // lookupPkgKey returns the (exported) pkg a pkgKey resolved to.
+    callExport(wake, pkg, lookupPkgKey):
       assert U.isPkg(pkg) : 'Not a pkg: %s' % [pkg];
-      local requestingPkgVer = pkg.pkgVer;
-
-      // Note: lvl is the "restriction level"
-      local lookupPkg = function(lvl, pkgReq)
-        assert std.isString(lvl);
+      local lookupPkg = function(pkgReq)
         assert std.isString(pkgReq);
-
-        local pkgKey = std.join(C.WAKE_SEP, [
-          requestingPkgVer,
+        local result = lookupPkgKey(std.join(C.WAKE_SEP, [
+          pkg.pkgVer,
           pkgReq,
-        ]);
-
-        // NOTE: wake._private.pkgsDefined is **injected** by
-        // wake/runWakeExport.jsonnet
-        assert pkgKey in P.pkgsDefined : 'pkgKey=%s not found' % [pkgKey];
-
-        local result = P.pkgsDefined[pkgKey](wake);
+        ]));
         assert U.isPkg(result) : 'lookupPkg result is not a package';
-        result
-
-      ;
-      local lookupPkgs = function(lvl, pkgs)
-        assert std.isString(lvl);
-        assert std.isObject(pkgs) : '%s not object: %s' % [lvl, pkgs];
-        {
-          [k]: lookupPkg(lvl, pkgs[k])
-          for k in std.objectFields(pkgs)
-        }
-
-      ;
-      local depsShallow = {
-        [lvl]: lookupPkgs(lvl, pkg.depsReq[lvl])
-        for lvl in std.objectFields(pkg.depsReq)
-      }
-
-      ;
-      local recurseMapResolve = function(pkgs) {
-        [k]: P.recursePkgResolve(wake, pkgs[k])
-        for k in std.objectFields(pkgs)
-      }
-
-      ;
-      pkg {
-        local this = self
-
-        ,
-        deps: {
-          [lvl]: recurseMapResolve(depsShallow[lvl])
-          for lvl in std.objectFields(depsShallow)
-        },
-      }
+        result;
 
-    ,
-    // Note: pkg must have had recursePkgResolve called on it
-    recurseCallExport(wake, pkg):
-      local recurseMapExport = function(pkgs) {
-        [k]: P.recurseCallExport(wake, pkgs[k])
-        for k in std.objectFields(pkgs)
-      }
-
-      ;
-      pkg {
-        local this = self
-
-        ,
+      local result = pkg {
         deps: {
-          [lvl]: recurseMapExport(pkg.deps[lvl])
-          for lvl in std.objectFields(pkg.deps)
+          [lvl]: {
+            [k]: lookupPkg(pkg.depsReq[lvl][k])
+            for k in std.objectFields(pkg.depsReq[lvl])
+          }
+          for lvl in std.objectFields(pkg.depsReq)
         },
-
-        export: if pkg.exportFn == null then
+        export: exportValue[0],
+      },
+      exportValue = [
+        if pkg.exportFn == null then
           null
         else
-          pkg.exportFn(wake, this),
-      },
+          pkg.exportFn(wake, result),
+      ];
+      result
 
     // , simplify(pkg): {
     //     [C.F_TYPE]: pkg[C.F_TYPE],